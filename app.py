@@ -1,13 +1,16 @@
 import dash
+import diskcache
 import ee
+import os
 import subprocess
 import sys
 
 import dash_bootstrap_components as dbc
 
 from components.navbar import navbar
-from dash import Dash, html, dcc
+from dash import Dash, DiskcacheManager, html, dcc
 from pathlib import Path
+from ursa.utils.cache_manager import CACHE_DIR
 from ursa.utils.image import b64_image
 
 
@@ -21,10 +24,18 @@ data_path = Path("./data")
 
 HEADER_STYLE = {"text-align": "center", "margin": "50px"}
 
+# Long running callbacks, e.g. SLEUTH calibration, run as background
+# callbacks in separate processes, their state is kept in this cache
+BACKGROUND_CACHE_DIR = Path(
+    os.environ.get("URSA_BACKGROUND_CACHE_DIR", CACHE_DIR / "background")
+)
+background_callback_manager = DiskcacheManager(diskcache.Cache(BACKGROUND_CACHE_DIR))
+
 app = Dash(
     __name__,
     use_pages=True,
     external_stylesheets=[dbc.themes.BOOTSTRAP, dbc.icons.BOOTSTRAP],
+    background_callback_manager=background_callback_manager,
 )
 
 content = dcc.Loading(
@@ -0,0 +1,106 @@
+"""Benchmark of the nearest road search used to derive the SLEUTH road
+auxiliary grids.
+
+Compares the KDTree query over every lattice point used previously
+against the distance transform in ursa.sleuth_prep, reporting time and
+peak memory at SLEUTH grid sizes. Distances must be identical. Nearest
+roads may differ between equally distant candidates, so each returned
+road is checked to be a road pixel at the reported distance.
+
+Run from the repository root with:
+    python benchmarks/bench_auxiliary_roads.py
+"""
+
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+sys.path.append("./src")
+
+from scipy.spatial import KDTree  # noqa: E402
+from ursa.sleuth_prep import derive_auxiliary_roads_numpy  # noqa: E402
+
+SIZES = [500, 1000, 2000]
+METRICS = {"chebyshev": np.inf, "manhattan": 1, "euclidean": 2}
+SEED = 0
+
+
+def derive_auxiliary_roads_kdtree(roads, d_metric=np.inf):
+    roads = roads.copy()
+
+    roads[0, :] = 0
+    roads[:, 0] = 0
+    roads[-1, :] = 0
+    roads[:, -1] = 0
+
+    road_idx = np.column_stack(np.where(roads > 0))
+    tree = KDTree(road_idx)
+    I, J = roads.shape
+    grid_i, grid_j = np.meshgrid(range(I), range(J), indexing="ij")
+    coords = np.column_stack([grid_i.ravel(), grid_j.ravel()])
+    road_dist, idxs = tree.query(coords, p=d_metric)
+    road_dist = road_dist.reshape(roads.shape).astype(np.int32)
+    road_i = road_idx[:, 0][idxs].reshape(roads.shape).astype(np.int32)
+    road_j = road_idx[:, 1][idxs].reshape(roads.shape).astype(np.int32)
+
+    return roads, road_i, road_j, road_dist
+
+
+def make_roads(size, seed):
+    """Synthetic road raster with a sparse grid of straight roads of
+    weights 1-100, similar to a rasterized OSM network."""
+    rng = np.random.default_rng(seed)
+    roads = np.zeros((size, size), dtype=np.int32)
+    for _ in range(size // 20):
+        weight = rng.integers(1, 101)
+        if rng.random() < 0.5:
+            roads[rng.integers(size), :] = weight
+        else:
+            roads[:, rng.integers(size)] = weight
+    return roads
+
+
+def profile(func, *args, **kwargs):
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, elapsed, peak / 1024**2
+
+
+def check(roads, road_i, road_j, road_dist, d_metric):
+    assert (roads[road_i, road_j] > 0).all()
+    grid_i, grid_j = np.indices(roads.shape)
+    offsets = np.stack([road_i - grid_i, road_j - grid_j])
+    dist = np.linalg.norm(offsets, ord=d_metric, axis=0).astype(np.int32)
+    assert np.array_equal(dist, road_dist)
+
+
+def main():
+    for size in SIZES:
+        roads = make_roads(size, SEED)
+        for name, d_metric in METRICS.items():
+            old, old_time, old_mem = profile(
+                derive_auxiliary_roads_kdtree, roads, d_metric=d_metric
+            )
+            new, new_time, new_mem = profile(
+                derive_auxiliary_roads_numpy, roads, d_metric=d_metric
+            )
+
+            assert np.array_equal(old[0], new[0])
+            assert np.array_equal(old[3], new[3])
+            check(*new, d_metric)
+
+            print(
+                f"{size}x{size} {name}: "
+                f"KDTree {old_time:.2f}s {old_mem:.0f} MB, "
+                f"distance transform {new_time:.3f}s {new_mem:.0f} MB"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+"""Benchmark of the land cover projection shown on the SLEUTH page.
+
+Compares the loop over WorldCover classes and predicted years used
+previously against layouts.sleuth.calculate_coverage on a 50 year
+prediction. Results must match up to floating point rounding.
+
+Run from the repository root with:
+    python benchmarks/bench_coverage.py
+"""
+
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+sys.path.append(".")
+sys.path.append("./src")
+
+from layouts.sleuth import WORLD_COVER_TYPE, calculate_coverage  # noqa: E402
+
+SIZES = [500, 1000]
+NUM_YEARS = 50
+START_YEAR = 2020
+SEED = 0
+
+
+def calculate_coverage_loop(worldcover, sleuth_predictions, start_year):
+    num_samples, height, width = sleuth_predictions.shape
+
+    kernels = {}
+    for key, value in WORLD_COVER_TYPE.items():
+        kernels[key] = np.where(worldcover == value, 1, 0)
+
+    result_df = pd.DataFrame()
+    for key, kernel in kernels.items():
+        sample_results = []
+        for i in range(num_samples):
+            result = np.sum((1 - sleuth_predictions[i]) * kernel) / (height * width)
+            sample_results.append(result)
+        result_df[key] = sample_results
+
+    sample_results = []
+    for i in range(num_samples):
+        result = np.sum(sleuth_predictions[i]) / (height * width)
+        sample_results.append(result)
+    result_df["Urban"] = sample_results
+    result_df["Year"] = list(range(start_year + 1, start_year + num_samples + 1))
+    result_df.set_index("Year", inplace=True)
+    result_df = result_df * 100
+    return result_df
+
+
+def main():
+    rng = np.random.default_rng(SEED)
+    codes = list(WORLD_COVER_TYPE.values()) + [0]
+    for size in SIZES:
+        worldcover = rng.choice(codes, size=(size, size))
+        predictions = np.sort(rng.random((NUM_YEARS, size, size)), axis=0)
+
+        start = time.perf_counter()
+        old = calculate_coverage_loop(worldcover, predictions, START_YEAR)
+        old_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        new = calculate_coverage(worldcover, predictions, START_YEAR)
+        new_time = time.perf_counter() - start
+
+        pd.testing.assert_frame_equal(old, new, rtol=1e-9)
+        print(f"{size}x{size}: loop {old_time:.2f}s, bincount {new_time:.3f}s")
+
+
+if __name__ == "__main__":
+    main()
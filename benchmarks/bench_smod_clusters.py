@@ -0,0 +1,60 @@
+"""Benchmark of the SMOD cluster history map of the historic growth page.
+
+Builds ghsl.plot_smod_clusters for a city in every rendering mode and
+reports the build time and the size of the figure JSON sent to the
+browser. The "pixels" mode is the previous output, one polygon per SMOD
+pixel.
+
+Needs the city files in data/output/cities and downloads the SMOD
+raster into the city cache if missing.
+
+Run from the repository root with:
+    python benchmarks/bench_smod_clusters.py [--country Argentina] [--city "Buenos Aires"]
+"""
+
+import argparse
+import sys
+import time
+
+from pathlib import Path
+
+sys.path.append("./src")
+
+import ursa.ghsl as ghsl  # noqa: E402
+import ursa.utils.cache_manager as cm  # noqa: E402
+import ursa.utils.geometry as ug  # noqa: E402
+import ursa.utils.raster as ru  # noqa: E402
+
+PATH_FUA = Path("./data/output/cities/")
+MODES = ["pixels", "dissolve", "image"]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--country", default="Argentina")
+    parser.add_argument("--city", default="Buenos Aires")
+    args = parser.parse_args()
+
+    bbox_latlon, _, _ = ru.get_bboxes(args.city, args.country, PATH_FUA)
+    bbox_mollweide = ug.reproject_geometry(bbox_latlon, ghsl.GHS_CRS).envelope
+    id_hash = ug.hash_geometry(ug.geometry_to_json(bbox_latlon))
+    path_cache = cm.CACHE_DIR / str(id_hash)
+    path_cache.mkdir(parents=True, exist_ok=True)
+
+    smod, _, _ = ghsl.load_plot_datasets(bbox_mollweide, path_cache, clip=True)
+    print(f"{args.city}, {args.country}: SMOD grid {smod.shape[1]}x{smod.shape[2]}")
+
+    for feature in ["clusters", "centers"]:
+        for mode in MODES:
+            start = time.perf_counter()
+            fig = ghsl.plot_smod_clusters(smod, bbox_latlon, feature, mode)
+            elapsed = time.perf_counter() - start
+            payload = len(fig.to_json())
+            print(
+                f"{feature} {mode}: built in {elapsed:.2f} s, "
+                f"{payload / 1e6:.2f} MB JSON"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,165 @@
+"""Benchmark of the cluster population filter, majority smoothing and
+hole filling used by find_urban_clusters and find_urban_centers.
+
+Times the implementations in ursa.degree_of_urbanization on a full
+size grid. The full raster loops used previously scale with pixels
+times clusters, so they are timed on a crop of the grid only, checking
+that both produce the same arrays and that cluster populations are
+bit-identical, including clusters whose population is set right at the
+threshold.
+
+Run from the repository root with:
+    python benchmarks/bench_urban_clusters.py [--size 2000] [--check-size 500]
+"""
+
+import argparse
+import sys
+import time
+
+import numpy as np
+
+sys.path.append("./src")
+
+from scipy.ndimage import convolve, label  # noqa: E402
+from ursa.degree_of_urbanization import (  # noqa: E402
+    fill_holes,
+    remove_small_clusters,
+    smooth_clusters,
+)
+
+SIZE = 2000
+# Side of the crop on which the loops are timed and compared
+CHECK_SIZE = 500
+SEED = 0
+
+
+def remove_small_clusters_loop(array, clusters, nclusters, pop_array, min_pop):
+    labels = []
+    for lbl in range(1, nclusters + 1):
+        mask = clusters == lbl
+        total_pop = pop_array[mask].sum()
+        if total_pop < min_pop:
+            array[mask] = 0
+            clusters[mask] = 0
+        else:
+            labels.append(lbl)
+    return np.array(labels)
+
+
+def smooth_clusters_loop(array, clusters, labels):
+    kernel = np.array([[1, 1, 1], [1, -8, 1], [1, 1, 1]])
+    for lbl in labels:
+        current_center = (clusters == lbl).astype(int)
+        while True:
+            n_nbrs = convolve(current_center, kernel, mode="constant", output=int)
+            mask = n_nbrs >= 5
+            if mask.sum() == 0:
+                break
+            current_center[mask] = 1
+            array[mask] += 1
+
+
+def fill_holes_loop(array, min_hole_size):
+    inverted = 1 - array
+    holes, nholes = label(inverted)
+    for h in range(1, nholes + 1):
+        mask = holes == h
+        if mask.sum() <= min_hole_size:
+            array[mask] = 1
+
+
+def make_density(size, seed):
+    """Synthetic density grid with many small islands, similar to a large
+    metropolitan bbox at 100 m."""
+    rng = np.random.default_rng(seed)
+    density = rng.lognormal(mean=4, sigma=1.5, size=(size, size))
+    return density.astype("float32")
+
+
+def check_thresholds(remove_func, density, nchecked=200):
+    """Runs remove_func with min_pop set to the population of each of
+    the first nchecked clusters, and to the next float32 above it, where
+    totals differing in the last bit would flip the cluster. Checks the
+    kept labels against the populations summed by the loop and returns
+    the number of thresholds checked."""
+    u_array = (density >= 300).astype("uint8")
+    clusters, nclusters = label(u_array, structure=np.ones((3, 3)))
+    loop_pop = np.array(
+        [density[clusters == lbl].sum() for lbl in range(1, nclusters + 1)]
+    )
+
+    thresholds = []
+    for pop in loop_pop[:nchecked]:
+        thresholds += [pop, np.nextafter(pop, np.float32(np.inf))]
+
+    for threshold in thresholds:
+        kept = remove_func(
+            u_array.copy(), clusters.copy(), nclusters, density, threshold
+        )
+        expected = np.flatnonzero(~(loop_pop < threshold)) + 1
+        assert np.array_equal(kept, expected)
+
+    return len(thresholds)
+
+
+def run(remove_func, smooth_func, fill_func, density):
+    u_array = np.zeros_like(density, dtype="uint8")
+    u_array[density >= 300] = 1
+    clusters, nclusters = label(u_array, structure=np.ones((3, 3)))
+
+    start = time.perf_counter()
+    labels = remove_func(u_array, clusters, nclusters, density, 5000)
+    t_remove = time.perf_counter() - start
+
+    start = time.perf_counter()
+    smooth_func(u_array, clusters, labels)
+    u_array[u_array > 1] = 0
+    t_smooth = time.perf_counter() - start
+
+    start = time.perf_counter()
+    fill_func(u_array, 100)
+    t_fill = time.perf_counter() - start
+
+    return u_array, labels, nclusters, (t_remove, t_smooth, t_fill)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--size", type=int, default=SIZE)
+    parser.add_argument("--check-size", type=int, default=CHECK_SIZE)
+    args = parser.parse_args()
+    check_size = min(args.check_size, args.size)
+
+    density = make_density(args.size, SEED)
+    steps = ["Population filter", "Majority smoothing", "Hole filling"]
+
+    _, _, nclusters, full_times = run(
+        remove_small_clusters, smooth_clusters, fill_holes, density
+    )
+    print(f"Grid: {args.size}x{args.size}, clusters: {nclusters}")
+    for step, new in zip(steps, full_times):
+        print(f"{step}: {new:.3f}s")
+    print(f"Total: {sum(full_times):.3f}s")
+
+    crop = density[:check_size, :check_size]
+    new_array, new_labels, nclusters, new_times = run(
+        remove_small_clusters, smooth_clusters, fill_holes, crop
+    )
+    old_array, old_labels, _, old_times = run(
+        remove_small_clusters_loop, smooth_clusters_loop, fill_holes_loop, crop
+    )
+
+    assert np.array_equal(new_array, old_array)
+    assert np.array_equal(new_labels, old_labels)
+
+    nthresholds = check_thresholds(remove_small_clusters, crop)
+
+    print(f"Crop: {check_size}x{check_size}, clusters: {nclusters}")
+    for step, old, new in zip(steps, old_times, new_times):
+        print(f"{step}: loop {old:.2f}s, new {new:.3f}s")
+    print(f"Speedup: {sum(old_times) / sum(new_times):.0f}x, outputs identical.")
+    print(f"Population filter identical at {nthresholds} threshold values.")
+
+
+if __name__ == "__main__":
+    main()
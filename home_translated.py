@@ -5,6 +5,7 @@ import json
 import dash_bootstrap_components as dbc
 import dash_leaflet as dl
 import geopandas as gpd
+import ursa.utils.cache_manager as cm
 import ursa.utils.raster as ru
 
 from dash import callback, html, Input, Output, State
@@ -372,7 +373,7 @@ def set_city(n_clicks, country, city):
 
     id_hash = hash_geometry(bbox_latlon_json)
 
-    path_cache = Path(f"./data/cache/{str(id_hash)}")
+    path_cache = cm.CACHE_DIR / str(id_hash)
     path_cache.mkdir(exist_ok=True, parents=True)
 
     centroid = bbox_latlon.centroid
@@ -410,7 +411,7 @@ def set_custom_bbox(n_clicks, geojson, bbox_orig):
     features = geojson["features"]
     if len(features) == 0:
         id_hash = hash_geometry(bbox_orig)
-        path_cache = Path(f"./data/cache/{str(id_hash)}")
+        path_cache = cm.CACHE_DIR / str(id_hash)
         path_cache.mkdir(exist_ok=True, parents=True)
         return (
             bbox_orig,
@@ -434,7 +435,7 @@ def set_custom_bbox(n_clicks, geojson, bbox_orig):
         )
 
     id_hash = hash_geometry(bbox_json)
-    path_cache = Path(f"./data/cache/{str(id_hash)}")
+    path_cache = cm.CACHE_DIR / str(id_hash)
     path_cache.mkdir(exist_ok=True, parents=True)
 
     if len(features) == 1:
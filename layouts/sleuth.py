@@ -6,11 +6,13 @@ import dash_bootstrap_components as dbc
 import numpy as np
 import pandas as pd
 import plotly.express as px
+import plotly.graph_objects as go
+import ursa.utils.cache_manager as cm
+import ursa.utils.image as ui
 import xarray as xr
 
 from dash import html
 from dash import dcc
-from pathlib import Path
 from shapely.geometry import shape
 
 WORLD_COVER_COLOR = {
@@ -29,51 +31,108 @@ WORLD_COVER_COLOR = {
 
 FIELDS = ["diffusion", "breed", "spread", "slope", "road"]
 
+PREDICTION_COLORSCALE = "Plasma"
+
+
+WORLD_COVER_TYPE = {
+    "Tree Cover": 10,
+    "Shrubland": 20,
+    "Grassland": 30,
+    "Cropland": 40,
+    "Built-up": 50,
+    "Bare/Sparse Vegetation": 60,
+    "Snow and Ice": 70,
+    "Permanent water bodies": 80,
+    "Herbaceous wetlands": 90,
+    "Mangroves": 95,
+    "Moss and lichen": 100,
+}
+
 
 def calculate_coverage(worldcover, sleuth_predictions, start_year):
-    world_cover_type = {
-        "Tree Cover": 10,
-        "Shrubland": 20,
-        "Grassland": 30,
-        "Cropland": 40,
-        "Built-up": 50,
-        "Bare/Sparse Vegetation": 60,
-        "Snow and Ice": 70,
-        "Permanent water bodies": 80,
-        "Herbaceous wetlands": 90,
-        "Mangroves": 95,
-        "Moss and lichen": 100,
-    }
-
-    # Obtener el tamaño de sleuth_predictions
-    num_samples, height, width = sleuth_predictions.shape
+    """Percentage of the area of each WorldCover class expected to remain
+    non-urban in every predicted year, and the percentage of urban area.
+
+    The non-urban area of a class is its pixel count minus the urban
+    probability summed over its pixels, computed for every year with a
+    weighted bincount over the class index of each pixel.
+    """
 
-    # Crear un diccionario de kernels
-    kernels = {}
-    for key, value in world_cover_type.items():
-        kernels[key] = np.where(worldcover == value, 1, 0)
-
-    # Inicializar un DataFrame vacío
-    result_df = pd.DataFrame()
-
-    # Aplicar el proceso a cada clase en world_cover_type
-    for key, kernel in kernels.items():
-        sample_results = []
-        for i in range(num_samples):
-            result = np.sum((1 - sleuth_predictions[i]) * kernel) / (height * width)
-            sample_results.append(result)
-        result_df[key] = sample_results
-
-    sample_results = []
-    for i in range(num_samples):
-        result = np.sum(sleuth_predictions[i]) / (height * width)
-        sample_results.append(result)
-    result_df["Urban"] = sample_results
+    num_samples, height, width = sleuth_predictions.shape
+    predictions = sleuth_predictions.reshape(num_samples, height * width)
+
+    # Index of the class of each pixel, pixels of other classes get an
+    # extra index that is dropped
+    num_classes = len(WORLD_COVER_TYPE)
+    worldcover = worldcover.ravel()
+    class_idx = np.full(worldcover.shape, num_classes, dtype=np.intp)
+    for i, code in enumerate(WORLD_COVER_TYPE.values()):
+        class_idx[worldcover == code] = i
+
+    counts = np.bincount(class_idx, minlength=num_classes + 1)[:num_classes]
+    urban_by_class = np.array(
+        [
+            np.bincount(class_idx, weights=row, minlength=num_classes + 1)
+            for row in predictions
+        ]
+    )[:, :num_classes]
+    non_urban = (counts - urban_by_class) / (height * width)
+
+    result_df = pd.DataFrame(non_urban, columns=list(WORLD_COVER_TYPE))
+    result_df["Urban"] = predictions.sum(axis=1) / (height * width)
     result_df["Year"] = list(range(start_year + 1, start_year + num_samples + 1))
     result_df.set_index("Year", inplace=True)
     result_df = result_df * 100
     return result_df
 
+
+def load_or_calculate_coverage(
+    worldcover, sleuth_predictions, start_year, path_cache, mode, force=False
+):
+    """Loads the coverage of a prediction mode from the city cache,
+    computing it with calculate_coverage if missing.
+
+    The cached table is named after mode and start_year, and it is
+    computed again if the predictions ({mode}.npy) or the land cover
+    (worldcover.npy) in the cache are newer.
+
+    Parameters
+    ----------
+    worldcover : np.ndarray
+        WorldCover class of each pixel.
+    sleuth_predictions : np.ndarray
+        Urbanization probabilities of shape (years, height, width).
+    start_year : int
+        Year before the first predicted year.
+    path_cache : Path
+        City cache directory.
+    mode : str
+        Name of the prediction mode, e.g. "inercial".
+    force : bool
+        If True, compute the coverage even if cached.
+
+    Returns
+    -------
+    df : pd.DataFrame
+        Coverage by year, see calculate_coverage.
+    """
+
+    fpath = path_cache / f"coverage_{mode}_{start_year}.csv"
+    sources = [path_cache / f"{mode}.npy", path_cache / "worldcover.npy"]
+
+    stale = fpath.exists() and any(
+        source.exists() and source.stat().st_mtime > fpath.stat().st_mtime
+        for source in sources
+    )
+    if not force and not stale and cm.lookup(fpath):
+        df = pd.read_csv(fpath, index_col="Year")
+    else:
+        df = calculate_coverage(worldcover, sleuth_predictions, start_year)
+        df.to_csv(fpath)
+        cm.register(fpath, producer=calculate_coverage)
+    return df
+
+
 def plot_coverage(lc_df, title):
     # Eliminamos columnas que tengan cero
     lc_df = lc_df.loc[:, (lc_df != 0).any(axis=0)]
@@ -231,33 +290,93 @@ def load_sleuth_predictions(path_cache, id_hash, mode):
 
 
 def plot_sleuth_predictions(grid, start_year, num_years):
-    sim_years = list(range(start_year + 1, start_year + num_years + 1))
+    """Animated map of predicted urbanization probabilities.
 
-    grid_plot = xr.DataArray(
-        data=grid * 100,
-        dims=["Año", "y", "x"],
-        coords={
-            "Año": sim_years,
-            "y": list(range(grid.shape[1])),
-            "x": list(range(grid.shape[2])),
-        },
+    Every year is sent as a downsampled palette PNG (see
+    ursa.utils.image.encode_frames) instead of a full matrix, full
+    resolution grids are only available through downloads. The colorbar
+    is drawn by an empty scatter trace, since image traces have none.
+    """
+
+    sim_years = list(range(start_year + 1, start_year + num_years + 1))
+    uris, (height, width) = ui.encode_frames(grid, PREDICTION_COLORSCALE)
+
+    colorbar_trace = go.Scatter(
+        x=[None],
+        y=[None],
+        mode="markers",
+        marker=dict(
+            color=[0],
+            colorscale=PREDICTION_COLORSCALE,
+            cmin=0,
+            cmax=100,
+            showscale=True,
+            colorbar=dict(title="Probabilidad de urbanización"),
+        ),
+        hoverinfo="skip",
+        showlegend=False,
     )
 
-    fig = px.imshow(
-        grid_plot,
-        animation_frame="Año",
-        labels=dict(color="Probabilidad de urbanización"),
-        zmin=0,
-        zmax=100,
-        aspect="equal",
+    frames = [
+        go.Frame(data=[go.Image(source=uri)], traces=[0], name=str(year))
+        for year, uri in zip(sim_years, uris)
+    ]
+
+    def animate_args(duration):
+        return {
+            "mode": "immediate",
+            "frame": {"duration": duration, "redraw": True},
+            "transition": {"duration": 0},
+        }
+
+    steps = [
+        dict(method="animate", label=str(year), args=[[str(year)], animate_args(0)])
+        for year in sim_years
+    ]
+
+    fig = go.Figure(
+        data=[go.Image(source=uris[0], hoverinfo="skip"), colorbar_trace],
+        frames=frames,
+    )
+    fig.update_layout(
+        sliders=[dict(active=0, currentvalue={"prefix": "Año="}, steps=steps)],
+        updatemenus=[
+            dict(
+                type="buttons",
+                direction="left",
+                x=0.1,
+                y=0,
+                xanchor="right",
+                yanchor="top",
+                pad={"r": 10, "t": 70},
+                showactive=False,
+                buttons=[
+                    dict(
+                        label="&#9654;",
+                        method="animate",
+                        args=[None, animate_args(500)],
+                    ),
+                    dict(
+                        label="&#9724;",
+                        method="animate",
+                        args=[[None], animate_args(0)],
+                    ),
+                ],
+            )
+        ],
+    )
+    fig.update_xaxes(showticklabels=False, visible=False, range=[-0.5, width - 0.5])
+    fig.update_yaxes(
+        showticklabels=False,
+        visible=False,
+        range=[height - 0.5, -0.5],
+        scaleanchor="x",
     )
-    fig.update_xaxes(showticklabels=False, visible=False)
-    fig.update_yaxes(showticklabels=False, visible=False)
     return fig
 
 
 def summary(id_hash, urban_rasters, years):
-    path_cache = Path(f"./data/cache/{id_hash}")
+    path_cache = cm.CACHE_DIR / str(id_hash)
 
     worldcover = np.load(path_cache / "worldcover.npy")
 
@@ -314,8 +433,8 @@ def summary(id_hash, urban_rasters, years):
         )
         tabs.append(tab)
         # Coverage
-        estimate_coverage = calculate_coverage(
-            worldcover, grids, start_year, 
+        estimate_coverage = load_or_calculate_coverage(
+            worldcover, grids, start_year, path_cache, mode
         )
         fig_coverage = plot_coverage(estimate_coverage, f"Expansión {mode}")
         # fig_coverage.write_image(f"./test/{mode}.eps", width=1200, height=600, scale=1.5)
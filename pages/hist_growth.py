@@ -2,13 +2,12 @@ import dash
 
 import dash_bootstrap_components as dbc
 import ursa.ghsl as ghsl
-import ursa.utils.geometry as ug
+import ursa.utils.cache_manager as cm
 
 from components.text import figureWithDescription, figureWithDescription_translation
 from components.text import mapComponent
 from components.page import new_page_layout
 from dash import html, dcc, callback, Input, Output
-from pathlib import Path
 from shapely.geometry import shape
 from zipfile import ZipFile
 
@@ -604,96 +603,21 @@ def generate_lines(id_hash, bbox_latlon, uc_latlon):
     if id_hash is None:
         return [dash.no_update] * 11 + ["/"]
 
-    path_cache = Path(f"./data/cache/{str(id_hash)}")
+    path_cache = cm.CACHE_DIR / str(id_hash)
 
     bbox_latlon = shape(bbox_latlon)
-    bbox_mollweide = ug.reproject_geometry(bbox_latlon, "ESRI:54009").envelope
-
     uc_latlon = shape(uc_latlon)
-    uc_mollweide = ug.reproject_geometry(uc_latlon, "ESRI:54009")
-
-    centroid_mollweide = uc_mollweide.centroid
-
-    smod, built, pop = ghsl.load_plot_datasets(bbox_mollweide, path_cache, clip=True)
-
-    growth_df = ghsl.get_urb_growth_df(
-        smod=smod,
-        built=built,
-        pop=pop,
-        centroid_mollweide=centroid_mollweide,
-        path_cache=path_cache,
-    )
-
-    line_plot_params = [
-        dict(
-            y_cols=["urban_cluster_main", "urban_cluster_other"],
-            title="Área urbana",
-            ylabel="Área (km²)",
-            var_type="extensive",
-        ),
-        dict(
-            y_cols=["built_cluster_main", "built_cluster_other"],
-            title="Área construida",
-            ylabel="Área (km²)",
-            var_type="extensive",
-        ),
-        dict(
-            y_cols=["pop_cluster_main", "pop_cluster_other"],
-            title="Población",
-            ylabel="Población",
-            var_type="extensive",
-        ),
-        dict(
-            y_cols=[
-                "built_density_cluster_main",
-                "built_density_cluster_other",
-                "built_density_cluster_all",
-            ],
-            title="Densidad de construcción",
-            ylabel="Fracción de área construida",
-            var_type="intensive",
-        ),
-        dict(
-            y_cols=[
-                "pop_density_cluster_main",
-                "pop_density_cluster_other",
-                "pop_density_cluster_all",
-            ],
-            title="Densidad de población",
-            ylabel="Personas por km²",
-            var_type="intensive",
-        ),
-        dict(
-            y_cols=[
-                "pop_b_density_cluster_main",
-                "pop_b_density_cluster_other",
-                "pop_b_density_cluster_all",
-            ],
-            title="Densidad de población (construcción)",
-            ylabel="Personas por km² de construcción",
-            var_type="intensive",
-        ),
-    ]
+
+    lines, maps = ghsl.load_or_plot_hist_growth(bbox_latlon, uc_latlon, path_cache)
 
     plots = []
-    for params in line_plot_params:
-        try:
-            lines = ghsl.plot_growth(growth_df, **params)
-            plots.append(lines)
-        except Exception:
+    for lines_fig in lines:
+        if lines_fig is None:
             plots.append(dash.no_update)
             error_triggered = True
+        else:
+            plots.append(lines_fig)
 
-    map1 = ghsl.plot_built_agg_img(smod, built, bbox_mollweide, centroid_mollweide)
-    map2 = ghsl.plot_smod_clusters(smod, bbox_latlon)
-    map3 = ghsl.plot_built_year_img(
-        smod, built, bbox_latlon, bbox_mollweide, centroid_mollweide
-    )
-    map4 = ghsl.plot_pop_year_img(smod, pop, bbox_mollweide, centroid_mollweide)
-
-    plots.append(map1)
-    plots.append(map2)
-    plots.append(map3)
-    plots.append(map4)
+    plots += maps
 
     return plots + [error_triggered, dash.no_update]
\ No newline at end of file
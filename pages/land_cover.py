@@ -4,6 +4,7 @@ import ee
 
 import dash_bootstrap_components as dbc
 import ursa.dynamic_world as udw
+import ursa.utils.cache_manager as cm
 
 from components.page import new_page_layout
 from components.text import figureWithDescription, figureWithDescription_translation
@@ -460,7 +461,7 @@ def generate_plots(id_hash, bbox_latlon, fua_latlon):
     if id_hash is None:
         return [dash.no_update] * 3 + ["/"]
 
-    path_cache = Path(f"./data/cache/{id_hash}")
+    path_cache = cm.CACHE_DIR / str(id_hash)
 
     bbox_latlon = shape(bbox_latlon)
     fua_latlon = shape(fua_latlon)
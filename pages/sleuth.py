@@ -13,12 +13,15 @@ import plotly.express as px
 import rasterio as rio
 import rasterio.warp as warp
 import sleuth_sklearn.utils as utils
+import ursa.sleuth_jobs as sj
 import ursa.sleuth_prep as sp
+import ursa.utils.array_store as store
+import ursa.utils.cache_manager as cm
 import ursa.utils.geometry as ug
-import xarray as xr
 
 from dash import html, dcc, callback, Input, Output, State
 from io import BytesIO
+from itertools import chain
 from pathlib import Path
 from rasterio import MemoryFile
 from rasterio.crs import CRS
@@ -304,6 +307,11 @@ translations = {
         "en": "Execute Calibration",
         "pt": "Executar Calibração"
     },
+    "btn-cancel-calibration": {
+        "es": "Cancelar calibración",
+        "en": "Cancel Calibration",
+        "pt": "Cancelar Calibração",
+    },
     "simulacion-text1": {
         "es": "Parámetros",
         "en": "Parameters",
@@ -643,7 +651,7 @@ RASTER_FIELD_MAP = {
     "urban": "Urbano",
 }
 
-PATH_CACHE = Path("./data/cache")
+PATH_CACHE = cm.CACHE_DIR
 
 dash.register_page(
     __name__,
@@ -1508,7 +1516,28 @@ subtab_3 = dbc.Card(dbc.CardBody(rows_3))
 
 # Simulación
 submit_button = html.Div(
-    [dbc.Button(id="btn-calibrate", n_clicks=0)],
+    [
+        dbc.Button(id="btn-calibrate", n_clicks=0, className="me-2"),
+        dbc.Button(
+            id="btn-cancel-calibration",
+            n_clicks=0,
+            color="danger",
+            disabled=True,
+        ),
+        dbc.Progress(
+            id="progress-calibration",
+            value=0,
+            striped=True,
+            animated=True,
+            className="mt-3",
+        ),
+        html.Div(id="div-calibration-progress", className="mt-2"),
+        dcc.Interval(
+            id="interval-calibration",
+            interval=sj.JOB_POLL_SECONDS * 1000,
+            disabled=True,
+        ),
+    ],
     className="mt-2 text-center",
 )
 
@@ -1928,7 +1957,15 @@ subtab_2_3 = dbc.Card(
     )
 )
 
-subtab_2_4 = dbc.Card(dbc.CardBody(id="card-prediction-results"))
+subtab_2_4 = dbc.Card(
+    dbc.CardBody(
+        [
+            # Scenario tabs are streamed here while the prediction runs
+            html.Div(id="div-prediction-progress"),
+            html.Div(id="card-prediction-results"),
+        ]
+    )
+)
 
 tab2_content = dbc.Card(
     dbc.CardBody(
@@ -1990,6 +2027,8 @@ all_stores = (
     + [
         dcc.Store(id="memory-years"),
         dcc.Store(id="memory-predicted-rasters"),
+        # Kept in the session so running calibrations survive a reload
+        dcc.Store(id="memory-calibration-job", storage_type="session"),
     ]
 )
 
@@ -2077,8 +2116,10 @@ def update_year_range(start_year, years):
     Input({"type": "memory-raster", "field": dash.MATCH}, "data"),
     State("memory-years", "data"),
 )
-def update_graphs(arr, years):
-    arr = np.array(arr)
+def update_graphs(handle, years):
+    if handle is None:
+        return dash.no_update
+    arr = store.get(handle)
     if arr.ndim == 2:
         return sl.make_simple_raster(arr)
     else:
@@ -2144,8 +2185,8 @@ def download_orig_raster(n_clicks, id_hash):
     State({"type": "memory-attrs", "field": dash.MATCH}, "data"),
     prevent_initial_call=True,
 )
-def download_current_raster(n_clicks, data, attrs):
-    data = np.array(data, dtype=rio.int32)
+def download_current_raster(n_clicks, handle, attrs):
+    data = np.asarray(store.get(handle), dtype=rio.int32)
     crs = CRS.from_string(attrs["crs"])
     transform = rio.Affine(*attrs["transform"])
     field = dash.callback_context.triggered_id["field"]
@@ -2215,7 +2256,7 @@ def update_arrays(uploaded, id_hash):
 
     out_dict = dict(crs=target_crs.to_string(), transform=list(reprojected_transform))
 
-    return reprojected.tolist(), out_dict, False, None
+    return store.put(reprojected, id_hash), out_dict, False, None
 
 
 # Restaurar arreglos
@@ -2236,10 +2277,10 @@ def restore_raster(n_clicks, id_hash):
     with open(PATH_CACHE / id_hash / "attributes.json", "r") as f:
         attrs = json.load(f)
 
-    return arr, attrs
+    return store.put(arr, id_hash), attrs
 
 
-def process_grids(grid_slope, grid_excluded, grid_roads):
+def process_grids(grid_slope, grid_excluded, grid_roads, path_cache):
     grid_slope = np.array(grid_slope, dtype=np.int32)
     grid_excluded = np.array(grid_excluded, dtype=np.int32)
     grid_roads = np.array(grid_roads, dtype=np.int32)
@@ -2248,7 +2289,7 @@ def process_grids(grid_slope, grid_excluded, grid_roads):
         grid_roads_i,
         grid_roads_j,
         grid_roads_dist,
-    ) = sp.derive_auxiliary_roads_numpy(grid_roads)
+    ) = sp.load_or_derive_auxiliary_roads(grid_roads, path_cache)
     return {
         "grid_slope": grid_slope,
         "grid_excluded": grid_excluded,
@@ -2268,6 +2309,69 @@ for field in sl.FIELDS:
     state_vals.append(state_2)
 
 
+def calibration_table(coefficients):
+    return dbc.Table(
+        [
+            html.Thead(html.Tr([html.Th("Coeficiente"), html.Th("Valor")])),
+            html.Tbody(
+                [
+                    html.Tr([html.Td(field.title()), html.Td(coefficients[field])])
+                    for field in sl.FIELDS
+                ]
+            ),
+        ],
+        bordered=True,
+    )
+
+
+def format_seconds(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours:d}:{minutes:02d}:{seconds:02d}"
+
+
+def calibration_progress(status):
+    """Returns the value and label of the progress bar and the progress
+    text of a calibration job status."""
+
+    if status is None:
+        return 0, "", ""
+
+    elapsed = status["elapsed"]
+    estimated = status["estimated"]
+
+    if status["status"] == "done":
+        return 100, "100%", f"Calibración terminada en {format_seconds(elapsed)}."
+    if status["status"] == "cancelled":
+        return 0, "", "Calibración cancelada."
+    if status["status"] == "failed":
+        return 0, "", f"La calibración falló: {status['error']}"
+    if status["status"] == "lost":
+        return 0, "", "La calibración se interrumpió, vuelva a ejecutarla."
+
+    text = [
+        f"Combinaciones: {status['combinations']} "
+        f"× {status['n_iters']} iteraciones de Monte Carlo",
+        f"Tiempo transcurrido: {format_seconds(elapsed)}",
+    ]
+
+    # SLEUTH does not report progress, so it is estimated from earlier
+    # calibrations of the city
+    if estimated is None:
+        text.append("Tiempo restante: sin estimación")
+        return 0, "", " · ".join(text)
+
+    fraction = min(elapsed / estimated, 0.99)
+    evaluated = int(fraction * status["combinations"])
+    remaining = max(estimated - elapsed, 0)
+    text[0] = (
+        f"Combinaciones evaluadas (estimado): {evaluated} de "
+        f"{status['combinations']} × {status['n_iters']} iteraciones de Monte Carlo"
+    )
+    text.append(f"Tiempo restante estimado: {format_seconds(remaining)}")
+    return round(fraction * 100), f"{fraction:.0%}", " · ".join(text)
+
+
 @callback(
     Output("div-calibration-results", "children"),
     Output("result-calibration-tabs", "active_tab"),
@@ -2287,9 +2391,23 @@ for field in sl.FIELDS:
     State("memory-years", "data"),
     State({"type": "val-calibration", "field": "start-year"}, "value"),
     State({"type": "val-calibration", "field": "stop-year"}, "value"),
+    State("global-store-hash", "data"),
+    background=True,
+    progress=[
+        Output("memory-calibration-job", "data"),
+        Output("progress-calibration", "value"),
+        Output("progress-calibration", "label"),
+        Output("div-calibration-progress", "children"),
+    ],
+    running=[
+        (Output("btn-calibrate", "disabled"), True, False),
+        (Output("btn-cancel-calibration", "disabled"), False, True),
+    ],
+    cancel=[Input("btn-cancel-calibration", "n_clicks")],
     prevent_initial_call=True,
 )
 def start_calibration(
+    set_progress,
     n_clicks,
     n_iters,
     n_refinement_iters,
@@ -2314,13 +2432,24 @@ def start_calibration(
     years,
     start_year,
     end_year,
+    id_hash,
 ):
     start_year = int(start_year)
     end_year = int(end_year)
+    path_cache = PATH_CACHE / str(id_hash)
+
+    # Runs in a process of the background callback manager, see app.py
+    job_id = sj.new_job_id()
+    set_progress((job_id, 0, "", "Preparando calibración ..."))
+
+    grid_slope, grid_roads, grid_excluded, grid_urban = [
+        store.get(handle)
+        for handle in (grid_slope, grid_roads, grid_excluded, grid_urban)
+    ]
 
     assert len(years) == len(grid_urban)
 
-    processed_grids = process_grids(grid_slope, grid_excluded, grid_roads)
+    processed_grids = process_grids(grid_slope, grid_excluded, grid_roads, path_cache)
 
     model = SLEUTH(
         n_iters=n_iters,
@@ -2350,25 +2479,79 @@ def start_calibration(
     wanted_years = np.array(wanted_years, dtype=np.int32)
     wanted_urban = np.array(wanted_urban, dtype=np.int32)
 
-    model.fit(wanted_urban, wanted_years, out_dir)
-
-    table = dbc.Table(
-        [
-            html.Thead(html.Tr([html.Th("Coeficiente"), html.Th("Valor")])),
-            html.Tbody(
-                [
-                    html.Tr([html.Td("Diffusion"), html.Td(model.coef_diffusion_)]),
-                    html.Tr([html.Td("Breed"), html.Td(model.coef_breed_)]),
-                    html.Tr([html.Td("Spread"), html.Td(model.coef_spread_)]),
-                    html.Tr([html.Td("Slope"), html.Td(model.coef_slope_)]),
-                    html.Tr([html.Td("Road"), html.Td(model.coef_road_)]),
-                ]
-            ),
-        ],
-        bordered=True,
+    status = sj.run_calibration(
+        model,
+        wanted_urban,
+        wanted_years,
+        out_dir,
+        path_cache,
+        job_id,
+        set_progress=lambda status: set_progress(
+            (job_id, *calibration_progress(status))
+        ),
     )
+    set_progress((job_id, *calibration_progress(status)))
+
+    if status["status"] != "done":
+        return dash.no_update, dash.no_update, dash.no_update
+
+    return calibration_table(status["coefficients"]), "tab-3", False
+
+
+# Recuperar calibración después de recargar la página
+@callback(
+    Output("div-calibration-results", "children", allow_duplicate=True),
+    Output("result-calibration-tabs", "active_tab", allow_duplicate=True),
+    Output("result-calibration-subtab", "disabled", allow_duplicate=True),
+    Output("progress-calibration", "value", allow_duplicate=True),
+    Output("progress-calibration", "label", allow_duplicate=True),
+    Output("div-calibration-progress", "children", allow_duplicate=True),
+    Output("btn-cancel-calibration", "disabled", allow_duplicate=True),
+    Output("interval-calibration", "disabled"),
+    Input("global-store-hash", "data"),
+    Input("interval-calibration", "n_intervals"),
+    State("memory-calibration-job", "data"),
+    prevent_initial_call="initial_duplicate",
+)
+def attach_calibration(id_hash, n_intervals, job_id):
+    if id_hash is None or job_id is None:
+        return (dash.no_update,) * 7 + (True,)
 
-    return table, "tab-3", False
+    status = sj.read_status(PATH_CACHE / str(id_hash), job_id)
+    if status is None:
+        # Job of another city
+        return (dash.no_update,) * 7 + (True,)
+
+    value, label, text = calibration_progress(status)
+    running = status["status"] == "running"
+
+    if status["status"] == "done":
+        results = (calibration_table(status["coefficients"]), "tab-3", False)
+    else:
+        results = (dash.no_update,) * 3
+
+    return (*results, value, label, text, not running, not running)
+
+
+@callback(
+    Output("div-calibration-progress", "children", allow_duplicate=True),
+    Input("btn-cancel-calibration", "n_clicks"),
+    State("memory-calibration-job", "data"),
+    State("global-store-hash", "data"),
+    prevent_initial_call=True,
+)
+def cancel_calibration(n_clicks, job_id, id_hash):
+    if job_id is None:
+        return dash.no_update
+
+    # Stops jobs attached after a reload, jobs started from this page
+    # are also stopped by the background callback manager, and records
+    # the final status of both
+    status = sj.cancel_job(PATH_CACHE / str(id_hash), job_id)
+    if status is None:
+        return dash.no_update
+
+    return "Calibración cancelada."
 
 
 # Actualizar resumen de parámetros
@@ -2405,10 +2588,14 @@ def update_ranges(c_min, c_max, c_num):
     Input({"type": "memory-raster", "field": dash.MATCH}, "data"),
     State("global-store-hash", "data"),
 )
-def update_custom_raster_results(current, id_hash):
+def update_custom_raster_results(handle, id_hash):
+    if handle is None:
+        return dash.no_update, dash.no_update
+
     id_hash = str(id_hash)
     triggered_field = dash.callback_context.triggered_id["field"]
-    original = np.load(PATH_CACHE / id_hash / f"{triggered_field}.npy")
+    original = np.load(PATH_CACHE / id_hash / f"{triggered_field}.npy", mmap_mode="r")
+    current = store.get(handle)
 
     return ("No", "No") if np.array_equal(current, original, equal_nan=True) else ("Sí", "Sí")
 
@@ -2466,75 +2653,52 @@ def update_prediction_param_display(value):
     return str(value)
 
 
-def run_single_prediction(
-    n_iters,
-    processed_grids,
-    grid_urban,
-    critical_slope,
-    random_state,
-    coef_diffusion,
-    coef_breed,
-    coef_spread,
-    coef_slope,
-    coef_road,
-    start_year,
-    num_years,
-    all_years,
-):
-    model = SLEUTH(
-        n_iters=n_iters,
-        grid_excluded=processed_grids["grid_excluded"],
-        grid_roads=processed_grids["grid_roads"],
-        grid_roads_dist=processed_grids["grid_roads_dist"],
-        grid_roads_i=processed_grids["grid_roads_i"],
-        grid_roads_j=processed_grids["grid_roads_j"],
-        grid_slope=processed_grids["grid_slope"],
-        crit_slope=critical_slope,
-        random_state=random_state,
-    )
-
-    model.coef_diffusion_ = coef_diffusion
-    model.coef_breed_ = coef_breed
-    model.coef_spread_ = coef_spread
-    model.coef_slope_ = coef_slope
-    model.coef_road_ = coef_road
-
-    sim_years = list(range(start_year + 1, start_year + num_years + 1))
-
-    start_idx = all_years.index(start_year)
-    seed_grid = np.array(grid_urban[start_idx], dtype=bool)
-
-    grid, _, _ = model.predict(seed_grid, num_years)
-
-    grid_plot = xr.DataArray(
-        data=grid * 100,
-        dims=["Año", "y", "x"],
-        coords={
-            "Año": sim_years,
-            "y": list(range(grid.shape[1])),
-            "x": list(range(grid.shape[2])),
-        },
-    )
+def prediction_tab(i, fig, download=True):
+    if download:
+        download_col = dbc.Col(
+            dbc.Button(
+                "Descargar rasters",
+                id={"type": "btn-download-predicted-rasters", "index": i},
+                className="my-2",
+            ),
+            width=4,
+            className="text-center",
+        )
+    else:
+        # Downloads are enabled once all scenarios are saved
+        download_col = dbc.Col(
+            html.P("Descarga disponible al terminar la predicción.", className="my-2"),
+            width=4,
+            className="text-center",
+        )
 
-    fig = px.imshow(
-        grid_plot,
-        animation_frame="Año",
-        labels=dict(color="Probabilidad de urbanización"),
-        zmin=0,
-        zmax=100,
-        aspect="equal",
+    return dbc.Tab(
+        dbc.Card(
+            dbc.CardBody(
+                dbc.Container(
+                    dbc.Row(
+                        [
+                            dbc.Col(
+                                dcc.Graph(
+                                    figure=fig,
+                                    responsive=True,
+                                    style={"height": "60vh"},
+                                ),
+                                width=8,
+                            ),
+                            download_col,
+                        ]
+                    )
+                )
+            )
+        ),
+        label=f"Escenario {i+1}",
     )
-    fig.update_xaxes(showticklabels=False, visible=False)
-    fig.update_yaxes(showticklabels=False, visible=False)
-
-    return grid, fig
 
 
 # Iniciar predicción
 @callback(
     Output("card-prediction-results", "children"),
-    Output("result-prediction-tabs", "active_tab"),
-    Output("result-prediction-subtab", "disabled"),
     Output("memory-predicted-rasters", "data"),
     Input("btn-predict", "n_clicks"),
     *[
@@ -2554,9 +2718,21 @@ def run_single_prediction(
     State({"type": "val-prediction", "field": "start-year"}, "value"),
     State("memory-years", "data"),
     State({"type": "val-prediction", "field": "num-years"}, "value"),
+    State("global-store-hash", "data"),
+    background=True,
+    # Scenario tabs are streamed as they finish, without downloads
+    progress=[Output("div-prediction-progress", "children")],
+    running=[
+        (Output("btn-predict", "disabled"), True, False),
+        (Output("div-prediction-progress", "style"), {}, {"display": "none"}),
+        (Output("card-prediction-results", "style"), {"display": "none"}, {}),
+        (Output("result-prediction-subtab", "disabled"), False, False),
+        (Output("result-prediction-tabs", "active_tab"), "tab-3", "tab-3"),
+    ],
     prevent_initial_call=True,
 )
 def start_prediction(
+    set_progress,
     n_clicks,
     coefs_diffusion,
     coefs_breed,
@@ -2573,70 +2749,53 @@ def start_prediction(
     start_year,
     all_years,
     num_years,
+    id_hash,
 ):
     all_years = [int(year) for year in all_years]
     start_year = int(start_year)
     num_years = int(num_years)
 
-    processed_grids = process_grids(grid_slope, grid_excluded, grid_roads)
-    grid_urban = np.array(grid_urban)
-
-    tabs = []
-    grids = []
-    for i, (diffusion, breed, spread, slope, road) in enumerate(
-        zip(coefs_diffusion, coefs_breed, coefs_spread, coefs_slope, coefs_road)
-    ):
-        grid, fig = run_single_prediction(
-            n_iters=n_iters,
-            processed_grids=processed_grids,
-            grid_urban=grid_urban,
-            critical_slope=critical_slope,
-            random_state=random_state,
-            coef_diffusion=diffusion,
-            coef_breed=breed,
-            coef_road=road,
-            coef_slope=slope,
-            coef_spread=spread,
-            start_year=start_year,
-            num_years=num_years,
-            all_years=all_years,
-        )
+    set_progress(html.Div("Ejecutando escenarios ..."))
 
-        tab = dbc.Tab(
-            dbc.Card(
-                dbc.CardBody(
-                    dbc.Container(
-                        dbc.Row(
-                            [
-                                dbc.Col(
-                                    dcc.Graph(
-                                        figure=fig,
-                                        responsive=True,
-                                        style={"height": "60vh"},
-                                    ),
-                                    width=8,
-                                ),
-                                dbc.Col(
-                                    dbc.Button(
-                                        "Descargar rasters",
-                                        id={
-                                            "type": "btn-download-predicted-rasters",
-                                            "index": i,
-                                        },
-                                        className="my-2",
-                                    ),
-                                    width=4,
-                                    className="text-center",
-                                ),
-                            ]
-                        )
-                    )
-                )
-            ),
-            label=f"Escenario {i+1}",
+    grid_slope, grid_roads, grid_excluded = [
+        store.get(handle) for handle in (grid_slope, grid_roads, grid_excluded)
+    ]
+    processed_grids = process_grids(
+        grid_slope, grid_excluded, grid_roads, PATH_CACHE / str(id_hash)
+    )
+    grid_urban = np.asarray(store.get(grid_urban))
+    seed_grid = np.array(grid_urban[all_years.index(start_year)], dtype=bool)
+
+    scenarios = [
+        dict(zip(sl.FIELDS, coefficients))
+        for coefficients in zip(
+            coefs_diffusion, coefs_breed, coefs_spread, coefs_slope, coefs_road
         )
-        tabs.append(tab)
-        grids.append(grid)
+    ]
+
+    # Predicted grids are kept in the city cache, the browser only gets
+    # the ID of the run
+    run_id = store.new_run_id()
+    sim_years = list(range(start_year + 1, start_year + num_years + 1))
+
+    figs = {}
+    urbanization = {}
+    finished = sj.run_scenarios(
+        processed_grids,
+        seed_grid,
+        scenarios,
+        num_years=num_years,
+        n_iters=n_iters,
+        crit_slope=critical_slope,
+        random_state=random_state,
+    )
+    for i, grid in finished:
+        store.put_scenario(id_hash, run_id, i, grid, sim_years)
+        figs[i] = sl.plot_sleuth_predictions(grid, start_year, num_years)
+        urbanization[i] = [band.sum() / band.size for band in grid]
+
+        streamed = [prediction_tab(j, figs[j], download=False) for j in sorted(figs)]
+        set_progress(dbc.Tabs(streamed, active_tab="tab-0"))
 
     x = all_years
     y = [grid.sum() / grid.size for grid in grid_urban]
@@ -2644,9 +2803,9 @@ def start_prediction(
 
     final_y = y[-1]
 
-    for i in range(len(grids)):
-        x_pred = list(range(start_year + 1, start_year + num_years + 1))
-        y_pred = [grid.sum() / grid.size for grid in grids[i]]
+    for i in range(len(scenarios)):
+        x_pred = list(sim_years)
+        y_pred = urbanization[i]
         z_pred = [f"Escenario {i + 1}"] * (len(x_pred) + 1)
 
         x_pred = [start_year] + x_pred
@@ -2664,13 +2823,12 @@ def start_prediction(
     fig.update_yaxes(tickformat=",.0%")
 
     plot_tab = dbc.Tab(dbc.Card(dbc.CardBody(dcc.Graph(figure=fig))), label="Resumen")
-    tabs = [plot_tab] + tabs
-
-    out = dbc.Tabs(tabs, active_tab="tab-0")
-
-    grids = np.stack(grids)
+    tabs = [prediction_tab(i, figs[i]) for i in sorted(figs)]
+    out = dbc.Tabs([plot_tab] + tabs, active_tab="tab-0")
 
-    return out, "tab-3", False, grids.tolist()
+    # Download buttons only exist in the final results, once every
+    # scenario is saved under run_id
+    return out, run_id
 
 
 @callback(
@@ -2680,24 +2838,42 @@ def start_prediction(
     State("global-store-hash", "data"),
     prevent_initial_call=True,
 )
-def download_predicted_rasters(n_clicks, data, id_hash):
+def download_predicted_rasters(n_clicks, run_id, id_hash):
     id_hash = str(id_hash)
-    triggered_field = dash.callback_context.triggered_id["field"]
     triggered_idx = dash.callback_context.triggered_id["index"]
 
-    with open(PATH_CACHE / id_hash / "attributes.json", "r") as f:
-        attrs = json.load(f)
-    
-    if n_clicks[triggered_idx] is None:
+    # Buttons are matched by their index, not their position in n_clicks
+    if dash.callback_context.triggered[0]["value"] is None or run_id is None:
         return dash.no_update
 
-    data = np.array(data, dtype=rio.float64)
-    data = data[triggered_idx]
+    with open(PATH_CACHE / id_hash / "attributes.json", "r") as f:
+        attrs = json.load(f)
 
     crs = CRS.from_string(attrs["crs"])
     transform = rio.Affine(*attrs["transform"])
-    bytes = raster_to_bytes(data, crs, transform, dtype=rio.float64)
-    return dcc.send_bytes(bytes, "predicted.tif")
+    years = store.scenario_years(id_hash, run_id, triggered_idx)
+
+    def write_scenario(buffer):
+        # Years are read and written one band at a time
+        bands = store.iter_scenario(id_hash, run_id, triggered_idx)
+        first = next(bands)
+        height, width = first[1].shape
+        with MemoryFile() as memfile:
+            with memfile.open(
+                driver="GTiff",
+                height=height,
+                width=width,
+                crs=crs,
+                transform=transform,
+                dtype=rio.float64,
+                count=len(years),
+            ) as dataset:
+                for i, (year, band) in enumerate(chain([first], bands), start=1):
+                    dataset.write(band.astype(rio.float64), i)
+                    dataset.set_band_description(i, str(year))
+            buffer.write(memfile.read())
+
+    return dcc.send_bytes(write_scenario, f"predicted_{triggered_idx + 1}.tif")
 
 
 @callback(
@@ -2737,7 +2913,7 @@ def add_parameter_row(n_clicks, children, orig_coefficients):
 )
 def delete_parameter_row(n_clicks, current_coefficients):
     triggered_idx = dash.callback_context.triggered_id["index"]
-    if n_clicks[triggered_idx] is None:
+    if dash.callback_context.triggered[0]["value"] is None:
         return dash.no_update
 
     children = []
@@ -2852,7 +3028,8 @@ def download_data(id_hash, bbox_latlon):
     urban_rasters = None
     for field in RASTER_FIELDS:
         raster = np.load(path_cache / f"{field}.npy")
-        out_rasters.append(raster)
+        # Only handles are sent to the browser
+        out_rasters.append(store.put(raster, id_hash))
         if field == "urban":
             urban_rasters = raster
 
@@ -6,6 +6,7 @@ import dash_bootstrap_components as dbc
 import pandas as pd
 import ursa.heat_islands as ht
 import ursa.plots.heat_islands as pht
+import ursa.utils.cache_manager as cm
 import ursa.utils.date as du
 import ursa.utils.geometry as ug
 import ursa.utils.raster as ru
@@ -1083,7 +1084,7 @@ def update_mitigation_kilometers(values, id_hash, bbox_latlon, uc_latlon):
     if id_hash is None:
         return [dash.no_update] * 5 + ["/", dash.no_update]
 
-    path_cache = Path(f"./data/cache/{id_hash}")
+    path_cache = cm.CACHE_DIR / str(id_hash)
 
     bbox_latlon = shape(bbox_latlon)
     uc_latlon = shape(uc_latlon)
@@ -1143,7 +1144,7 @@ def update_mitigation_kilometers(values, id_hash, bbox_latlon, uc_latlon):
     prevent_initial_call=True,
 )
 def download_file(n_clicks, id_hash):
-    path_cache = Path(f"./data/cache/{id_hash}")
+    path_cache = cm.CACHE_DIR / str(id_hash)
     csv_path = path_cache / "land_cover_by_temp.csv"
     if csv_path.exists():
         df = pd.read_csv(csv_path)
@@ -1165,7 +1166,7 @@ def start_download(n_clicks, id_hash, bbox_latlon, task_name):
     if n_clicks is None or n_clicks == 0:
         return dash.no_update, dash.no_update, dash.no_update
 
-    path_cache = Path(f"./data/cache/{id_hash}")
+    path_cache = cm.CACHE_DIR / str(id_hash)
 
     if task_name is None:
         start_date, end_date = du.date_format("Qall", 2022)
@@ -1232,7 +1233,7 @@ def generate_maps(id_hash, bbox_latlon, fua_latlon, uc_latlon):
     if id_hash is None:
         return [dash.no_update] * 5
 
-    path_cache = Path(f"./data/cache/{id_hash}")
+    path_cache = cm.CACHE_DIR / str(id_hash)
 
     bbox_latlon = shape(bbox_latlon)
     fua_latlon = shape(fua_latlon)
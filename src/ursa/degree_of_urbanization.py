@@ -1,9 +1,16 @@
+import os
+
 import numpy as np
 import pandas as pd
 import rioxarray as rxr
+import ursa.pipeline as pl
+import ursa.utils.cache_manager as cm
+import ursa.utils.process_pool as pp
+import ursa.utils.shared_arrays as sa
 import xarray as xr
 
-from scipy.ndimage import label, convolve, center_of_mass
+from concurrent.futures.process import BrokenProcessPool
+from scipy.ndimage import label, convolve, find_objects
 from ursa.ghsl import load_or_download
 
 
@@ -13,6 +20,114 @@ lvl_1_classes = {
     "Rural": 0,  # 1
 }
 
+# Maximum number of epochs processed concurrently by dou_for_ghs,
+# 1 processes them sequentially in the calling process. Each worker
+# holds a full resolution epoch, so the default is kept small.
+DOU_MAX_WORKERS = int(os.environ.get("URSA_DOU_MAX_WORKERS", 4))
+
+# Offsets of the 8 neighbors of a pixel
+NEIGHBOR_OFFSETS = [(i, j) for i in (-1, 0, 1) for j in (-1, 0, 1) if (i, j) != (0, 0)]
+
+
+def remove_small_clusters(array, clusters, nclusters, pop_array, min_pop):
+    """Removes clusters with a total population below min_pop.
+
+    Pixels are sorted by label once, so the population of each cluster
+    is the sum of a contiguous segment, and clusters are removed with a
+    lookup table indexed by label. Segments keep the row-major order of
+    the pixels and are summed in the dtype of pop_array, so totals are
+    bit-identical to pop_array[clusters == lbl].sum(). Both array and
+    clusters are modified in place.
+
+    Returns the labels of the remaining clusters.
+    """
+
+    flat = clusters.ravel()
+    order = np.argsort(flat, kind="stable")
+    sorted_pop = pop_array.ravel()[order]
+    bounds = np.searchsorted(flat[order], np.arange(nclusters + 2))
+
+    cluster_pop = np.zeros(nclusters + 1, dtype=sorted_pop.dtype)
+    for lbl in range(1, nclusters + 1):
+        cluster_pop[lbl] = sorted_pop[bounds[lbl] : bounds[lbl + 1]].sum()
+    # Written as a negation so clusters with nan population are kept
+    keep = ~(cluster_pop < min_pop)
+    keep[0] = False
+
+    removed = ~keep[clusters]
+    array[removed] = 0
+    clusters[removed] = 0
+
+    return np.flatnonzero(keep)
+
+
+def smooth_clusters(array, clusters, labels):
+    """Fills gaps and smooths borders of each cluster with the majority rule.
+
+    Non urban pixels with at least 5 of their 8 neighbors in the cluster
+    are added to it, iteratively until no more additions are performed.
+    Every addition increments array by one, so pixels added to more than
+    one cluster end up with counts > 1.
+
+    A pixel outside the bounding box of a cluster has at most 3
+    neighbors inside it, so the cluster never grows beyond its bounding
+    box and the rule is evaluated on that slice only, padded by one
+    pixel. After the first iteration, only the neighbors of the pixels
+    added in the previous iteration can reach the threshold, so only
+    those are re-evaluated.
+    """
+
+    kernel = np.array([[1, 1, 1], [1, 0, 1], [1, 1, 1]])
+    slices = find_objects(clusters)
+    nrows, ncols = clusters.shape
+
+    for lbl in labels:
+        rows, cols = slices[lbl - 1]
+        window = (
+            slice(max(rows.start - 1, 0), min(rows.stop + 1, nrows)),
+            slice(max(cols.start - 1, 0), min(cols.stop + 1, ncols)),
+        )
+
+        # An extra zero border keeps neighbor lookups inside the local
+        # arrays, pixels outside the raster count as non urban
+        current = np.pad(clusters[window] == lbl, 1)
+        added = np.zeros_like(current)
+
+        # Number of urban neighbors of each cell
+        n_nbrs = convolve(current.astype(int), kernel, mode="constant")
+        new = (n_nbrs >= 5) & ~current
+
+        while new.any():
+            current |= new
+            added |= new
+
+            # Update neighbor counts and find the cells next to
+            # the new ones
+            new_i, new_j = np.nonzero(new)
+            frontier = np.zeros_like(current)
+            for di, dj in NEIGHBOR_OFFSETS:
+                np.add.at(n_nbrs, (new_i + di, new_j + dj), 1)
+                frontier[new_i + di, new_j + dj] = True
+
+            new = frontier & (n_nbrs >= 5) & ~current
+
+        array[window] += added[1:-1, 1:-1]
+
+
+def fill_holes(array, min_hole_size):
+    """Fills holes of array with a size of at most min_hole_size pixels,
+    in place."""
+
+    # Invert image and find all holes
+    inverted = 1 - array
+    holes, nholes = label(inverted)
+
+    hole_sizes = np.bincount(holes.ravel(), minlength=nholes + 1)
+    fill = hole_sizes <= min_hole_size
+    fill[0] = False
+
+    array[fill[holes]] = 1
+
 
 def find_urban_centers(
     pop_array,
@@ -34,49 +149,20 @@ def find_urban_centers(
 
     # Find their total population and remove them from
     # urban center array if necessary
-    labels = []
-    for lbl in range(1, nclusters + 1):
-        mask = clusters == lbl
-        total_pop = pop_array[mask].sum()
-        if total_pop < u_center_pop:
-            u_center_array[mask] = 0
-            clusters[mask] = 0
-        else:
-            labels.append(lbl)
+    labels = remove_small_clusters(
+        u_center_array, clusters, nclusters, pop_array, u_center_pop
+    )
 
     # Fill gaps and smooth borders, majority rule
-    # Apply per urban center, find all candidates
-    # for allocation
-    kernel = np.array([[1, 1, 1], [1, -8, 1], [1, 1, 1]])
-    for lbl in labels:
-        # This needs to be done iteratively until no more additions are performed
-        current_center = (clusters == lbl).astype(int)
-        while True:
-            # Find number of neighbors of each cell
-            # Non urban pixels have neighbor values 0-8, while urban
-            # pixels have -8-0
-            n_nbrs = convolve(current_center, kernel, mode="constant", output=int)
-            # New cells are non urban pixels with >=5 neighbors
-            mask = n_nbrs >= 5
-            if mask.sum() == 0:
-                break
-            # Update both current center and urban_center_array
-            current_center[mask] = 1
-            u_center_array[mask] += 1
+    # Apply per urban center
+    smooth_clusters(u_center_array, clusters, labels)
     # Cells added to more than one urban center have counts > 1.
     # Remove them
     u_center_array[u_center_array > 1] = 0
 
     if fill:
         # Fill holes smaller than min hole size, defaults to 15km
-        # Invert image
-        inverted = 1 - u_center_array
-        # Find all holes smaller than min size
-        holes, nholes = label(inverted)
-        for h in range(1, nholes + 1):
-            mask = holes == h
-            if mask.sum() <= min_hole_size:
-                u_center_array[mask] = 1
+        fill_holes(u_center_array, min_hole_size)
 
     return u_center_array
 
@@ -100,56 +186,26 @@ def find_urban_clusters(
 
     # Find their total population and remove them from
     # if necessary
-    labels = []
-    for lbl in range(1, nclusters + 1):
-        mask = clusters == lbl
-        total_pop = pop_array[mask].sum()
-        if total_pop < u_cluster_pop:
-            u_cluster_array[mask] = 0
-            clusters[mask] = 0
-        else:
-            labels.append(lbl)
+    labels = remove_small_clusters(
+        u_cluster_array, clusters, nclusters, pop_array, u_cluster_pop
+    )
 
     if smooth:
         # Fill gaps and smooth borders, majority rule
-        # Apply per urban center, find all candidates
-        # for allocation
-        kernel = np.array([[1, 1, 1], [1, -8, 1], [1, 1, 1]])
-        for lbl in labels:
-            # This needs to be done iteratively until no more
-            # additions are performed
-            current_center = (clusters == lbl).astype(int)
-            while True:
-                # Find number of neighbors of each cell
-                # Non urban pixels have neighbor values 0-8, while urban
-                # pixels have -8-0
-                n_nbrs = convolve(current_center, kernel, mode="constant", output=int)
-                # New cells are non urban pixels with >=5 neighbors
-                mask = n_nbrs >= 5
-                if mask.sum() == 0:
-                    break
-                # Update both current center and urban_center_array
-                current_center[mask] = 1
-                u_cluster_array[mask] += 1
+        # Apply per urban cluster
+        smooth_clusters(u_cluster_array, clusters, labels)
         # Cells added to more than one urban center have counts > 1.
         # Remove them
         u_cluster_array[u_cluster_array > 1] = 0
 
     if fill:
         # Fill holes smaller min_hole_size, defaults to 1km
-        # Invert image
-        inverted = 1 - u_cluster_array
-        # Find all holes smaller than min size
-        holes, nholes = label(inverted)
-        for h in range(1, nholes + 1):
-            mask = holes == h
-            if mask.sum() <= min_hole_size:
-                u_cluster_array[mask] = 1
+        fill_holes(u_cluster_array, min_hole_size)
 
     return u_cluster_array
 
 
-def dou_lvl1(
+def dou_lvl1_array(
     density,
     builtup,
     u_center_density=1500,
@@ -158,25 +214,89 @@ def dou_lvl1(
     u_cluster_density=300,
     u_cluster_pop=5000,
 ):
-    u_cluster_array = find_urban_clusters(
-        density.values, u_cluster_density, u_cluster_pop
-    )
+    u_cluster_array = find_urban_clusters(density, u_cluster_density, u_cluster_pop)
 
     # u_center_array = find_urban_centers(
-    #     density.values,
-    #     builtup.values,
+    #     density,
+    #     builtup,
     #     u_center_density,
     #     u_center_pop,
     #     builtup_trshld)
 
-    dou_array = np.full_like(density.values, lvl_1_classes["Rural"], dtype="uint8")
+    dou_array = np.full_like(density, lvl_1_classes["Rural"], dtype="uint8")
     dou_array[u_cluster_array > 0] = lvl_1_classes["Urban Cluster"]
     # dou_array[u_center_array > 0] = lvl_1_classes['Urban Center']
+
+    return dou_array
+
+
+def dou_lvl1(
+    density,
+    builtup,
+    u_center_density=1500,
+    u_center_pop=50000,
+    builtup_trshld=0.5,
+    u_cluster_density=300,
+    u_cluster_pop=5000,
+):
+    dou_array = dou_lvl1_array(
+        density.values,
+        builtup.values,
+        u_center_density,
+        u_center_pop,
+        builtup_trshld,
+        u_cluster_density,
+        u_cluster_pop,
+    )
     dou_rxr = density.copy(data=dou_array)
 
     return dou_rxr
 
 
+def labeled_stats(label_array, pop_array, builtup_array, max_label):
+    """Reduces the pixels of every label in label_array in a single pass.
+
+    Parameters
+    ----------
+    label_array : np.ndarray
+        Array of non negative integer labels.
+    pop_array : np.ndarray
+        Population array with the same shape as label_array.
+    builtup_array : np.ndarray
+        Built-up array with the same shape as label_array.
+    max_label : int
+        Largest label of interest, all returned arrays have at least
+        max_label + 1 entries.
+
+    Returns
+    -------
+    stats : dict
+        Arrays indexed by label with the pixel count ("count"), total
+        population ("pop") and built-up ("builtup"), and the row and
+        column of the centroid ("row", "col"), nan for empty labels.
+
+    """
+
+    labels = label_array.ravel()
+    minlength = max_label + 1
+
+    count = np.bincount(labels, minlength=minlength)
+    rows, cols = np.indices(label_array.shape)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        row = np.bincount(labels, weights=rows.ravel(), minlength=minlength) / count
+        col = np.bincount(labels, weights=cols.ravel(), minlength=minlength) / count
+
+    return {
+        "count": count,
+        "pop": np.bincount(labels, weights=pop_array.ravel(), minlength=minlength),
+        "builtup": np.bincount(
+            labels, weights=builtup_array.ravel(), minlength=minlength
+        ),
+        "row": row,
+        "col": col,
+    }
+
+
 def get_stats_dict(
     class_array, pop_array, builtup_array, classes, year, cell_area=0.01, connectivity=4
 ):
@@ -188,20 +308,23 @@ def get_stats_dict(
             class_array, ncenters = label(class_array)
         classes = {f"{classes} {lbl}": lbl for lbl in range(1, ncenters + 1)}
 
+    stats = labeled_stats(
+        class_array, pop_array, builtup_array, max(classes.values(), default=0)
+    )
+    total_pop = pop_array.sum()
+    total_builtup = builtup_array.sum() * cell_area
+
     for c, l in classes.items():
-        mask = class_array == l
         stat_dict = {"Grupo": c}
         stat_dict["year"] = year
-        stat_dict["Area"] = mask.sum() * cell_area
+        stat_dict["Area"] = stats["count"][l] * cell_area
         stat_dict["Area_fraction"] = stat_dict["Area"] / (class_array.size * cell_area)
-        stat_dict["Pob"] = pop_array[mask].sum() * cell_area
+        stat_dict["Pob"] = stats["pop"][l] * cell_area
         stat_dict["Pop_density"] = stat_dict["Pob"] / stat_dict["Area"]
-        stat_dict["Pop_fraction"] = stat_dict["Pob"] / pop_array.sum()
-        stat_dict["Builtup_area"] = builtup_array[mask].sum() * cell_area
-        stat_dict["Builtup_fraction"] = stat_dict["Builtup_area"] / (
-            builtup_array.sum() * cell_area
-        )
-        stat_dict["centroid"] = center_of_mass(mask)
+        stat_dict["Pop_fraction"] = stat_dict["Pob"] / total_pop
+        stat_dict["Builtup_area"] = stats["builtup"][l] * cell_area
+        stat_dict["Builtup_fraction"] = stat_dict["Builtup_area"] / total_builtup
+        stat_dict["centroid"] = (stats["row"][l], stats["col"][l])
         stat_list.append(stat_dict)
     return stat_list
 
@@ -287,7 +410,88 @@ def load_input_data_ghs(bbox_mollweide, path_cache, resolution=100):
     return pop_density, built_fraction, land_fraction
 
 
-def dou_for_ghs(bbox_mollweide, path_cache, resolution=100):
+def dou_year(density, builtup, year, thresholds):
+    """Computes the level 1 classification and its stats for a single
+    year, before harmonization with the previous years."""
+
+    print(f"Calculating DoU for year {year}...")
+    dou_array = dou_lvl1_array(density, builtup, **thresholds)
+    df_stats = get_stats_df(dou_array, density, builtup, year)
+    print(f"Done with year {year}.")
+
+    return dou_array, df_stats
+
+
+def _dou_year_shared(density_spec, builtup_spec, idx, year, thresholds):
+    """Worker for dou_for_ghs, runs dou_year on band idx of the shared
+    memory arrays described by density_spec and builtup_spec."""
+
+    density_shm, density = sa.from_shared(density_spec)
+    builtup_shm, builtup = sa.from_shared(builtup_spec)
+    try:
+        result = dou_year(density[idx], builtup[idx], year, thresholds)
+        # Views must be released before closing the blocks
+        del density, builtup
+    finally:
+        density_shm.close()
+        builtup_shm.close()
+
+    return result
+
+
+def dou_years_parallel(density, builtup, year_list, thresholds, max_workers):
+    """Runs dou_year for every year in a long-lived process pool, see
+    ursa.utils.process_pool.
+
+    Input arrays are placed once in shared memory, so workers read their
+    band without pickling the full stacks.
+    """
+
+    density_shm, density_spec = sa.to_shared(density)
+    builtup_shm, builtup_spec = sa.to_shared(builtup)
+    try:
+        executor = pp.get_executor("dou", max_workers)
+        futures = [
+            executor.submit(
+                _dou_year_shared, density_spec, builtup_spec, i, year, thresholds
+            )
+            for i, year in enumerate(year_list)
+        ]
+        try:
+            results = [future.result() for future in futures]
+        except BrokenProcessPool:
+            pp.reset_executor("dou", executor)
+            raise
+    finally:
+        for shm in (density_shm, builtup_shm):
+            shm.close()
+            shm.unlink()
+
+    return results
+
+
+def dou_for_ghs(bbox_mollweide, path_cache, resolution=100, max_workers=None):
+    """Computes the level 1 Degree of Urbanization for all GHS epochs.
+
+    Epochs are classified independently, in a process pool if max_workers
+    is larger than 1, and then harmonized so that urban pixels in a year
+    remain urban in all the following years. The results are saved to
+    path_cache as dou.tif and dou_stats.csv.
+
+    Parameters
+    ----------
+    bbox_mollweide : Polygon
+        Bounding box in Mollweide projection.
+    path_cache : Path
+        Path to the city cache.
+    resolution : int
+        Resolution of the GHS datasets in meters.
+    max_workers : int
+        Maximum number of epochs processed concurrently.
+        Defaults to DOU_MAX_WORKERS.
+
+    """
+
     (pop_density, built_fraction, land_fraction) = load_input_data_ghs(
         bbox_mollweide, path_cache, resolution
     )
@@ -310,36 +514,44 @@ def dou_for_ghs(bbox_mollweide, path_cache, resolution=100):
     builtup_trshld = 0.5
     u_cluster_density = 300
     u_cluster_pop = 5000
+    thresholds = dict(
+        u_center_density=u_center_density,
+        u_center_pop=u_center_pop,
+        builtup_trshld=builtup_trshld,
+        u_cluster_density=u_cluster_density,
+        u_cluster_pop=u_cluster_pop,
+    )
 
-    df_list = []
-    xr_list = []
-    for year in year_list:
-        print(f"Calculating DoU for year {year}...")
-        density = pop_density.sel(band=year)
-        builtup = built_fraction.sel(band=year)
-
-        print("    Building array...")
-        dou_xr = dou_lvl1(
-            density,
-            builtup,
-            u_center_density,
-            u_center_pop,
-            builtup_trshld,
-            u_cluster_density,
-            u_cluster_pop,
+    if max_workers is None:
+        max_workers = DOU_MAX_WORKERS
+    max_workers = max(1, min(max_workers, len(year_list)))
+
+    if max_workers > 1:
+        results = dou_years_parallel(
+            pop_density.values,
+            built_fraction.values,
+            year_list,
+            thresholds,
+            max_workers,
         )
-
-        print("    Getting stats...")
-        df_stats = get_stats_df(dou_xr.values, density.values, builtup.values, year)
-
-        # dou_xr.rio.to_raster(path_cache / f'dou_{year}.tif')
-        # harmonize from previous year
-        if year > year_list[0]:
-            prev = xr_list[-1].values
-            dou_xr.values = np.logical_or(prev, dou_xr.values).astype("uint8")
-        xr_list.append(dou_xr)
-        df_list.append(df_stats)
-        print("Done.")
+    else:
+        results = [
+            dou_year(
+                pop_density.sel(band=year).values,
+                built_fraction.sel(band=year).values,
+                year,
+                thresholds,
+            )
+            for year in year_list
+        ]
+    dou_arrays, df_list = zip(*results)
+
+    # Harmonize from previous years, urban pixels remain urban
+    dou_arrays = np.logical_or.accumulate(np.stack(dou_arrays), axis=0)
+    xr_list = [
+        pop_density.sel(band=year).copy(data=dou_array.astype("uint8"))
+        for year, dou_array in zip(year_list, dou_arrays)
+    ]
     dou_full = xr.concat(xr_list, pd.Index(year_list, name="year"))
     dou_full.rio.to_raster(path_cache / "dou.tif")
     df_stats = pd.concat(df_list)
@@ -350,13 +562,27 @@ def dou_for_ghs(bbox_mollweide, path_cache, resolution=100):
     # df_largest.to_csv(path_cache / 'dou_largest.csv')
 
 
-def load_or_process_dou(bbox_mollweide, path_cache, force=False):
+def load_or_process_dou(bbox_mollweide, path_cache, force=False, max_workers=None):
     fpath = path_cache / "dou.tif"
-    if fpath.exists() and not force:
-        pass
-    else:
-        dou_for_ghs(bbox_mollweide, path_cache)
+    if force or not cm.lookup(fpath):
+        dou_for_ghs(bbox_mollweide, path_cache, max_workers=max_workers)
+        cm.register(fpath, path_cache / "dou_stats.csv", producer=dou_for_ghs)
     raster = rxr.open_rasterio(fpath, cache=False)
     raster.coords["band"] = list(range(1975, 2021, 5))
 
     return raster
+
+
+# DoU raster and stats as a pipeline artifact, see ursa.pipeline.
+# The context may set dou_max_workers, see dou_for_ghs.
+ARTIFACTS = {
+    "dou": pl.artifact(
+        ["dou.tif", "dou_stats.csv"],
+        lambda context: load_or_process_dou(
+            context["bbox_mollweide"],
+            context["path_cache"],
+            max_workers=context.get("dou_max_workers"),
+        ),
+        inputs=["ghs_built", "ghs_pop", "ghs_land"],
+    ),
+}
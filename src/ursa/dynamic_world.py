@@ -4,6 +4,7 @@ import geemap.plotlymap as geemap
 import geopandas as gpd
 import pandas as pd
 import plotly.express as px
+import ursa.utils.cache_manager as cm
 import ursa.utils.date as du
 import ursa.utils.raster as ru
 
@@ -271,10 +272,11 @@ def get_cover_df(bbox_latlon, path_cache):
 
 def load_or_get_lc_df(bbox_latlon, path_cache, force=False):
     fpath = path_cache / "land_cover.csv"
-    if fpath.exists() and not force:
+    if not force and cm.lookup(fpath):
         df = pd.read_csv(fpath, index_col="year")
     else:
         df = get_cover_df(bbox_latlon, path_cache)
+        cm.register(fpath, producer=get_cover_df)
     return df
 
 
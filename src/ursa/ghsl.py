@@ -1,4 +1,6 @@
-import os
+import hashlib
+import json
+import threading
 
 import geemap.plotlymap as geemap
 import geopandas as gpd
@@ -9,20 +11,45 @@ import pandas as pd
 import plotly.express as px
 import rasterio as rio
 import rioxarray as rxr
-import tempfile
+import shapely
+import ursa.pipeline as pl
+import ursa.utils.cache_manager as cm
+import ursa.utils.figure_cache as fc
+import ursa.utils.geometry as ug
+import ursa.utils.image as ui
 import ursa.utils.raster as ru
 
+from functools import cache
 from PIL import Image, ImageOps
 from shapely.geometry import shape
 
 HEIGHT = 600
+# Upscale map overlays up to 10x, within the pixel budget
+# of ursa.utils.image.OVERLAY_MAX_PIXELS
 HIGH_RES = True
 
+# All GHS datasets are distributed in Mollweide
+GHS_CRS = "ESRI:54009"
+
+# In process memo of smod_polygons results, keyed by smod_polygons_key,
+# holding at most SMOD_MEMO_SIZE entries. Dash callbacks run in threads,
+# so the memo is only accessed while holding its lock.
+SMOD_MEMO_SIZE = 32
+_smod_polygons_memo = {}
+_smod_polygons_lock = threading.Lock()
+
 url_pop = "https://doi.org/10.2905/D6D86A90-4351-4508-99C1-CB074B022C4A"
 url_built = "https://doi.org/10.2905/D07D81B4-7680-4D28-B896-583745C27085"
 url_smod = "https://doi.org/10.2905/4606D58A-DC08-463C-86A9-D49EF461C47F"
 
 
+def ghs_years(ds):
+    """Returns the list of years available for GHS dataset ds."""
+    if ds == "LAND":
+        return [2018]
+    return list(range(1975, 2021, 5))
+
+
 def download_s3(
     bbox,
     ds,
@@ -30,12 +57,13 @@ def download_s3(
     resolution=1000,
     s3_path="GHSL/",
     bucket="tec-expansion-urbana-p",
+    max_workers=None,
 ):
     """Downloads a GHSL windowed rasters for each available year.
 
     Takes a bounding box (bbox) and downloads the corresponding rasters from a
     the global COG stored on Amazon S3. Returns a single multiband raster,
-    a band per year.
+    a band per year. Yearly rasters are downloaded concurrently.
 
     Parameters
     ----------
@@ -51,6 +79,9 @@ def download_s3(
     s3_dir : str
         Relative path to COGs on S3.
     bucket : str
+    max_workers : int
+        Maximum number of concurrent downloads.
+        If none, use ursa.utils.raster.S3_MAX_WORKERS.
 
     Returns
     -------
@@ -65,30 +96,25 @@ def download_s3(
 
     s3_path = f"{s3_path}/GHS_{ds}/"
 
+    year_list = ghs_years(ds)
     if ds == "LAND":
-        year_list = [2018]
         fname = f"GHS_{ds}_E{{}}_GLOBE_R2022A_54009_{resolution}_V1_0.tif"
     else:
         fname = f"GHS_{ds}_E{{}}_GLOBE_R2023A_54009_{resolution}_V1_0.tif"
-        year_list = list(range(1975, 2021, 5))
 
-    array_list = []
-    for year in year_list:
-        subset, profile = ru.np_from_bbox_s3(
-            s3_path + fname.format(year), bbox, bucket, nodata_to_zero=True
-        )
-        array_list.append(subset)
+    results = ru.np_list_from_bbox_s3(
+        [s3_path + fname.format(year) for year in year_list],
+        bbox,
+        bucket,
+        nodata_to_zero=True,
+        max_workers=max_workers,
+    )
+    array_list = [subset for subset, _ in results]
+    profile = results[0][1]
     ghs_full = np.concatenate(array_list)
 
-    # Create rioxarray
-    profile["count"] = ghs_full.shape[0]
-    tmp_name = os.path.join(tempfile.gettempdir(), os.urandom(24).hex())
-    with rio.open(tmp_name, "w", **profile) as dst:
-        dst.write(ghs_full)
-    raster = rxr.open_rasterio(tmp_name)
-
-    # Rename band dimension to reflect years
-    raster.coords["band"] = year_list
+    # Create rioxarray, with the band dimension reflecting years
+    raster = ru.xr_from_np(ghs_full, profile, bands=year_list)
 
     if data_path is not None:
         raster.rio.to_raster(data_path / f"GHS_{ds}_{resolution}.tif")
@@ -131,18 +157,88 @@ def load_or_download(
 
     """
     fpath = data_path / f"GHS_{ds}_{resolution}.tif"
-    if fpath.exists():
+    if cm.lookup(fpath):
         raster = rxr.open_rasterio(fpath)
-        if ds != "LAND":
-            raster.coords["band"] = list(range(1975, 2021, 5))
-        else:
-            raster.coords["band"] = [2018]
+        raster.coords["band"] = ghs_years(ds)
+        return raster
+
+    raster = slice_from_cache(bbox, ds, resolution)
+    if raster is not None:
+        producer = slice_from_cache
+        raster.rio.to_raster(fpath)
     else:
+        producer = download_s3
         raster = download_s3(bbox, ds, data_path, resolution, s3_path, bucket)
 
+    cm.register(
+        fpath,
+        producer=producer,
+        ds=ds,
+        resolution=resolution,
+        crs=GHS_CRS,
+        bounds=list(raster.rio.bounds()),
+    )
+
     return raster
 
 
+def slice_from_cache(bbox, ds, resolution=1000):
+    """Builds a GHS raster for bbox from a cached raster that contains it.
+
+    Custom regions are drawn inside the bounding box of a city, so the
+    city's cached GHS rasters usually hold a superset of the required
+    window. Slicing them locally avoids downloading the data again.
+
+    Parameters
+    ----------
+    bbox : Polygon
+        Shapely Polygon defining the bounding box, in Mollweide.
+    ds : str
+        Data set, can be one of SMOD, BUILT_S, POP, or LAND.
+    resolution : int
+        Resolution of the dataset, either 100 or 1000.
+
+    Returns
+    -------
+    raster : rioxarray.DataArray
+        In memory raster, or None if no cached raster contains bbox.
+
+    """
+
+    candidates = cm.find_containing(
+        bbox.bounds, ds=ds, resolution=resolution, crs=GHS_CRS
+    )
+    for fpath in candidates:
+        with rio.open(fpath) as src:
+            # Same window rounding as ru.np_from_bbox_url, the cached raster
+            # is aligned with the global grid so the result is the same
+            window = rio.windows.from_bounds(*bbox.bounds, src.transform)
+            window = window.round_lengths().round_offsets()
+            if (
+                window.col_off < 0
+                or window.row_off < 0
+                or window.col_off + window.width > src.width
+                or window.row_off + window.height > src.height
+            ):
+                continue
+            profile = src.profile.copy()
+            profile.update(
+                {
+                    "height": window.height,
+                    "width": window.width,
+                    "transform": src.window_transform(window),
+                }
+            )
+            subset = src.read(window=window)
+
+        print(f"Using cached {ds} raster from {fpath.parent.name}.")
+        cm.lookup(fpath)
+
+        return ru.xr_from_np(subset, profile, bands=ghs_years(ds))
+
+    return None
+
+
 def clip_dataset(ds, polygons):
     ds = ds.rio.set_nodata(0)
     ds = ds.rio.clip(polygons)
@@ -177,9 +273,37 @@ def load_plot_datasets(bbox_mollweide, path_cache, clip=False):
     return smod, built, pop
 
 
-def smod_polygons(smod, centroid):
+def smod_polygons_key(smod, centroid):
+    """Returns a digest identifying the SMOD raster and centroid used to
+    compute smod polygons."""
+
+    h = hashlib.sha256()
+    h.update(np.ascontiguousarray(smod.values).tobytes())
+    h.update(str(smod.values.shape).encode())
+    h.update(str(tuple(smod.rio.transform())).encode())
+    h.update(str(list(smod["band"].values)).encode())
+    h.update(centroid.wkb)
+    return h.hexdigest()
+
+
+def remember_smod_polygons(key, smod_p):
+    """Adds smod_p to the in process memo, dropping the oldest entry if
+    it is full."""
+
+    with _smod_polygons_lock:
+        _smod_polygons_memo.pop(key, None)
+        while len(_smod_polygons_memo) >= SMOD_MEMO_SIZE:
+            _smod_polygons_memo.pop(next(iter(_smod_polygons_memo)))
+        _smod_polygons_memo[key] = smod_p
+
+
+def smod_polygons(smod, centroid, path_cache=None):
     """Find SMOD polygons for urban centers and urban clusters.
 
+    Results are memoized in memory and, if path_cache is given, saved as
+    a GeoParquet file in the city cache, both keyed by the SMOD values,
+    transform and centroid.
+
     Parameters
     ----------
     smod : xarray.DataArray
@@ -188,6 +312,8 @@ def smod_polygons(smod, centroid):
         Polygons containing centroid will be identified as
         the principal urban center and cluster.
         Must be in Mollweide proyection.
+    path_cache : Path
+        Path to the city cache. If None, results are only kept in memory.
 
     Returns
     -------
@@ -195,6 +321,33 @@ def smod_polygons(smod, centroid):
         GeoDataFrame with polygons for urban clusters and centers.
     """
 
+    key = smod_polygons_key(smod, centroid)
+    with _smod_polygons_lock:
+        smod_p = _smod_polygons_memo.get(key)
+    if smod_p is not None:
+        return smod_p.copy()
+
+    if path_cache is not None:
+        fpath = path_cache / f"smod_polygons_{key[:16]}.parquet"
+        if cm.lookup(fpath):
+            smod_p = gpd.read_parquet(fpath)
+            remember_smod_polygons(key, smod_p)
+            return smod_p.copy()
+
+    smod_p = polygonize_smod(smod, centroid)
+
+    if path_cache is not None:
+        smod_p.to_parquet(fpath)
+        cm.register(fpath, producer=polygonize_smod)
+    remember_smod_polygons(key, smod_p)
+
+    return smod_p.copy()
+
+
+def polygonize_smod(smod, centroid):
+    """Polygonizes urban centers and clusters of every year of smod.
+    See smod_polygons."""
+
     # Get DoU lvl 1 representation (1: rural, 2: cluster, 3: center)
     smod_lvl_1 = smod // 10
 
@@ -203,40 +356,29 @@ def smod_polygons(smod, centroid):
 
     transform = smod.rio.transform()
 
-    dict_list = []
+    classes = []
+    years = []
+    geometries = []
     for year in smod["band"].values:
-        centers = rio.features.shapes(
-            smod_centers.sel(band=year).values, connectivity=8, transform=transform
-        )
-        clusters = rio.features.shapes(
-            smod_clusters.sel(band=year).values, connectivity=8, transform=transform
-        )
-
-        center_list = [shape(f[0]) for f in centers if f[1] > 0]
-        cluster_list = [shape(f[0]) for f in clusters if f[1] > 0]
-
-        center_dicts = [
-            {
-                "class": 3,
-                "year": year,
-                "is_main": centroid.within(center),
-                "geometry": center,
-            }
-            for center in center_list
-        ]
-        cluster_dicts = [
-            {
-                "class": 2,
-                "year": year,
-                "is_main": centroid.within(cluster),
-                "geometry": cluster,
-            }
-            for cluster in cluster_list
-        ]
-        dict_list += center_dicts
-        dict_list += cluster_dicts
+        for c, array in ((3, smod_centers), (2, smod_clusters)):
+            features = rio.features.shapes(
+                array.sel(band=year).values, connectivity=8, transform=transform
+            )
+            polygons = [shape(f[0]) for f in features if f[1] > 0]
+            classes += [c] * len(polygons)
+            years += [year] * len(polygons)
+            geometries += polygons
 
-    smod_polygons = gpd.GeoDataFrame(dict_list, crs=smod.rio.crs)
+    geometries = np.array(geometries, dtype=object)
+    smod_polygons = gpd.GeoDataFrame(
+        {
+            "class": classes,
+            "year": years,
+            "is_main": shapely.contains(geometries, centroid),
+            "geometry": geometries,
+        },
+        crs=smod.rio.crs,
+    )
 
     return smod_polygons
 
@@ -254,7 +396,9 @@ def built_s_polygons(built):
     built_df = built_df[built_df.b_area > 0].reset_index(drop=True)
 
     built_df["fraction"] = built_df.b_area / pixel_area
-    built_df["geometry"] = built_df.apply(ru.row2cell, res_xy=resolution, axis=1)
+    built_df["geometry"] = ru.cells_from_xy(
+        built_df.x, built_df.y, resolution, index=built_df.index
+    )
 
     built_gdf = gpd.GeoDataFrame(built_df, crs=built.rio.crs).drop(columns=["x", "y"])
 
@@ -291,7 +435,9 @@ def plot_built_poly(built_gdf, bbox_latlon, year=2020):
     return Map
 
 
-def plot_built_agg_img(smod, built, bbox_mollweide, centroid_mollweide, thresh=0.2):
+def plot_built_agg_img(
+    smod, built, bbox_mollweide, centroid_mollweide, thresh=0.2, path_cache=None
+):
     """Plots historic built using an image overlay."""
 
     years = [
@@ -354,14 +500,11 @@ def plot_built_agg_img(smod, built, bbox_mollweide, centroid_mollweide, thresh=0
         [lonmin, latmax],
     ]
 
-    # Create Image object (memory haevy)
+    # Create Image object
     img = ImageOps.flip(Image.fromarray(built_img))
 
-    # High res image
-    if HIGH_RES:
-        img = img.resize(
-            [hw * 10 for hw in img.size], resample=Image.Resampling.NEAREST
-        )
+    # Encode as PNG, upscaled within the pixel budget
+    img = ui.encode_overlay(img, max_upscale=10 if HIGH_RES else 1)
 
     dummy_df = pd.DataFrame({"lat": [0] * 10, "lon": [0] * 10, "Año": years})
     fig = px.scatter_mapbox(
@@ -380,7 +523,7 @@ def plot_built_agg_img(smod, built, bbox_mollweide, centroid_mollweide, thresh=0
     )
 
     # Create polygons of urban clusters and centers
-    smod_p = smod_polygons(smod, centroid_mollweide)
+    smod_p = smod_polygons(smod, centroid_mollweide, path_cache)
     clusters_2020 = smod_p[(smod_p.year == 2020) & (smod_p["class"] == 2)]
     clusters_2020 = clusters_2020.to_crs(4326)
 
@@ -459,11 +602,55 @@ def plot_built_agg_img(smod, built, bbox_mollweide, centroid_mollweide, thresh=0
     return fig
 
 
+def cluster_labels(clusters_gdf, years, raster):
+    """Burns urban cluster polygons into label grids aligned with raster.
+
+    Pixels whose center falls in the main cluster of a year are labeled
+    2, pixels in any other cluster 1 and the remaining ones 0, the same
+    pixel selection made by rio.clip. Years without a main cluster are
+    left as zeros.
+
+    Parameters
+    ----------
+    clusters_gdf : GeoDataFrame
+        Urban cluster polygons with year and is_main columns, as
+        returned by smod_polygons.
+    years : list
+        Years of the output grids.
+    raster : xarray.DataArray
+        Raster with the target grid, e.g. BUILT_S or POP.
+
+    Returns
+    -------
+    labels : np.ndarray
+        Array of shape (len(years), height, width) with cluster labels.
+    """
+
+    out_shape = raster.shape[-2:]
+    transform = raster.rio.transform()
+
+    labels = np.zeros((len(years), *out_shape), dtype="uint8")
+    for i, year in enumerate(years):
+        clusters_year = clusters_gdf[clusters_gdf.year == year]
+        if not clusters_year.is_main.any():
+            continue
+        # Main cluster goes last so it is burned on top
+        clusters_year = clusters_year.sort_values("is_main", kind="stable")
+        rio.features.rasterize(
+            zip(clusters_year.geometry, clusters_year.is_main.astype(int) + 1),
+            out=labels[i],
+            transform=transform,
+            all_touched=False,
+        )
+
+    return labels
+
+
 def get_urb_growth_df(smod, built, pop, centroid_mollweide, path_cache):
     built.rio.set_nodata(0)
     pop.rio.set_nodata(0)
 
-    smod_gdf = smod_polygons(smod, centroid_mollweide)
+    smod_gdf = smod_polygons(smod, centroid_mollweide, path_cache)
     smod_gdf["Area"] = smod_gdf.area
 
     clusters_gdf = smod_gdf[smod_gdf["class"] == 2]
@@ -477,67 +664,28 @@ def get_urb_growth_df(smod, built, pop, centroid_mollweide, path_cache):
 
     # Built and pop within center and cluster
     years = smod.coords["band"].values
-    cluster_built = []
-    cluster_pop = []
-    cluster_built_all = []
-    cluster_pop_all = []
-
-    for year in years:
-        # Check if main cluster is empty
-        if main_cluster[main_cluster.year == year].empty:
-            cluster_built.append(0)
-            cluster_pop.append(0)
-            cluster_built_all.append(0)
-            cluster_pop_all.append(0)
-        else:
-            # Main cluster and center
-            cluster = main_cluster[main_cluster.year == year].geometry.iloc[0]
-
-            # All clusters and centers
-            cluster_all = clusters_gdf[clusters_gdf.year == year].geometry
-
-            # Series for main cluster and center
-            cluster_built.append(
-                np.nansum(
-                    built.sel(band=year)
-                    .rio.set_nodata(0)
-                    .rio.clip([cluster], crs=built.rio.crs)
-                    .values
-                )
-            )
-
-            cluster_pop.append(
-                np.nansum(
-                    pop.sel(band=year)
-                    .rio.set_nodata(0)
-                    .rio.clip([cluster], crs=pop.rio.crs)
-                    .values
-                )
-            )
-
-            # Series for ALL clusters and centers
-            cluster_built_all.append(
-                np.nansum(
-                    built.sel(band=year)
-                    .rio.set_nodata(0)
-                    .rio.clip(cluster_all, crs=built.rio.crs)
-                    .values
-                )
-            )
-
-            cluster_pop_all.append(
-                np.nansum(
-                    pop.sel(band=year)
-                    .rio.set_nodata(0)
-                    .rio.clip(cluster_all, crs=pop.rio.crs)
-                    .values
-                )
-            )
-
-    cluster_built = np.array(cluster_built)
-    cluster_pop = np.array(cluster_pop)
-    cluster_built_all = np.array(cluster_built_all)
-    cluster_pop_all = np.array(cluster_pop_all)
+    labels = cluster_labels(clusters_gdf, years, built)
+
+    # Sum built and pop per (year, label) pair in a single pass,
+    # nodata is 0 and nan pixels are ignored as in np.nansum
+    idx = (np.arange(len(years))[:, None, None] * 3 + labels).ravel()
+    minlength = 3 * len(years)
+    built_sums = np.bincount(
+        idx,
+        weights=np.nan_to_num(built.sel(band=years).values.ravel()),
+        minlength=minlength,
+    ).reshape(len(years), 3)
+    pop_sums = np.bincount(
+        idx,
+        weights=np.nan_to_num(pop.sel(band=years).values.ravel()),
+        minlength=minlength,
+    ).reshape(len(years), 3)
+
+    # Series for main cluster and for ALL clusters
+    cluster_built = built_sums[:, 2]
+    cluster_pop = pop_sums[:, 2]
+    cluster_built_all = built_sums[:, 1] + built_sums[:, 2]
+    cluster_pop_all = pop_sums[:, 1] + pop_sums[:, 2]
 
     # Identify year that are not in main, i.e. years without a main cluster
     years_not_int_main = set(years) - set(main_cluster.year.values)
@@ -597,14 +745,83 @@ def get_urb_growth_df(smod, built, pop, centroid_mollweide, path_cache):
     return df
 
 
-def plot_smod_clusters(smod, bbox_latlon, feature="clusters"):
-    if feature == "clusters":
-        c_code = 2
-    elif feature == "centers":
-        c_code = 3
-    else:
-        print("Feature must be either clusters or centers.")
-        assert False
+def ghs_fingerprint(path_cache, datasets, *extra):
+    """Fingerprint of cached GHS rasters and additional parameters.
+
+    Rasters are identified by their file size and modification time,
+    which change whenever they are downloaded or sliced again.
+
+    Parameters
+    ----------
+    path_cache : Path
+        Path to the city cache.
+    datasets : list of tuple
+        (dataset, resolution) pairs of the input rasters.
+    *extra
+        Additional JSON serializable parameters, e.g. centroid
+        coordinates.
+
+    Returns
+    -------
+    fingerprint : str
+        Hex digest identifying the inputs.
+    """
+
+    inputs = []
+    for ds, resolution in datasets:
+        fpath = path_cache / f"GHS_{ds}_{resolution}.tif"
+        try:
+            stat = fpath.stat()
+            inputs.append([fpath.name, stat.st_size, stat.st_mtime_ns])
+        except FileNotFoundError:
+            inputs.append([fpath.name, None, None])
+    inputs.extend(extra)
+
+    return hashlib.sha256(json.dumps(inputs).encode()).hexdigest()
+
+
+def load_or_get_urb_growth_df(smod, built, pop, centroid_mollweide, path_cache):
+    """Loads urban_growth.csv from the cache if it was computed from the
+    same GHS rasters and centroid, otherwise computes it with
+    get_urb_growth_df.
+
+    The fingerprint of the inputs is stored next to the csv in
+    urban_growth.key.
+    """
+
+    fpath = path_cache / "urban_growth.csv"
+    key_path = path_cache / "urban_growth.key"
+
+    key = ghs_fingerprint(
+        path_cache,
+        [("SMOD", 1000), ("BUILT_S", 100), ("POP", 100)],
+        [centroid_mollweide.x, centroid_mollweide.y],
+    )
+
+    if cm.lookup(fpath, key_path) and key_path.read_text() == key:
+        return pd.read_csv(fpath, index_col=0)
+
+    df = get_urb_growth_df(smod, built, pop, centroid_mollweide, path_cache)
+    key_path.write_text(key)
+    cm.register(fpath, key_path, producer=get_urb_growth_df)
+
+    return df
+
+
+def first_year_codes(smod, c_code):
+    """Returns a uint8 raster with the index + 1 of the first band in
+    which each SMOD pixel reaches DoU level 1 class c_code, 0 if it never
+    does."""
+
+    reached = (smod // 10 >= c_code).values
+    codes = (reached.argmax(axis=0) + 1).astype("uint8")
+    codes[~reached.any(axis=0)] = 0
+
+    return smod.isel(band=0, drop=True).copy(data=codes).rio.write_nodata(0)
+
+
+def smod_clusters_pixels(smod, c_code):
+    """One polygon per pixel, with the first year it reached c_code."""
 
     smod_lvl_1 = smod // 10
 
@@ -617,11 +834,66 @@ def plot_smod_clusters(smod, bbox_latlon, feature="clusters"):
     df = df.rename(columns={"band": "Año"})
     df = df.sort_values("Año").reset_index(drop=True)
 
-    df["geometry"] = df.apply(ru.row2cell, res_xy=smod.rio.resolution(), axis=1)
+    df["geometry"] = ru.cells_from_xy(df.x, df.y, smod.rio.resolution(), index=df.index)
 
     gdf = gpd.GeoDataFrame(df.drop(columns=["x", "y"]), crs=smod.rio.crs)
 
-    gdf["Año"] = gdf.Año.astype(str)
+    return gdf
+
+
+def smod_clusters_dissolved(smod, c_code):
+    """One multipolygon per year, covering the pixels that first
+    reached c_code that year."""
+
+    codes = first_year_codes(smod, c_code)
+    years = smod["band"].values
+
+    features = rio.features.shapes(
+        codes.values,
+        mask=codes.values > 0,
+        connectivity=4,
+        transform=codes.rio.transform(),
+    )
+    records = [{"Año": years[int(c) - 1], "geometry": shape(f)} for f, c in features]
+
+    gdf = gpd.GeoDataFrame(
+        records, columns=["Año", "geometry"], geometry="geometry", crs=smod.rio.crs
+    )
+    gdf = gdf.dissolve(by="Año").reset_index()
+
+    return gdf
+
+
+def plot_smod_clusters(smod, bbox_latlon, feature="clusters", mode="dissolve"):
+    """Plots the first year in which each SMOD pixel became urban.
+
+    Parameters
+    ----------
+    smod : xarray.DataArray
+        DataArray with SMOD raster data.
+    bbox_latlon : Polygon
+        Bounding box in lat lon, used to center the map.
+    feature : str
+        Either "clusters" or "centers".
+    mode : str
+        Rendering mode, one of:
+            - "dissolve": one multipolygon per year.
+            - "image": a single RGBA image layer.
+            - "pixels": one polygon per pixel (legacy, heavy payloads).
+
+    Returns
+    -------
+    fig : plotly.graph_objects.Figure
+        Mapbox figure.
+    """
+
+    if feature == "clusters":
+        c_code = 2
+    elif feature == "centers":
+        c_code = 3
+    else:
+        print("Feature must be either clusters or centers.")
+        assert False
 
     # Set colormap
     years = [
@@ -639,19 +911,69 @@ def plot_smod_clusters(smod, bbox_latlon, feature="clusters"):
     colors_rgba = [plt.cm.get_cmap("cividis", 10)(i) for i in range(10)]
     cmap_cat = {y: mpl.colors.rgb2hex(c) for y, c in zip(years, colors_rgba)}
 
-    gdf = gdf.to_crs(epsg=4326).reset_index()
-    fig = px.choropleth_mapbox(
-        gdf,
-        geojson=gdf.geometry,
-        color="Año",
-        locations="index",
-        hover_name=None,
-        hover_data={"Año": True, "index": False},
-        color_discrete_map=cmap_cat,
-        opacity=0.5,
-        mapbox_style="carto-positron",
-    )
-    fig.update_traces(marker_line_width=0)
+    if mode == "image":
+        # Default nearest neighbour resampling keeps year codes intact
+        codes = first_year_codes(smod, c_code).rio.reproject("EPSG:4326")
+
+        # Colorize image, code 0 remains transparent
+        colors = np.zeros((len(years) + 1, 4), dtype="uint8")
+        colors[1:] = (np.array(colors_rgba) * 255).astype("uint8")
+        colors[1:, 3] = 128
+        img = ImageOps.flip(Image.fromarray(colors[codes.values]))
+        img = ui.encode_overlay(img, max_upscale=10 if HIGH_RES else 1)
+
+        lonmin, latmin, lonmax, latmax = codes.rio.bounds()
+        coordinates = [
+            [lonmin, latmin],
+            [lonmax, latmin],
+            [lonmax, latmax],
+            [lonmin, latmax],
+        ]
+
+        dummy_df = pd.DataFrame({"lat": [0] * 10, "lon": [0] * 10, "Año": years})
+        fig = px.scatter_mapbox(
+            dummy_df,
+            lat="lat",
+            lon="lon",
+            color="Año",
+            color_discrete_map=cmap_cat,
+            mapbox_style="carto-positron",
+        )
+        fig.update_layout(
+            mapbox_layers=[
+                {
+                    "sourcetype": "image",
+                    "source": img,
+                    "coordinates": coordinates,
+                    "below": "traces",
+                }
+            ]
+        )
+    elif mode in ("dissolve", "pixels"):
+        if mode == "dissolve":
+            gdf = smod_clusters_dissolved(smod, c_code)
+        else:
+            gdf = smod_clusters_pixels(smod, c_code)
+
+        gdf["Año"] = gdf.Año.astype(str)
+
+        gdf = gdf.to_crs(epsg=4326).reset_index()
+        fig = px.choropleth_mapbox(
+            gdf,
+            geojson=gdf.geometry,
+            color="Año",
+            locations="index",
+            hover_name=None,
+            hover_data={"Año": True, "index": False},
+            color_discrete_map=cmap_cat,
+            category_orders={"Año": years},
+            opacity=0.5,
+            mapbox_style="carto-positron",
+        )
+        fig.update_traces(marker_line_width=0)
+    else:
+        raise ValueError(f"Unknown mode {mode}, use dissolve, image or pixels.")
+
     fig.update_layout(
         mapbox_center={
             "lat": bbox_latlon.centroid.xy[1][0],
@@ -681,7 +1003,13 @@ def plot_smod_clusters(smod, bbox_latlon, feature="clusters"):
 
 
 def plot_built_year_img(
-    smod, built, bbox_latlon, bbox_mollweide, centroid_mollweide, year=2020
+    smod,
+    built,
+    bbox_latlon,
+    bbox_mollweide,
+    centroid_mollweide,
+    year=2020,
+    path_cache=None,
 ):
     """Plots built for year using an image overlay."""
 
@@ -735,7 +1063,7 @@ def plot_built_year_img(
     )
 
     # Create polygons of urban clusters and centers
-    smod_p = smod_polygons(smod, centroid_mollweide)
+    smod_p = smod_polygons(smod, centroid_mollweide, path_cache)
     clusters_2020 = smod_p[(smod_p.year == 2020) & (smod_p["class"] == 2)]
     clusters_2020 = clusters_2020.to_crs(4326)
 
@@ -790,11 +1118,8 @@ def plot_built_year_img(
     p_fig.update_traces(hovertemplate=None, hoverinfo="skip")
     fig.add_traces(p_fig.data)
 
-    # High res image
-    if HIGH_RES:
-        img = img.resize(
-            [hw * 10 for hw in img.size], resample=Image.Resampling.NEAREST
-        )
+    # Encode as PNG, upscaled within the pixel budget
+    img = ui.encode_overlay(img, max_upscale=10 if HIGH_RES else 1)
 
     fig.update_layout(coloraxis_colorbar_orientation="h")
     fig.update_layout(
@@ -821,7 +1146,9 @@ def plot_built_year_img(
     return fig
 
 
-def plot_pop_year_img(smod, pop, bbox_mollweide, centroid_mollweide, year=2020):
+def plot_pop_year_img(
+    smod, pop, bbox_mollweide, centroid_mollweide, year=2020, path_cache=None
+):
     resolution = pop.rio.resolution()
     pixel_area = abs(np.prod(resolution)) / 1e6
 
@@ -899,7 +1226,7 @@ def plot_pop_year_img(smod, pop, bbox_mollweide, centroid_mollweide, year=2020):
     )
 
     # Create polygons of urban clusters and centers
-    smod_p = smod_polygons(smod, centroid_mollweide)
+    smod_p = smod_polygons(smod, centroid_mollweide, path_cache)
     clusters_2020 = smod_p[(smod_p.year == 2020) & (smod_p["class"] == 2)]
     clusters_2020 = clusters_2020.to_crs(4326)
 
@@ -954,11 +1281,8 @@ def plot_pop_year_img(smod, pop, bbox_mollweide, centroid_mollweide, year=2020):
     p_fig.update_traces(hovertemplate=None, hoverinfo="skip")
     fig.add_traces(p_fig.data)
 
-    # High res image
-    if HIGH_RES:
-        img = img.resize(
-            [hw * 10 for hw in img.size], resample=Image.Resampling.NEAREST
-        )
+    # Encode as PNG, upscaled within the pixel budget
+    img = ui.encode_overlay(img, max_upscale=10 if HIGH_RES else 1)
 
     fig.update_layout(
         mapbox_layers=[
@@ -1040,3 +1364,203 @@ def plot_growth(growth_df, *, y_cols, title, ylabel, var_type="extensive"):
     )
 
     return fig
+
+
+def ghs_artifact(ds, resolution):
+    """Pipeline artifact for the GHS dataset ds at resolution."""
+    return pl.artifact(
+        [f"GHS_{ds}_{resolution}.tif"],
+        lambda context: load_or_download(
+            context["bbox_mollweide"],
+            ds,
+            data_path=context["path_cache"],
+            resolution=resolution,
+        ),
+    )
+
+
+# GHS rasters and derived files as pipeline artifacts, see ursa.pipeline.
+# urban_growth needs centroid_mollweide in the context.
+ARTIFACTS = {
+    "ghs_smod": ghs_artifact("SMOD", 1000),
+    "ghs_built": ghs_artifact("BUILT_S", 100),
+    "ghs_pop": ghs_artifact("POP", 100),
+    "ghs_land": ghs_artifact("LAND", 100),
+    "urban_growth": pl.artifact(
+        ["urban_growth.csv", "urban_growth.key"],
+        lambda context: load_or_get_urb_growth_df(
+            *load_plot_datasets(
+                context["bbox_mollweide"], context["path_cache"], clip=True
+            ),
+            context["centroid_mollweide"],
+            context["path_cache"],
+        ),
+        inputs=["ghs_smod", "ghs_built", "ghs_pop"],
+    ),
+}
+
+
+# Line plots of the historic growth page, as (kind, plot_growth kwargs)
+GROWTH_LINE_PLOTS = [
+    (
+        "growth_urban_area",
+        dict(
+            y_cols=["urban_cluster_main", "urban_cluster_other"],
+            title="Área urbana",
+            ylabel="Área (km²)",
+            var_type="extensive",
+        ),
+    ),
+    (
+        "growth_built_area",
+        dict(
+            y_cols=["built_cluster_main", "built_cluster_other"],
+            title="Área construida",
+            ylabel="Área (km²)",
+            var_type="extensive",
+        ),
+    ),
+    (
+        "growth_pop",
+        dict(
+            y_cols=["pop_cluster_main", "pop_cluster_other"],
+            title="Población",
+            ylabel="Población",
+            var_type="extensive",
+        ),
+    ),
+    (
+        "growth_built_density",
+        dict(
+            y_cols=[
+                "built_density_cluster_main",
+                "built_density_cluster_other",
+                "built_density_cluster_all",
+            ],
+            title="Densidad de construcción",
+            ylabel="Fracción de área construida",
+            var_type="intensive",
+        ),
+    ),
+    (
+        "growth_pop_density",
+        dict(
+            y_cols=[
+                "pop_density_cluster_main",
+                "pop_density_cluster_other",
+                "pop_density_cluster_all",
+            ],
+            title="Densidad de población",
+            ylabel="Personas por km²",
+            var_type="intensive",
+        ),
+    ),
+    (
+        "growth_pop_b_density",
+        dict(
+            y_cols=[
+                "pop_b_density_cluster_main",
+                "pop_b_density_cluster_other",
+                "pop_b_density_cluster_all",
+            ],
+            title="Densidad de población (construcción)",
+            ylabel="Personas por km² de construcción",
+            var_type="intensive",
+        ),
+    ),
+]
+
+
+def load_or_plot_hist_growth(bbox_latlon, uc_latlon, path_cache):
+    """Returns the line plots and maps of the historic growth page.
+
+    Figures are served from the figure cache of the city when available.
+    Rasters and the growth DataFrame are only loaded if at least one
+    figure has to be built.
+
+    Parameters
+    ----------
+    bbox_latlon : Polygon
+        Bounding box of the city in lat lon.
+    uc_latlon : Polygon
+        Urban center of the city in lat lon.
+    path_cache : Path
+        Path to the city cache.
+
+    Returns
+    -------
+    lines : list
+        Figure dictionaries for each entry in GROWTH_LINE_PLOTS, None
+        for plots that could not be built.
+    maps : list
+        Figure dictionaries for the built-up history, SMOD clusters,
+        built-up fraction and population maps.
+    """
+
+    bbox_mollweide = ug.reproject_geometry(bbox_latlon, GHS_CRS).envelope
+    uc_mollweide = ug.reproject_geometry(uc_latlon, GHS_CRS)
+    centroid_mollweide = uc_mollweide.centroid
+
+    @cache
+    def datasets():
+        return load_plot_datasets(bbox_mollweide, path_cache, clip=True)
+
+    @cache
+    def growth_df():
+        smod, built, pop = datasets()
+        return load_or_get_urb_growth_df(
+            smod=smod,
+            built=built,
+            pop=pop,
+            centroid_mollweide=centroid_mollweide,
+            path_cache=path_cache,
+        )
+
+    lines = []
+    for kind, params in GROWTH_LINE_PLOTS:
+        try:
+            fig = fc.load_or_build_figure(
+                path_cache,
+                kind,
+                lambda: plot_growth(growth_df(), **params),
+                producer=plot_growth,
+            )
+        except Exception:
+            fig = None
+        lines.append(fig)
+
+    def built_agg():
+        smod, built, _ = datasets()
+        return plot_built_agg_img(
+            smod, built, bbox_mollweide, centroid_mollweide, path_cache=path_cache
+        )
+
+    def smod_clusters():
+        smod, _, _ = datasets()
+        return plot_smod_clusters(smod, bbox_latlon)
+
+    def built_year():
+        smod, built, _ = datasets()
+        return plot_built_year_img(
+            smod,
+            built,
+            bbox_latlon,
+            bbox_mollweide,
+            centroid_mollweide,
+            path_cache=path_cache,
+        )
+
+    def pop_year():
+        smod, _, pop = datasets()
+        return plot_pop_year_img(
+            smod, pop, bbox_mollweide, centroid_mollweide, path_cache=path_cache
+        )
+
+    maps = [
+        fc.load_or_build_figure(path_cache, "map_built_agg", built_agg),
+        fc.load_or_build_figure(path_cache, "map_smod_clusters", smod_clusters),
+        fc.load_or_build_figure(path_cache, "map_built_year", built_year),
+        fc.load_or_build_figure(path_cache, "map_pop_year", pop_year),
+    ]
+
+    return lines, maps
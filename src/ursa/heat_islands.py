@@ -4,7 +4,9 @@ import json
 import geopandas as gpd
 import pandas as pd
 import ursa.ghsl as ghsl
+import ursa.pipeline as pl
 import ursa.sleuth_prep as sp
+import ursa.utils.cache_manager as cm
 import ursa.utils.geometry as ug
 import ursa.world_cover as wc
 
@@ -96,13 +98,14 @@ def get_temps(lst, masks):
 
 def load_or_get_temps(lst, masks, path_cache):
     fpath = path_cache / "temperatures.json"
-    if fpath.exists():
+    if cm.lookup(fpath):
         with open(fpath, "r") as f:
             temps = json.load(f)
     else:
         temps = get_temps(lst, masks)
         with open(path_cache / "temperatures.json", "w") as f:
             json.dump(temps, f)
+        cm.register(fpath, producer=get_temps)
 
     return temps
 
@@ -172,11 +175,12 @@ def get_temperature_areas(img_cat, masks, bbox):
 
 def load_or_get_t_areas(bbox_ee, img_cat, masks, path_cache):
     fpath = path_cache / "temp_areas.csv"
-    if fpath.exists():
+    if cm.lookup(fpath):
         df = pd.read_csv(fpath, index_col="clase")
     else:
         df = get_temperature_areas(img_cat, masks, bbox_ee)
         df.to_csv(path_cache / "temp_areas.csv")
+        cm.register(fpath, producer=get_temperature_areas)
     return df
 
 
@@ -230,12 +234,13 @@ def get_land_usage_dataframe(bbox_ee, img_cat, lc):
 
 def load_or_get_land_usage_df(bbox_ee, img_cat, path_cache):
     fpath = path_cache / "land_cover_by_temp.csv"
-    if fpath.exists():
+    if cm.lookup(fpath):
         df = pd.read_csv(fpath)
     else:
         lc, _ = wc.get_cover_and_masks(bbox_ee, img_cat.projection())
         df = get_land_usage_dataframe(bbox_ee, img_cat, lc)
         df.to_csv(path_cache / "land_cover_by_temp.csv", index=False)
+        cm.register(fpath, producer=get_land_usage_dataframe)
     return df
 
 
@@ -333,7 +338,7 @@ def load_or_get_radial_distributions(
     fpath_f = path_cache / "radial_function.csv"
     fpath_lc = path_cache / "radial_lc.csv"
 
-    if fpath_f.exists() and fpath_lc.exists():
+    if cm.lookup(fpath_f, fpath_lc):
         df_f = pd.read_csv(fpath_f)
         df_lc = pd.read_csv(fpath_lc, index_col="x")
     else:
@@ -355,6 +360,7 @@ def load_or_get_radial_distributions(
 
         df_lc.to_csv(fpath_lc)
         df_f.to_csv(fpath_f)
+        cm.register(fpath_f, fpath_lc, producer=get_radial_f)
 
     return df_f, df_lc
 
@@ -388,7 +394,7 @@ def get_mit_areas_df(bbox_latlon, bbox_mollweide, uc_mollweide_centroid, path_ca
     smod = ghsl.load_or_download(
         bbox_mollweide, "SMOD", data_path=path_cache, resolution=1000
     )
-    smod_gdf = ghsl.smod_polygons(smod, uc_mollweide_centroid)
+    smod_gdf = ghsl.smod_polygons(smod, uc_mollweide_centroid, path_cache)
     clusters_gdf = smod_gdf[smod_gdf["class"] == 2]
     main_cluster = clusters_gdf[clusters_gdf.is_main]
 
@@ -420,12 +426,13 @@ def load_or_get_mit_areas_df(
     bbox_latlon, bbox_mollweide, uc_mollweide_centroid, path_cache, force=False
 ):
     fpath = path_cache / "mitigation_areas.csv"
-    if fpath.exists() and not force:
+    if not force and cm.lookup(fpath):
         df = pd.read_csv(fpath)
     else:
         df = get_mit_areas_df(
             bbox_latlon, bbox_mollweide, uc_mollweide_centroid, path_cache
         )
+        cm.register(fpath, producer=get_mit_areas_df)
     return df
 
 
@@ -470,3 +477,21 @@ def calculate_road_area(bbox, path_cache, cluster):
     total_lenght = edges[pip]["length"].sum() / 1000
 
     return total_lenght
+
+
+# Mitigation areas as a pipeline artifact, see ursa.pipeline. Needs
+# bbox_latlon and centroid_mollweide in the context. Temperature
+# artifacts depend on the season and year chosen in the app and are
+# kept out of the graph.
+ARTIFACTS = {
+    "mitigation_areas": pl.artifact(
+        ["mitigation_areas.csv"],
+        lambda context: load_or_get_mit_areas_df(
+            context["bbox_latlon"],
+            context["bbox_mollweide"],
+            context["centroid_mollweide"],
+            context["path_cache"],
+        ),
+        inputs=["ghs_smod", "ghs_built"],
+    ),
+}
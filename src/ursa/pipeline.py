@@ -0,0 +1,412 @@
+"""Dependency graph runner for the files derived for each city.
+
+Each artifact is a group of files in the city cache, produced together
+by a single function from a set of input artifacts. Artifacts are
+described by dictionaries built with artifact() and collected in a
+graph, a dictionary keyed by artifact name, e.g.:
+
+    graph = {**ghsl.ARTIFACTS, **dou.ARTIFACTS, **sp.ARTIFACTS}
+    pipeline.run(graph, ["sleuth_urban"], context)
+
+Producers receive a context dictionary with the city parameters
+(path_cache, bbox_mollweide and, for some artifacts, bbox_latlon and
+centroid_mollweide) and must write their outputs to path_cache.
+
+An artifact is stale if any of its files is missing or if the contents
+of any of its inputs changed since it was built. Contents are compared
+by sha256 fingerprints recorded in path_cache/pipeline.json when an
+artifact is built, artifacts built before that are compared by
+modification time instead. A missing input is treated as an
+intermediate file: it is only built again if an artifact reading it is
+rebuilt, so inputs evicted from the cache do not cascade into rebuilds,
+and an input downloaded again with the same contents does not make its
+dependents stale.
+
+Only stale artifacts are rebuilt, and independent artifacts are built
+concurrently in a thread pool. Producers run in a temporary directory
+holding links to the files of the city cache, and new files are moved
+into the city cache with os.replace once the producer finishes, so
+readers never see missing or partial files.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import time
+import uuid
+
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import ursa.utils.cache_manager as cm
+
+from ursa.utils.file_lock import file_lock
+
+# Maximum number of artifacts built concurrently.
+PIPELINE_MAX_WORKERS = int(os.environ.get("URSA_PIPELINE_MAX_WORKERS", 4))
+
+STATE_NAME = "pipeline.json"
+STATE_LOCK_NAME = "pipeline.lock"
+
+
+def artifact(outputs, producer, inputs=()):
+    """Describes an artifact of the graph.
+
+    Parameters
+    ----------
+    outputs : list of str
+        File names of the artifact, relative to the city cache.
+    producer : callable
+        Function receiving the context dictionary that writes outputs.
+    inputs : list of str
+        Names of the artifacts the producer reads.
+
+    Returns
+    -------
+    artifact : dict
+    """
+
+    return {"outputs": list(outputs), "producer": producer, "inputs": list(inputs)}
+
+
+def dependencies(graph, targets):
+    """Returns targets and all their upstream artifacts in topological
+    order, inputs first."""
+
+    order = []
+    visiting = set()
+
+    def visit(name):
+        if name in order:
+            return
+        if name in visiting:
+            raise ValueError(f"Dependency cycle found at artifact {name}.")
+        if name not in graph:
+            raise KeyError(f"Unknown artifact {name}.")
+        visiting.add(name)
+        for input_name in graph[name]["inputs"]:
+            visit(input_name)
+        visiting.remove(name)
+        order.append(name)
+
+    for target in targets:
+        visit(target)
+
+    return order
+
+
+def _exists(graph, name, path_cache):
+    return all((path_cache / fname).exists() for fname in graph[name]["outputs"])
+
+
+def _read_state(path_cache):
+    try:
+        with open(path_cache / STATE_NAME, "r", encoding="utf8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {"files": {}, "artifacts": {}}
+
+
+def _update_state(path_cache, files=None, artifacts=None):
+    """Merges file fingerprints and artifact records into the state file.
+
+    Several processes may run the same city, e.g. the precompute CLI and
+    the app, so the state is read and written under a file lock.
+    """
+
+    fpath = path_cache / STATE_NAME
+    with file_lock(path_cache / STATE_LOCK_NAME):
+        state = _read_state(path_cache)
+        state["files"].update(files or {})
+        state["artifacts"].update(artifacts or {})
+        tmp_path = fpath.with_name(f"{fpath.name}.{os.getpid()}.tmp")
+        with open(tmp_path, "w", encoding="utf8") as f:
+            json.dump(state, f)
+        os.replace(tmp_path, fpath)
+
+
+def _fingerprints(graph, name, path_cache, state):
+    """Returns the sha256 digests of the outputs of name, keyed by file
+    name.
+
+    Digests are cached in the state file by modification time and size,
+    so unchanged files are not read again.
+    """
+
+    fingerprints = {}
+    new_files = {}
+    for fname in graph[name]["outputs"]:
+        stat = (path_cache / fname).stat()
+        cached = state["files"].get(fname)
+        if cached and cached[:2] == [stat.st_mtime_ns, stat.st_size]:
+            fingerprints[fname] = cached[2]
+            continue
+
+        h = hashlib.sha256()
+        with open(path_cache / fname, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                h.update(chunk)
+        fingerprints[fname] = h.hexdigest()
+        new_files[fname] = [stat.st_mtime_ns, stat.st_size, fingerprints[fname]]
+
+    if new_files:
+        state["files"].update(new_files)
+        _update_state(path_cache, files=new_files)
+
+    return fingerprints
+
+
+def _changed_inputs(graph, name, path_cache, state):
+    """Returns True if any existing input of name changed since name was
+    built. Missing inputs are ignored."""
+
+    inputs = [
+        input_name
+        for input_name in graph[name]["inputs"]
+        if _exists(graph, input_name, path_cache)
+    ]
+    record = state["artifacts"].get(name)
+
+    if record is None:
+        # Built before fingerprints were recorded
+        mtime = min(
+            (path_cache / fname).stat().st_mtime for fname in graph[name]["outputs"]
+        )
+        return any(
+            (path_cache / fname).stat().st_mtime > mtime
+            for input_name in inputs
+            for fname in graph[input_name]["outputs"]
+        )
+
+    return any(
+        record.get(input_name) != _fingerprints(graph, input_name, path_cache, state)
+        for input_name in inputs
+    )
+
+
+def stale_artifacts(graph, targets, path_cache, force=False):
+    """Returns the set of artifacts needed by targets that must be
+    (re)built.
+
+    Targets are built if missing, if any of their inputs changed or if
+    any of their inputs is rebuilt, and missing inputs are only built
+    for artifacts that are built.
+    """
+
+    order = dependencies(graph, targets)
+    state = _read_state(path_cache)
+
+    # Artifacts that must be rebuilt if they are needed
+    missing = {name for name in order if not _exists(graph, name, path_cache)}
+    outdated = set()
+    for name in order:
+        if name in missing:
+            continue
+        if (
+            force
+            or any(input_name in outdated for input_name in graph[name]["inputs"])
+            or _changed_inputs(graph, name, path_cache, state)
+        ):
+            outdated.add(name)
+
+    stale = set()
+    needed = set(targets)
+    for name in reversed(order):
+        if name not in needed or name not in missing | outdated:
+            continue
+        stale.add(name)
+        needed.update(graph[name]["inputs"])
+
+    return stale
+
+
+def _link_or_copy(src, dst):
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+
+def _build(graph, name, context):
+    """Runs the producer of name in a temporary directory and moves the
+    new files into the city cache."""
+
+    node = graph[name]
+    path_cache = context["path_cache"]
+    build_dir = path_cache / f".build-{name}-{uuid.uuid4().hex}"
+    build_dir.mkdir()
+
+    try:
+        # Every file but the outputs is linked, so the load_or_* functions
+        # used as producers reuse their other files and compute the
+        # outputs again instead of reading them. Linked files are shared
+        # with the city cache, load_or_* functions only write missing
+        # files.
+        linked = {}
+        for fpath in path_cache.iterdir():
+            if (
+                fpath.name in node["outputs"]
+                or fpath.name in (STATE_NAME, STATE_LOCK_NAME)
+                or fpath.name.startswith(".")
+                or not fpath.is_file()
+            ):
+                continue
+            _link_or_copy(fpath, build_dir / fpath.name)
+            linked[fpath.name] = (build_dir / fpath.name).stat().st_ino
+
+        start = time.perf_counter()
+        node["producer"]({**context, "path_cache": build_dir})
+        elapsed = time.perf_counter() - start
+
+        missing = [
+            fname for fname in node["outputs"] if not (build_dir / fname).exists()
+        ]
+        if missing:
+            raise RuntimeError(f"Artifact {name} did not produce {missing}.")
+
+        # Outputs and any other file written by the producer
+        for fpath in build_dir.iterdir():
+            if not fpath.is_file() or linked.get(fpath.name) == fpath.stat().st_ino:
+                continue
+            cm.replace(fpath, path_cache / fpath.name)
+    finally:
+        shutil.rmtree(build_dir, ignore_errors=True)
+        # Forgets files registered in the build directory
+        cm.evict()
+
+    cm.lookup(*[path_cache / fname for fname in node["outputs"]])
+    return elapsed
+
+
+def _record(graph, name, path_cache):
+    """Records the fingerprints of the inputs name was built from."""
+
+    state = _read_state(path_cache)
+    record = {
+        input_name: _fingerprints(graph, input_name, path_cache, state)
+        for input_name in graph[name]["inputs"]
+        if _exists(graph, input_name, path_cache)
+    }
+    _update_state(path_cache, artifacts={name: record})
+
+
+def run(graph, targets, context, max_workers=None, force=False, raise_errors=True):
+    """Builds the stale artifacts needed by targets.
+
+    Parameters
+    ----------
+    graph : dict
+        Artifacts keyed by name.
+    targets : list of str
+        Names of the requested artifacts.
+    context : dict
+        Parameters passed to producers, must contain path_cache.
+    max_workers : int
+        Maximum number of artifacts built concurrently.
+        Defaults to PIPELINE_MAX_WORKERS.
+    force : bool
+        If True, rebuild all artifacts needed by targets.
+    raise_errors : bool
+        If True, errors of producers are raised once running artifacts
+        finish. Otherwise, failed artifacts and the artifacts depending
+        on them are reported in the returned records.
+
+    Returns
+    -------
+    records : list of dict
+        Name, status ("built", "fresh", "failed" or "not run"), build
+        time in seconds and error of every artifact needed by targets,
+        in topological order. Missing inputs of fresh artifacts are
+        reported as fresh.
+    """
+
+    if max_workers is None:
+        max_workers = PIPELINE_MAX_WORKERS
+
+    path_cache = context["path_cache"]
+    order = dependencies(graph, targets)
+    stale = stale_artifacts(graph, targets, path_cache, force)
+
+    records = {
+        name: {"artifact": name, "status": "fresh", "seconds": 0.0, "error": ""}
+        for name in order
+    }
+    pending = [name for name in order if name in stale]
+    done = set(order) - stale
+    failed = set()
+
+    # Fresh artifacts count as cache hits
+    for name in done:
+        cm.lookup(*[path_cache / fname for fname in graph[name]["outputs"]])
+
+    # Artifacts built before fingerprints were recorded, once all their
+    # inputs are available
+    recorded = _read_state(path_cache)["artifacts"]
+    for name in order:
+        if name in stale or name in recorded:
+            continue
+        inputs = graph[name]["inputs"]
+        if all(_exists(graph, n, path_cache) for n in [name, *inputs]):
+            _record(graph, name, path_cache)
+
+    state = _read_state(path_cache)
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+        running = {}
+        while pending or running:
+            for name in list(pending):
+                inputs = graph[name]["inputs"]
+                if any(input_name in failed for input_name in inputs):
+                    records[name]["status"] = "not run"
+                    failed.add(name)
+                    pending.remove(name)
+                elif all(input_name in done for input_name in inputs):
+                    pending.remove(name)
+                    # Rebuilt inputs may have the same contents as before
+                    if (
+                        not force
+                        and name in state["artifacts"]
+                        and _exists(graph, name, path_cache)
+                        and not _changed_inputs(graph, name, path_cache, state)
+                    ):
+                        done.add(name)
+                        continue
+                    print(f"Building {name} ...")
+                    running[executor.submit(_build, graph, name, context)] = name
+
+            if not running:
+                continue
+
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                name = running.pop(future)
+                try:
+                    records[name]["seconds"] = future.result()
+                except Exception as e:
+                    if raise_errors:
+                        # Pending artifacts are dropped
+                        pending.clear()
+                        raise
+                    print(f"Failed to build {name}: {e!r}")
+                    records[name].update(status="failed", error=repr(e))
+                    failed.add(name)
+                    continue
+                _record(graph, name, path_cache)
+                state = _read_state(path_cache)
+                records[name]["status"] = "built"
+                done.add(name)
+                print(f"Built {name} in {records[name]['seconds']:.1f} s.")
+
+                # Fresh artifacts reading an input that was missing are
+                # rebuilt if its new contents differ
+                for other in order:
+                    if (
+                        other in done
+                        and name in graph[other]["inputs"]
+                        and records[other]["status"] == "fresh"
+                        and _exists(graph, other, path_cache)
+                        and _changed_inputs(graph, other, path_cache, state)
+                    ):
+                        done.remove(other)
+                        pending.append(other)
+
+    return [records[name] for name in order]
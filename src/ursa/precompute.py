@@ -0,0 +1,240 @@
+"""Batch precomputation of the per city cache.
+
+Runs the expensive stages of the app (GHSL downloads, Degree of
+Urbanization, urban growth, SLEUTH inputs and historic growth figures)
+for every city in cities_fua.gpkg, so analysts find them already cached.
+Cities are processed in parallel in a process pool.
+
+Stages are described as artifacts of the ursa.pipeline graph, so files
+already in the cache and newer than their inputs are skipped, and an
+interrupted run can simply be started again to resume it. A report with
+the status and duration of every artifact is written at the end.
+
+Usage:
+    ursa-precompute [--workers N] [--stages ghsl dou ...] [--country C]
+"""
+
+import argparse
+import os
+import time
+import traceback
+
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+
+import ee
+import geopandas as gpd
+import pandas as pd
+import ursa.degree_of_urbanization as dou
+import ursa.ghsl as ghsl
+import ursa.heat_islands as ht
+import ursa.pipeline as pl
+import ursa.sleuth_prep as sp
+import ursa.utils.cache_manager as cm
+import ursa.utils.geometry as ug
+import ursa.utils.raster as ru
+
+PATH_FUA = Path("./data/output/cities/")
+
+STAGE_NAMES = ["ghsl", "dou", "growth", "sleuth", "mitigation", "figures"]
+
+# Pipeline artifacts requested by each stage, see ursa.pipeline
+STAGE_TARGETS = {
+    "ghsl": ["ghs_smod", "ghs_built", "ghs_pop", "ghs_land"],
+    "dou": ["dou"],
+    "growth": ["urban_growth"],
+    "sleuth": list(sp.ARTIFACTS),
+    "mitigation": ["mitigation_areas"],
+}
+
+# Stages run when none are given, mitigation areas also need OSM
+# and GEE queries per city and are only run on request.
+DEFAULT_STAGES = ["ghsl", "dou", "growth", "sleuth", "figures"]
+
+GRAPH = {**ghsl.ARTIFACTS, **dou.ARTIFACTS, **sp.ARTIFACTS, **ht.ARTIFACTS}
+
+
+def list_cities(data_path=PATH_FUA, countries=None):
+    """Returns a list of (country, city) pairs in cities_fua.gpkg."""
+
+    cities_fua = gpd.read_file(data_path / "cities_fua.gpkg")
+    if countries:
+        cities_fua = cities_fua[cities_fua.country.isin(countries)]
+    return list(zip(cities_fua.country, cities_fua.city))
+
+
+def init_worker():
+    """Initializes Earth Engine in each worker, needed by the SLEUTH
+    stage."""
+    try:
+        ee.Initialize()
+    except Exception as e:
+        print(f"Earth Engine could not be initialized: {e}")
+
+
+def precompute_city(country, city, stages, data_path=PATH_FUA, force=False):
+    """Runs stages for a single city.
+
+    Artifacts of the pipeline stages are built in a single pipeline run,
+    so fresh artifacts are skipped and independent ones are built
+    concurrently. If an artifact fails, the artifacts depending on it
+    are not run. Historic growth figures are built last, cached figures
+    are read back without rebuilding them.
+
+    Returns
+    -------
+    records : list of dict
+        Stage, artifact, status and duration of every artifact.
+    """
+
+    bbox_latlon, uc_latlon, _ = ru.get_bboxes(city, country, data_path)
+    id_hash = ug.hash_geometry(ug.geometry_to_json(bbox_latlon))
+    path_cache = cm.CACHE_DIR / str(id_hash)
+    path_cache.mkdir(exist_ok=True, parents=True)
+
+    context = {
+        "bbox_latlon": bbox_latlon,
+        "bbox_mollweide": ug.reproject_geometry(bbox_latlon, ghsl.GHS_CRS).envelope,
+        "centroid_mollweide": ug.reproject_geometry(uc_latlon, ghsl.GHS_CRS).centroid,
+        "path_cache": path_cache,
+        # Cities already run in parallel, epochs are processed sequentially
+        "dou_max_workers": 1,
+    }
+
+    stage_of = {}
+    for name in stages:
+        for target in STAGE_TARGETS.get(name, []):
+            stage_of.setdefault(target, name)
+
+    artifact_records = pl.run(
+        GRAPH, list(stage_of), context, force=force, raise_errors=False
+    )
+
+    records = []
+    for record in artifact_records:
+        # Upstream artifacts are reported with the first stage needing them
+        stage = stage_of.get(record["artifact"], stages[0])
+        records.append({"country": country, "city": city, "stage": stage, **record})
+
+    if "figures" in stages:
+        record = {
+            "country": country,
+            "city": city,
+            "stage": "figures",
+            "artifact": "hist_growth_figures",
+        }
+        if any(r["status"] in ("failed", "not run") for r in records):
+            record.update(status="not run", seconds=0.0, error="")
+        else:
+            start = time.perf_counter()
+            try:
+                ghsl.load_or_plot_hist_growth(bbox_latlon, uc_latlon, path_cache)
+                record.update(status="built", error="")
+            except Exception as e:
+                traceback.print_exc()
+                record.update(status="failed", error=repr(e))
+            record["seconds"] = time.perf_counter() - start
+        records.append(record)
+
+    for record in records:
+        record["id_hash"] = id_hash
+
+    return records
+
+
+def print_summary(report):
+    summary = report.groupby(["stage", "status"]).seconds.agg(["count", "sum", "mean"])
+    print("\nSummary (seconds):")
+    print(summary.round(1).to_string())
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Precomputes the cache of every city in cities_fua.gpkg."
+    )
+    parser.add_argument(
+        "--data-path",
+        type=Path,
+        default=PATH_FUA,
+        help="Directory with cities_fua.gpkg and cities_uc.gpkg.",
+    )
+    parser.add_argument(
+        "--stages",
+        nargs="+",
+        choices=STAGE_NAMES,
+        default=DEFAULT_STAGES,
+        help="Stages to run, in order.",
+    )
+    parser.add_argument(
+        "--country", nargs="+", default=None, help="Only process these countries."
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=max(1, (os.cpu_count() or 2) // 2),
+        help="Number of cities processed in parallel.",
+    )
+    parser.add_argument(
+        "--force", action="store_true", help="Run stages even if already cached."
+    )
+    parser.add_argument(
+        "--report",
+        type=Path,
+        default=cm.CACHE_DIR / "precompute_report.csv",
+        help="Path of the csv report.",
+    )
+    args = parser.parse_args()
+
+    stages = [name for name in STAGE_NAMES if name in args.stages]
+    cities = list_cities(args.data_path, args.country)
+    print(f"Precomputing {len(stages)} stages for {len(cities)} cities ...")
+
+    records = []
+    start = time.perf_counter()
+    with ProcessPoolExecutor(
+        max_workers=args.workers, initializer=init_worker
+    ) as executor:
+        futures = {
+            executor.submit(
+                precompute_city, country, city, stages, args.data_path, args.force
+            ): (country, city)
+            for country, city in cities
+        }
+        for i, future in enumerate(as_completed(futures), start=1):
+            country, city = futures[future]
+            try:
+                city_records = future.result()
+            except Exception as e:
+                city_records = [
+                    {
+                        "country": country,
+                        "city": city,
+                        "id_hash": None,
+                        "stage": "setup",
+                        "artifact": None,
+                        "status": "failed",
+                        "seconds": 0.0,
+                        "error": repr(e),
+                    }
+                ]
+            records += city_records
+
+            statuses = ", ".join(
+                f"{r['artifact']}: {r['status']}"
+                for r in city_records
+                if r["status"] != "fresh"
+            )
+            seconds = sum(r["seconds"] for r in city_records)
+            print(f"[{i}/{len(cities)}] {city}, {country} ({seconds:.1f} s) {statuses}")
+
+    report = pd.DataFrame(records)
+    args.report.parent.mkdir(parents=True, exist_ok=True)
+    report.to_csv(args.report, index=False)
+
+    print_summary(report)
+    print(f"Total time: {time.perf_counter() - start:.1f} s.")
+    print(f"Report written to {args.report}.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,410 @@
+"""Background SLEUTH calibration jobs and parallel prediction scenarios.
+
+Calibrations are run by Dash background callbacks (see app.py) in a
+process of the background callback manager, so they do not block the
+workers serving requests. Every job gets a random ID and keeps its
+status in a JSON file under path_cache/calibration, updated periodically
+while running and holding the fitted coefficients once it finishes. The
+browser only keeps the job ID, so a reloaded page can read the status
+file to show progress or results again.
+
+SLEUTH.fit does not report progress, so it is estimated from elapsed
+time and the speed of earlier calibrations of the same city, measured
+in units of work: coefficient combinations times Monte Carlo iterations
+times calibration years.
+
+Prediction scenarios are independent runs of SLEUTH over the same
+grids, so run_scenarios runs them in a long-lived process pool, see
+ursa.utils.process_pool. The grids are placed once in shared memory and
+attached read-only by the workers.
+"""
+
+import json
+import os
+import re
+import threading
+import time
+
+import ursa.utils.process_pool as pp
+import ursa.utils.shared_arrays as sa
+
+from concurrent.futures import as_completed
+from concurrent.futures.process import BrokenProcessPool
+from sleuth_sklearn.estimator import SLEUTH
+from ursa.utils.file_lock import file_lock
+
+# Seconds between status updates of a running job.
+JOB_POLL_SECONDS = float(os.environ.get("URSA_JOB_POLL_SECONDS", 2))
+
+# Running jobs whose status has not been updated for this many seconds
+# are reported as lost, e.g. after a server restart.
+JOB_STALE_SECONDS = max(60.0, 10 * JOB_POLL_SECONDS)
+
+# Maximum number of prediction scenarios run concurrently. Each worker
+# returns a float64 grid for every simulated year, so the default is
+# kept small.
+SCENARIO_MAX_WORKERS = int(os.environ.get("URSA_SCENARIO_MAX_WORKERS", 4))
+
+JOBS_DIR = "calibration"
+
+# SLEUTH coefficients searched during calibration.
+COEFFICIENTS = ["diffusion", "breed", "spread", "slope", "road"]
+
+_JOB_RE = re.compile(r"[0-9a-f]{32}")
+
+
+def new_job_id():
+    """Returns a random ID for a calibration job."""
+    return os.urandom(16).hex()
+
+
+def job_path(path_cache, job_id):
+    """Returns the path of the status file of job_id.
+
+    Raises
+    ------
+    ValueError
+        If job_id is not a valid job ID.
+    """
+
+    if not isinstance(job_id, str) or not _JOB_RE.fullmatch(job_id):
+        raise ValueError(f"Invalid job ID {job_id!r}.")
+    return path_cache / JOBS_DIR / f"{job_id}.json"
+
+
+def read_status(path_cache, job_id):
+    """Returns the status dictionary of job_id, None if not found.
+
+    Running jobs not updated for JOB_STALE_SECONDS are reported with
+    status "lost".
+    """
+
+    fpath = job_path(path_cache, job_id)
+    try:
+        with open(fpath, "r", encoding="utf8") as f:
+            status = json.load(f)
+    except (OSError, ValueError):
+        return None
+
+    if (
+        status["status"] == "running"
+        and time.time() - status["updated"] > JOB_STALE_SECONDS
+    ):
+        status["status"] = "lost"
+
+    return status
+
+
+def _save_status(fpath, status):
+    tmp_path = fpath.with_name(f"{fpath.name}.{os.getpid()}.tmp")
+    with open(tmp_path, "w", encoding="utf8") as f:
+        json.dump(status, f)
+    os.replace(tmp_path, fpath)
+
+
+def write_status(path_cache, job_id, **fields):
+    """Updates the status file of job_id with fields.
+
+    Cancelled jobs are not updated, so a job cancelled from another
+    process cannot overwrite its final status.
+
+    Returns
+    -------
+    status : dict
+        The updated status, or the current one if the job was cancelled.
+    """
+
+    fpath = job_path(path_cache, job_id)
+    fpath.parent.mkdir(parents=True, exist_ok=True)
+
+    with file_lock(fpath.with_suffix(".lock")):
+        status = read_status(path_cache, job_id) or {"job_id": job_id}
+        if status.get("status") == "cancelled":
+            return status
+        status.update(fields, updated=time.time())
+        _save_status(fpath, status)
+
+    return status
+
+
+def cancel_job(path_cache, job_id):
+    """Marks a running or lost job as cancelled, its final status.
+
+    The job process may already be stopped, e.g. by the background
+    callback manager, so the elapsed time is set here.
+
+    Returns
+    -------
+    status : dict
+        The cancelled status, None if the job was not running.
+    """
+
+    fpath = job_path(path_cache, job_id)
+
+    with file_lock(fpath.with_suffix(".lock")):
+        status = read_status(path_cache, job_id)
+        if status is None or status["status"] not in ("running", "lost"):
+            return None
+        now = time.time()
+        status.update(status="cancelled", elapsed=now - status["started"], updated=now)
+        _save_status(fpath, status)
+
+    return status
+
+
+def n_combinations(n_refinement_iters, n_refinement_splits):
+    """Returns the number of coefficient combinations evaluated by a
+    calibration grid search."""
+    return n_refinement_iters * n_refinement_splits ** len(COEFFICIENTS)
+
+
+def seconds_per_unit(path_cache):
+    """Returns the speed of the latest finished calibration of the city,
+    in seconds per unit of work, None if there is none."""
+
+    latest = None
+    for fpath in (path_cache / JOBS_DIR).glob("*.json"):
+        status = read_status(path_cache, fpath.stem)
+        if status is None or status["status"] != "done":
+            continue
+        if latest is None or status["updated"] > latest["updated"]:
+            latest = status
+
+    if latest is None:
+        return None
+    return latest["elapsed"] / latest["units"]
+
+
+def run_calibration(
+    model, urban, years, out_dir, path_cache, job_id, set_progress=None
+):
+    """Fits model, tracking the job in its status file.
+
+    The model is fitted in a separate thread while the calling thread
+    updates the status every JOB_POLL_SECONDS, passing it to
+    set_progress. If the status is set to "cancelled" by another
+    process, the job stops waiting for the fit and returns.
+
+    Parameters
+    ----------
+    model : SLEUTH
+        Unfitted model.
+    urban : np.ndarray
+        Urban grids of the calibration years.
+    years : np.ndarray
+        Calibration years.
+    out_dir : Path
+        Output directory of SLEUTH.fit.
+    path_cache : Path
+        City cache directory.
+    job_id : str
+        ID of the job, see new_job_id.
+    set_progress : callable
+        Called with the status dictionary on every update.
+
+    Returns
+    -------
+    status : dict
+        Final status. Fitted coefficients are in status["coefficients"]
+        if status["status"] is "done".
+    """
+
+    combinations = n_combinations(model.n_refinement_iters, model.n_refinement_splits)
+    units = combinations * model.n_iters * len(years)
+    speed = seconds_per_unit(path_cache)
+    estimated = None if speed is None else speed * units
+
+    start = time.time()
+    status = write_status(
+        path_cache,
+        job_id,
+        status="running",
+        started=start,
+        elapsed=0.0,
+        combinations=combinations,
+        n_iters=model.n_iters,
+        n_years=len(years),
+        units=units,
+        estimated=estimated,
+        coefficients=None,
+        error=None,
+    )
+
+    errors = []
+
+    def fit():
+        try:
+            model.fit(urban, years, out_dir)
+        except Exception as e:
+            errors.append(e)
+
+    # A daemon thread does not keep the job process alive once the job
+    # returns, e.g. after being cancelled
+    thread = threading.Thread(target=fit, daemon=True)
+    thread.start()
+
+    while thread.is_alive():
+        if set_progress is not None:
+            set_progress(status)
+        thread.join(JOB_POLL_SECONDS)
+
+        status = write_status(path_cache, job_id, elapsed=time.time() - start)
+        if status["status"] == "cancelled":
+            return status
+
+    elapsed = time.time() - start
+    if errors:
+        status = write_status(
+            path_cache, job_id, status="failed", error=repr(errors[0])
+        )
+        if status["status"] == "cancelled":
+            return status
+        raise errors[0]
+
+    coefficients = {}
+    for field in COEFFICIENTS:
+        value = getattr(model, f"coef_{field}_")
+        # numpy scalars are not JSON serializable
+        coefficients[field] = value.item() if hasattr(value, "item") else value
+
+    return write_status(
+        path_cache,
+        job_id,
+        status="done",
+        elapsed=elapsed,
+        coefficients=coefficients,
+    )
+
+
+def predict_scenario(
+    grids, seed_grid, coefficients, num_years, n_iters, crit_slope, random_state
+):
+    """Runs a SLEUTH prediction with fixed coefficients.
+
+    Parameters
+    ----------
+    grids : dict
+        Processed grids, with the keyword names of the SLEUTH grids
+        (grid_slope, grid_excluded, grid_roads, grid_roads_i,
+        grid_roads_j and grid_roads_dist).
+    seed_grid : np.ndarray
+        Boolean urban grid of the starting year.
+    coefficients : dict
+        Value of each coefficient in COEFFICIENTS.
+    num_years : int
+        Number of years to simulate.
+    n_iters : int
+        Number of Monte Carlo iterations.
+    crit_slope : float
+        Critical slope.
+    random_state : int
+        Seed of the simulation.
+
+    Returns
+    -------
+    grid : np.ndarray
+        Urbanization probabilities of shape (num_years, height, width).
+    """
+
+    model = SLEUTH(
+        n_iters=n_iters,
+        crit_slope=crit_slope,
+        random_state=random_state,
+        **grids,
+    )
+    for field in COEFFICIENTS:
+        setattr(model, f"coef_{field}_", coefficients[field])
+
+    grid, _, _ = model.predict(seed_grid, num_years)
+    return grid
+
+
+def _predict_scenario_shared(specs, index, coefficients, kwargs):
+    """Worker for run_scenarios, runs predict_scenario on the grids in
+    the shared memory blocks described by specs."""
+
+    blocks = []
+    arrays = {}
+    try:
+        for key, spec in specs.items():
+            shm, arrays[key] = sa.from_shared(spec, readonly=True)
+            blocks.append(shm)
+        # The seed is small, a private copy is safe to modify
+        seed_grid = arrays.pop("seed_grid").copy()
+        grid = predict_scenario(arrays, seed_grid, coefficients, **kwargs)
+        # Views must be released before closing the blocks
+        del arrays
+    finally:
+        for shm in blocks:
+            shm.close()
+
+    return index, grid
+
+
+def run_scenarios(
+    grids,
+    seed_grid,
+    scenarios,
+    num_years,
+    n_iters,
+    crit_slope,
+    random_state,
+    max_workers=None,
+):
+    """Runs predict_scenario for every scenario in a long-lived process
+    pool.
+
+    Parameters
+    ----------
+    grids, seed_grid, num_years, n_iters, crit_slope, random_state
+        Shared by all scenarios, see predict_scenario.
+    scenarios : list of dict
+        Coefficients of each scenario.
+    max_workers : int
+        Size of the pool, the maximum number of scenarios run
+        concurrently. Defaults to SCENARIO_MAX_WORKERS.
+
+    Yields
+    ------
+    index, grid : int, np.ndarray
+        Index of a scenario in scenarios and its predicted grid, in the
+        order in which scenarios finish.
+    """
+
+    if max_workers is None:
+        max_workers = SCENARIO_MAX_WORKERS
+    max_workers = max(1, max_workers)
+
+    kwargs = dict(
+        num_years=num_years,
+        n_iters=n_iters,
+        crit_slope=crit_slope,
+        random_state=random_state,
+    )
+
+    blocks = []
+    specs = {}
+    futures = []
+    try:
+        for key, array in {**grids, "seed_grid": seed_grid}.items():
+            shm, specs[key] = sa.to_shared(array)
+            blocks.append(shm)
+
+        executor = pp.get_executor("sleuth_scenarios", max_workers)
+        futures = [
+            executor.submit(_predict_scenario_shared, specs, i, coefficients, kwargs)
+            for i, coefficients in enumerate(scenarios)
+        ]
+        try:
+            for future in as_completed(futures):
+                yield future.result()
+        except BrokenProcessPool:
+            pp.reset_executor("sleuth_scenarios", executor)
+            raise
+    finally:
+        # Scenarios not started yet, e.g. if the caller stops early
+        for future in futures:
+            future.cancel()
+        for shm in blocks:
+            shm.close()
+            shm.unlink()
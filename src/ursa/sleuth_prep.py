@@ -1,4 +1,5 @@
 import ee
+import hashlib
 import json
 import requests
 
@@ -8,25 +9,24 @@ import osmnx as ox
 import rioxarray as rxr
 import ursa.degree_of_urbanization as dou
 import ursa.ghsl as ghsl
+import ursa.pipeline as pl
+import ursa.utils.cache_manager as cm
 import ursa.utils.geometry as ug
 import ursa.utils.raster as ru
 import xarray as xr
 
 from geocube.api.core import make_geocube
 from rasterio.enums import Resampling
-from scipy.spatial import KDTree
+from scipy.ndimage import distance_transform_cdt, distance_transform_edt
 
 
 def load_or_prep_rasters(bbox_mollweide, path_cache):
-    all_exist = True
-    for path in ["urban", "roads", "slope", "excluded", "years"]:
-        full_path = path_cache / f"{path}.npy"
-        all_exist &= full_path.exists()
+    """Builds the SLEUTH input arrays that are missing or whose inputs
+    changed, see ARTIFACTS."""
 
-    all_exist &= (path_cache / "attributes.json").exists()
-
-    if not all_exist:
-        prep_rasters(bbox_mollweide, path_cache)
+    graph = {**ghsl.ARTIFACTS, **dou.ARTIFACTS, **ARTIFACTS}
+    context = {"bbox_mollweide": bbox_mollweide, "path_cache": path_cache}
+    pl.run(graph, list(ARTIFACTS), context)
 
     return True
 
@@ -37,31 +37,10 @@ def bbox_to_latlon(bbox_mollweide, crs):
     return bbox_latlon
 
 
-def prep_rasters(bbox_mollweide, path_cache):
-    """SLEUTH inputs are_
-    - urban history
-    - slope
-    - water + protected areas = excluded
-    - roads
-
-    For calibration, the earliest urban year is used as the seed, and
-    subsequent urban layers, or control years, are used to measure
-    several statistical best fit values. For this reason, at least
-    four urban layers are needed for calibration: one for
-    initialization and three additional for a least-squares
-    calculation.
+def load_urban(bbox_mollweide, path_cache):
+    """Loads the historic urbanization, obtained from GHSL + DoU
+    processing, as SLEUTH urban layers."""
 
-    The expected values are 0: non-urbanized, 1: urbanized
-    """
-
-    # We also need a lat lon bbox that covers all the mollweide bbox
-    # to get data from GEE
-
-    bbox_latlon = bbox_to_latlon(bbox_mollweide, "ESRI:54009")
-    bbox_ee = ru.bbox_to_ee(bbox_latlon)
-
-    # Historic urbanization, obtained from GHSL + DoU processing
-    # Extract last 20 years or urbanization for 5 calibration points
     dou_xr = dou.load_or_process_dou(bbox_mollweide, path_cache)
     dou_xr = dou_xr.astype("int32")
     dou_xr.name = "urban"
@@ -72,26 +51,16 @@ def prep_rasters(bbox_mollweide, path_cache):
     assert dou_xr.max() >= 1
     assert len(urban_years) >= 4
 
-    # World Cover
-    print("Loading WorldCover")
-    load_worldcover(bbox_ee, path_cache, dou_xr)
-    print("End Loading WorldCover")
+    return dou_xr
 
-    # Slope and protected areas are obtained from GEE
-    slope_xr = load_slope(bbox_ee, path_cache, dou_xr)
 
-    excluded_xr = load_excluded(bbox_ee, bbox_mollweide, path_cache, dou_xr)
+def prep_urban(bbox_mollweide, path_cache):
+    """Saves urban layers, years and raster attributes."""
 
-    # The road network is downloaded from OSM and further processed
-    # into a set of auxiliary arrays with precomputed distances.
-    geocube = bbox_to_geocube(bbox_latlon, path_cache, dou_xr)
-    roads, *_ = load_roads(geocube)
+    dou_xr = load_urban(bbox_mollweide, path_cache)
 
-    np.save(path_cache / "years", urban_years)
+    np.save(path_cache / "years", dou_xr.coords["year"].values)
     np.save(path_cache / "urban", dou_xr.values)
-    np.save(path_cache / "roads", roads.values)
-    np.save(path_cache / "slope", slope_xr.values)
-    np.save(path_cache / "excluded", excluded_xr.values)
 
     attr_dict = dict(
         years=[int(year) for year in dou_xr.year.values],
@@ -104,6 +73,107 @@ def prep_rasters(bbox_mollweide, path_cache):
     with open(path_cache / "attributes.json", "w", encoding="utf8") as f:
         json.dump(attr_dict, f)
 
+    cm.register(
+        path_cache / "years.npy",
+        path_cache / "urban.npy",
+        path_cache / "attributes.json",
+        producer=prep_urban,
+    )
+
+
+def prep_worldcover(bbox_mollweide, path_cache):
+    """Saves World Cover matched to the urban layers grid."""
+
+    dou_xr = load_urban(bbox_mollweide, path_cache)
+    bbox_ee = ru.bbox_to_ee(bbox_to_latlon(bbox_mollweide, "ESRI:54009"))
+
+    print("Loading WorldCover")
+    load_worldcover(bbox_ee, path_cache, dou_xr)
+    print("End Loading WorldCover")
+
+    cm.register(
+        path_cache / "worldcover.tif",
+        path_cache / "worldcover.npy",
+        producer=prep_worldcover,
+    )
+
+
+def prep_slope(bbox_mollweide, path_cache):
+    """Saves slope matched to the urban layers grid."""
+
+    dou_xr = load_urban(bbox_mollweide, path_cache)
+    bbox_ee = ru.bbox_to_ee(bbox_to_latlon(bbox_mollweide, "ESRI:54009"))
+
+    # Slope is obtained from GEE
+    slope_xr = load_slope(bbox_ee, path_cache, dou_xr)
+    np.save(path_cache / "slope", slope_xr.values)
+
+    cm.register(path_cache / "slope.tif", path_cache / "slope.npy", producer=prep_slope)
+
+
+def prep_excluded(bbox_mollweide, path_cache):
+    """Saves excluded areas matched to the urban layers grid."""
+
+    dou_xr = load_urban(bbox_mollweide, path_cache)
+    bbox_ee = ru.bbox_to_ee(bbox_to_latlon(bbox_mollweide, "ESRI:54009"))
+
+    # Protected areas are obtained from GEE
+    excluded_xr = load_excluded(bbox_ee, bbox_mollweide, path_cache, dou_xr)
+    np.save(path_cache / "excluded", excluded_xr.values)
+
+    cm.register(
+        path_cache / "protected.tif",
+        path_cache / "excluded.npy",
+        producer=prep_excluded,
+    )
+
+
+def prep_roads(bbox_mollweide, path_cache):
+    """Saves the road network rasterized on the urban layers grid."""
+
+    dou_xr = load_urban(bbox_mollweide, path_cache)
+    bbox_latlon = bbox_to_latlon(bbox_mollweide, "ESRI:54009")
+
+    # The road network is downloaded from OSM and further processed
+    # into a set of auxiliary arrays with precomputed distances.
+    geocube = bbox_to_geocube(bbox_latlon, path_cache, dou_xr)
+    roads, *_ = load_roads(geocube)
+    np.save(path_cache / "roads", roads.values)
+
+    cm.register(
+        path_cache / "road_network.graphml",
+        path_cache / "roads.gpkg",
+        path_cache / "roads.npy",
+        producer=prep_roads,
+    )
+
+
+def prep_rasters(bbox_mollweide, path_cache):
+    """SLEUTH inputs are_
+    - urban history
+    - slope
+    - water + protected areas = excluded
+    - roads
+
+    For calibration, the earliest urban year is used as the seed, and
+    subsequent urban layers, or control years, are used to measure
+    several statistical best fit values. For this reason, at least
+    four urban layers are needed for calibration: one for
+    initialization and three additional for a least-squares
+    calculation.
+
+    The expected values are 0: non-urbanized, 1: urbanized
+
+    Each input is prepared by its own prep_* function, which is also
+    used by the pipeline artifacts in ARTIFACTS.
+    """
+
+    prep_urban(bbox_mollweide, path_cache)
+    prep_worldcover(bbox_mollweide, path_cache)
+    prep_slope(bbox_mollweide, path_cache)
+    prep_excluded(bbox_mollweide, path_cache)
+    prep_roads(bbox_mollweide, path_cache)
+
 
 def load_excluded(bbox_ee, bbox_mollweide, path_cache, raster_to_match):
     """Loads rasters denoting excluded areas.
@@ -339,31 +409,58 @@ def bbox_to_geocube(bbox, path_cache, raster_to_match):
     return roads
 
 
+def nearest_roads(roads, d_metric=np.inf):
+    """Finds the nearest road pixel of every pixel with a distance
+    transform.
+
+    Parameters
+    ----------
+    roads : np.ndarray
+        Roads raster, road pixels are > 0.
+    d_metric : float
+        Minkowski p of the distance, np.inf for chebyshev distance
+        (moore neighborhood), 1 for manhattan distance and 2 for
+        euclidean distance.
+
+    Returns
+    -------
+    road_i, road_j : np.ndarray
+        Row and column of the nearest road pixel.
+    road_dist : np.ndarray
+        Distance to the nearest road pixel, truncated to int.
+    """
+
+    # Road pixels are the background (zeros) of the transform,
+    # indices point to the nearest of them
+    not_road = roads == 0
+    if d_metric == np.inf:
+        road_dist, (road_i, road_j) = distance_transform_cdt(
+            not_road, metric="chessboard", return_indices=True
+        )
+    elif d_metric == 1:
+        road_dist, (road_i, road_j) = distance_transform_cdt(
+            not_road, metric="taxicab", return_indices=True
+        )
+    elif d_metric == 2:
+        road_dist, (road_i, road_j) = distance_transform_edt(
+            not_road, return_indices=True
+        )
+    else:
+        raise ValueError(f"Unsupported d_metric {d_metric}, use np.inf, 1 or 2.")
+
+    return (
+        road_i.astype(np.int32),
+        road_j.astype(np.int32),
+        road_dist.astype(np.int32),
+    )
+
+
 def derive_auxiliary_roads(roads, d_metric=np.inf):
     roads = roads.copy()
 
-    # Remove roads from border to avoid neighbor lookup out of bounds
-    roads.values[0, :] = 0
-    roads.values[:, 0] = 0
-    roads.values[-1, :] = 0
-    roads.values[:, -1] = 0
-
-    # Create bands with nearest roads indices
-    road_idx = np.column_stack(np.where(roads.values > 0))
-    # KDtree for fast neighbor lookup
-    tree = KDTree(road_idx)
-    # Explicitly create raster grid
-    I, J = roads.values.shape
-    grid_i, grid_j = np.meshgrid(range(I), range(J), indexing="ij")
-    # Get coordinate pairs (i,j) to loop over
-    coords = np.column_stack([grid_i.ravel(), grid_j.ravel()])
-    # Find nearest road for every lattice point
-    # p=inf is chebyshev distance (moore neighborhood)
-    dist, idxs = tree.query(coords, p=d_metric)
-    # Create bands
-    dist = dist.reshape(roads.shape).astype(np.int32)
-    road_i = road_idx[:, 0][idxs].reshape(roads.shape).astype(np.int32)
-    road_j = road_idx[:, 1][idxs].reshape(roads.shape).astype(np.int32)
+    roads.values, road_i, road_j, dist = derive_auxiliary_roads_numpy(
+        roads.values, d_metric=d_metric
+    )
 
     roads.name = "roads"
     road_i = roads.copy(data=road_i)
@@ -385,22 +482,69 @@ def derive_auxiliary_roads_numpy(roads, d_metric=np.inf):
     roads[-1, :] = 0
     roads[:, -1] = 0
 
-    # Create bands with nearest roads indices
-    road_idx = np.column_stack(np.where(roads > 0))
-    # KDtree for fast neighbor lookup
-    tree = KDTree(road_idx)
-    # Explicitly create raster grid
-    I, J = roads.shape
-    grid_i, grid_j = np.meshgrid(range(I), range(J), indexing="ij")
-    # Get coordinate pairs (i,j) to loop over
-    coords = np.column_stack([grid_i.ravel(), grid_j.ravel()])
-    # Find nearest road for every lattice point
-    # p=inf is chebyshev distance (moore neighborhood)
-    road_dist, idxs = tree.query(coords, p=d_metric)
-    # Create bands
-    road_dist = road_dist.reshape(roads.shape).astype(np.int32)
-    road_i = road_idx[:, 0][idxs].reshape(roads.shape).astype(np.int32)
-    road_j = road_idx[:, 1][idxs].reshape(roads.shape).astype(np.int32)
+    # Create bands with nearest roads indices and distances
+    road_i, road_j, road_dist = nearest_roads(roads, d_metric=d_metric)
+
+    return roads, road_i, road_j, road_dist
+
+
+def roads_key(roads, d_metric=np.inf):
+    """Returns a hash of the contents of a roads grid and the distance
+    metric, used to identify its cached auxiliary grids."""
+
+    roads = np.ascontiguousarray(roads)
+    h = hashlib.sha256()
+    h.update(f"{roads.shape}{roads.dtype.str}{d_metric}".encode())
+    h.update(roads.tobytes())
+    return h.hexdigest()
+
+
+def load_or_derive_auxiliary_roads(roads, path_cache, d_metric=np.inf):
+    """Loads the auxiliary road grids of roads from path_cache, deriving
+    and saving them with derive_auxiliary_roads_numpy if not found.
+
+    Auxiliary grids are keyed by the contents of roads, so edited or
+    uploaded road grids are cached as separate entries next to the
+    original roads.npy.
+
+    Parameters
+    ----------
+    roads : np.ndarray
+        Grid with road weights.
+    path_cache : Path
+        City cache directory.
+    d_metric : float
+        Order of the distance metric, see nearest_roads.
+
+    Returns
+    -------
+    roads, road_i, road_j, road_dist : np.ndarray
+        Outputs of derive_auxiliary_roads_numpy.
+    """
+
+    key = roads_key(roads, d_metric)
+    fpath = path_cache / f"roads_aux_{key[:16]}.npz"
+
+    if cm.lookup(fpath):
+        with np.load(fpath) as npz:
+            # Guard against prefix collisions
+            if npz["key"].item() == key:
+                return npz["roads"], npz["road_i"], npz["road_j"], npz["road_dist"]
+
+    roads, road_i, road_j, road_dist = derive_auxiliary_roads_numpy(
+        roads, d_metric=d_metric
+    )
+
+    path_cache.mkdir(parents=True, exist_ok=True)
+    np.savez(
+        fpath,
+        key=np.array(key),
+        roads=roads,
+        road_i=road_i,
+        road_j=road_j,
+        road_dist=road_dist,
+    )
+    cm.register(fpath, producer=load_or_derive_auxiliary_roads)
 
     return roads, road_i, road_j, road_dist
 
@@ -593,3 +737,39 @@ def create_scenario_file(
     f.close()
 
     return fpath
+
+
+def _city_args(context):
+    return context["bbox_mollweide"], context["path_cache"]
+
+
+# SLEUTH input arrays as pipeline artifacts. Raw downloads (worldcover.tif,
+# slope.tif, protected.tif and the OSM road network) are reused by the
+# load_* functions and are not rebuilt when the DoU raster changes.
+ARTIFACTS = {
+    "sleuth_urban": pl.artifact(
+        ["urban.npy", "years.npy", "attributes.json"],
+        lambda context: prep_urban(*_city_args(context)),
+        inputs=["dou"],
+    ),
+    "worldcover": pl.artifact(
+        ["worldcover.npy"],
+        lambda context: prep_worldcover(*_city_args(context)),
+        inputs=["dou"],
+    ),
+    "sleuth_slope": pl.artifact(
+        ["slope.npy"],
+        lambda context: prep_slope(*_city_args(context)),
+        inputs=["dou"],
+    ),
+    "sleuth_excluded": pl.artifact(
+        ["excluded.npy"],
+        lambda context: prep_excluded(*_city_args(context)),
+        inputs=["dou", "ghs_land"],
+    ),
+    "sleuth_roads": pl.artifact(
+        ["roads.npy"],
+        lambda context: prep_roads(*_city_args(context)),
+        inputs=["dou"],
+    ),
+}
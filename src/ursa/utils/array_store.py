@@ -0,0 +1,231 @@
+"""Server side store for the arrays edited in the browser.
+
+Arrays are saved as .npy files under path_cache/arrays, named after a
+digest of their contents, and the browser only keeps a small handle
+dictionary in its dcc.Store. Since the name depends on the contents,
+the key of a handle also works as its version: editing an array
+produces a new handle, while storing the same array again reuses the
+existing file.
+
+Arrays are loaded back memory-mapped and read-only, and the most
+recently used ones are kept open in an in-process LRU.
+
+SLEUTH predictions are stored per run under path_cache/predictions, one
+compressed .npz file per scenario with one member per simulated year,
+so a single year can be read without decompressing the whole scenario.
+The browser only keeps the random ID of the run.
+"""
+
+import hashlib
+import os
+import re
+import threading
+import uuid
+
+from collections import OrderedDict
+
+import numpy as np
+import ursa.utils.cache_manager as cm
+
+ARRAYS_DIR = "arrays"
+PREDICTIONS_DIR = "predictions"
+
+# Maximum number of memory-mapped arrays kept open.
+ARRAY_STORE_MAX_ITEMS = int(os.environ.get("URSA_ARRAY_STORE_MAX_ITEMS", 32))
+
+_CITY_RE = re.compile(r"-?\d+")
+_KEY_RE = re.compile(r"[0-9a-f]{64}")
+_RUN_RE = re.compile(r"[0-9a-f]{32}")
+
+_lru = OrderedDict()
+_lock = threading.Lock()
+
+
+def array_key(arr):
+    """Returns a sha256 digest of the shape, dtype and contents of arr."""
+
+    arr = np.ascontiguousarray(arr)
+    h = hashlib.sha256()
+    h.update(f"{arr.shape}{arr.dtype.str}".encode())
+    h.update(arr.tobytes())
+    return h.hexdigest()
+
+
+def handle_path(handle):
+    """Returns the path of the file referenced by handle.
+
+    Handles come from the browser, so both the city and the key are
+    validated before building the path.
+
+    Raises
+    ------
+    ValueError
+        If handle is not a valid handle.
+    """
+
+    if not isinstance(handle, dict):
+        raise ValueError(f"Invalid array handle {handle!r}.")
+
+    city = str(handle.get("city"))
+    key = str(handle.get("key"))
+    if not _CITY_RE.fullmatch(city) or not _KEY_RE.fullmatch(key):
+        raise ValueError(f"Invalid array handle {handle!r}.")
+
+    fpath = cm.CACHE_DIR / city / ARRAYS_DIR / f"{key}.npy"
+    if cm.CACHE_DIR.resolve() not in fpath.resolve().parents:
+        raise ValueError(f"Invalid array handle {handle!r}.")
+
+    return fpath
+
+
+def put(arr, id_hash):
+    """Stores arr in the cache of the city id_hash.
+
+    Parameters
+    ----------
+    arr : np.ndarray
+        Array to store.
+    id_hash : int or str
+        Hash of the city bounding box.
+
+    Returns
+    -------
+    handle : dict
+        JSON serializable handle with the city, key, shape and dtype of
+        the array, to be kept in a dcc.Store.
+    """
+
+    arr = np.asarray(arr)
+    handle = {
+        "city": str(id_hash),
+        "key": array_key(arr),
+        "shape": list(arr.shape),
+        "dtype": arr.dtype.str,
+    }
+
+    fpath = handle_path(handle)
+    if not cm.lookup(fpath):
+        fpath.parent.mkdir(parents=True, exist_ok=True)
+        # Written under a temporary name so concurrent readers never see
+        # a partial file
+        tmp_path = fpath.with_name(f"{fpath.stem}.{uuid.uuid4().hex}.tmp.npy")
+        np.save(tmp_path, arr)
+        os.replace(tmp_path, fpath)
+        cm.register(fpath, producer=put)
+
+    return handle
+
+
+def get(handle):
+    """Loads the array referenced by handle.
+
+    Returns
+    -------
+    arr : np.memmap
+        Read-only memory-mapped array.
+
+    Raises
+    ------
+    ValueError
+        If handle is not a valid handle.
+    FileNotFoundError
+        If the array is not in the cache, e.g. after being evicted.
+    """
+
+    fpath = handle_path(handle)
+
+    with _lock:
+        if fpath in _lru:
+            _lru.move_to_end(fpath)
+            return _lru[fpath]
+
+    if not cm.lookup(fpath):
+        raise FileNotFoundError(f"Array {handle['key']} not found in cache.")
+    arr = np.load(fpath, mmap_mode="r")
+
+    with _lock:
+        _lru[fpath] = arr
+        while len(_lru) > ARRAY_STORE_MAX_ITEMS:
+            _lru.popitem(last=False)
+
+    return arr
+
+
+def new_run_id():
+    """Returns a random ID for a prediction run."""
+    return os.urandom(16).hex()
+
+
+def scenario_path(id_hash, run_id, index):
+    """Returns the path of scenario index of a prediction run.
+
+    Raises
+    ------
+    ValueError
+        If id_hash, run_id or index are not valid.
+    """
+
+    city = str(id_hash)
+    run_id = str(run_id)
+    if not _CITY_RE.fullmatch(city) or not _RUN_RE.fullmatch(run_id):
+        raise ValueError(f"Invalid prediction run {run_id!r}.")
+    if isinstance(index, bool) or not isinstance(index, int) or index < 0:
+        raise ValueError(f"Invalid scenario {index!r}.")
+
+    return cm.CACHE_DIR / city / PREDICTIONS_DIR / run_id / f"scenario_{index}.npz"
+
+
+def put_scenario(id_hash, run_id, index, grid, years):
+    """Saves the predicted grids of a scenario.
+
+    Parameters
+    ----------
+    id_hash : int or str
+        Hash of the city bounding box.
+    run_id : str
+        ID of the prediction run, see new_run_id.
+    index : int
+        Index of the scenario within the run.
+    grid : np.ndarray
+        Array of shape (years, height, width) with urbanization
+        probabilities.
+    years : list of int
+        Simulated years, one per band of grid.
+    """
+
+    fpath = scenario_path(id_hash, run_id, index)
+    fpath.parent.mkdir(parents=True, exist_ok=True)
+
+    bands = {f"year_{year}": band for year, band in zip(years, grid)}
+    np.savez_compressed(fpath, years=np.asarray(years), **bands)
+    cm.register(fpath, producer=put_scenario)
+
+
+def scenario_years(id_hash, run_id, index):
+    """Returns the list of simulated years of a saved scenario."""
+
+    fpath = scenario_path(id_hash, run_id, index)
+    if not cm.lookup(fpath):
+        raise FileNotFoundError(f"Scenario {index} of run {run_id} not found.")
+
+    with np.load(fpath) as npz:
+        return npz["years"].tolist()
+
+
+def iter_scenario(id_hash, run_id, index):
+    """Yields (year, grid) pairs of a saved scenario, reading one year at
+    a time.
+
+    Raises
+    ------
+    FileNotFoundError
+        If the scenario is not in the cache, e.g. after being evicted.
+    """
+
+    fpath = scenario_path(id_hash, run_id, index)
+    if not cm.lookup(fpath):
+        raise FileNotFoundError(f"Scenario {index} of run {run_id} not found.")
+
+    with np.load(fpath) as npz:
+        for year in npz["years"].tolist():
+            yield year, npz[f"year_{year}"]
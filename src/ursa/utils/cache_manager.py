@@ -0,0 +1,326 @@
+"""Bookkeeping and eviction for the per city cache in data/cache.
+
+Every file produced by a load_or_* function is recorded in a manifest at
+the root of the cache, together with its creation time, last hit, size
+and producer function. Whenever a new file is registered, files older
+than the maximum age and, after that, the least recently used files are
+evicted until the total size of the cache fits in the budget. Files
+registered together form a group and are evicted together, so files
+read next to each other are never split.
+
+The manifest is shared by every process using the cache (Dash workers,
+background callbacks and process pools), so it is only read and written
+while holding a lock file next to it.
+
+Evicted files are simply produced again by their load_or_* function the
+next time they are requested.
+"""
+
+import json
+import logging
+import os
+import time
+
+from pathlib import Path
+from ursa.utils.file_lock import file_lock
+
+CACHE_DIR = Path(os.environ.get("URSA_CACHE_DIR", "./data/cache"))
+
+MANIFEST_NAME = "manifest.json"
+LOCK_NAME = "manifest.lock"
+
+# Total size budget of the cache in bytes.
+MAX_BYTES = int(float(os.environ.get("URSA_CACHE_MAX_GB", 20)) * 1024**3)
+
+# Maximum time in seconds since the last hit before a file is evicted.
+# A value of 0 disables age based eviction.
+MAX_AGE = float(os.environ.get("URSA_CACHE_MAX_AGE_DAYS", 0)) * 24 * 3600
+
+logger = logging.getLogger(__name__)
+
+
+def _manifest_path():
+    return CACHE_DIR / MANIFEST_NAME
+
+
+def _manifest_lock():
+    """Returns the manifest lock, held across threads and processes and
+    reentrant within a thread."""
+    CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    return file_lock(CACHE_DIR / LOCK_NAME)
+
+
+def _read_manifest():
+    fpath = _manifest_path()
+    if not fpath.exists():
+        return {}
+    try:
+        with open(fpath, "r", encoding="utf8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        # A corrupt manifest only loses bookkeeping, files are untouched
+        return {}
+
+
+def _write_manifest(manifest):
+    fpath = _manifest_path()
+    fpath.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = fpath.with_name(f"{fpath.name}.{os.getpid()}.tmp")
+    with open(tmp_path, "w", encoding="utf8") as f:
+        json.dump(manifest, f, ensure_ascii=False)
+    os.replace(tmp_path, fpath)
+
+
+def _entry_key(fpath):
+    """Returns the key of fpath in the manifest, its path relative to the
+    cache root, or None if fpath is outside of the cache."""
+    try:
+        return Path(fpath).resolve().relative_to(CACHE_DIR.resolve()).as_posix()
+    except ValueError:
+        return None
+
+
+def _is_temporary(key):
+    """Files in hidden directories, e.g. pipeline build directories, are
+    temporary links to other cached files."""
+    return any(part.startswith(".") for part in key.split("/")[:-1])
+
+
+def _producer_name(producer):
+    if producer is None:
+        return None
+    if callable(producer):
+        return f"{producer.__module__}.{producer.__qualname__}"
+    return str(producer)
+
+
+def _new_entry(fpath, producer, metadata, group=None):
+    now = time.time()
+    entry = {
+        "created": now,
+        "last_hit": now,
+        "bytes": Path(fpath).stat().st_size,
+        "producer": _producer_name(producer),
+        "group": group,
+    }
+    entry.update(metadata)
+    return entry
+
+
+def lookup(*fpaths):
+    """Checks if all files in fpaths are available in the cache.
+
+    If they are, their last hit time is updated. Existing files not yet
+    known by the manifest are added to it.
+
+    Parameters
+    ----------
+    *fpaths : Path
+        Paths of the cached files.
+
+    Returns
+    -------
+    found : bool
+        True if all the files exist.
+
+    """
+
+    if not all(Path(fpath).exists() for fpath in fpaths):
+        return False
+
+    with _manifest_lock():
+        manifest = _read_manifest()
+        now = time.time()
+        for fpath in fpaths:
+            key = _entry_key(fpath)
+            if key is None:
+                continue
+            if key in manifest:
+                manifest[key]["last_hit"] = now
+            elif not _is_temporary(key):
+                manifest[key] = _new_entry(fpath, None, {})
+        _write_manifest(manifest)
+
+    return True
+
+
+def register(*fpaths, producer=None, **metadata):
+    """Records freshly produced files in the manifest and evicts old
+    files if the cache is over budget.
+
+    Files that do not exist are skipped, so optional by-products of a
+    producer can be passed as well. Files registered together are
+    evicted together.
+
+    Parameters
+    ----------
+    *fpaths : Path
+        Paths of the produced files.
+    producer : callable or str
+        Function that produced the files.
+    **metadata
+        Additional JSON serializable metadata stored with each entry.
+
+    """
+
+    keys = [
+        key
+        for key in map(_entry_key, fpaths)
+        if key is not None and (CACHE_DIR / key).exists()
+    ]
+    group = keys[0] if len(keys) > 1 else None
+
+    with _manifest_lock():
+        manifest = _read_manifest()
+        for key in keys:
+            manifest[key] = _new_entry(CACHE_DIR / key, producer, metadata, group)
+        _write_manifest(manifest)
+
+        evict(keep=keys)
+
+
+def replace(src, dst):
+    """Moves the cached file src to dst with os.replace, moving its
+    manifest entry as well.
+
+    Used to publish files built under a temporary name, readers of dst
+    never see a missing or partial file.
+    """
+
+    src_key = _entry_key(src)
+    dst_key = _entry_key(dst)
+
+    with _manifest_lock():
+        os.replace(src, dst)
+        manifest = _read_manifest()
+        entry = manifest.pop(src_key, None) if src_key is not None else None
+        if dst_key is not None:
+            if entry is None:
+                entry = _new_entry(dst, None, {})
+            elif entry.get("group") is not None:
+                entry["group"] = _entry_key(
+                    Path(dst).parent / Path(entry["group"]).name
+                )
+            manifest[dst_key] = entry
+        _write_manifest(manifest)
+
+
+def evict(max_bytes=None, max_age=None, keep=()):
+    """Removes files from the cache until it fits in the size budget.
+
+    Files whose last hit is older than max_age are removed first, then
+    the least recently used files until the total size is below
+    max_bytes. Files registered together are removed together, using
+    the most recent hit of the group.
+
+    Parameters
+    ----------
+    max_bytes : int
+        Size budget in bytes. Defaults to MAX_BYTES.
+    max_age : float
+        Maximum age in seconds since the last hit. Defaults to MAX_AGE,
+        0 disables age based eviction.
+    keep : list of str
+        Manifest keys that must not be evicted, together with their
+        groups.
+
+    Returns
+    -------
+    evicted : list of str
+        Manifest keys of the evicted files.
+
+    """
+
+    if max_bytes is None:
+        max_bytes = MAX_BYTES
+    if max_age is None:
+        max_age = MAX_AGE
+
+    evicted = []
+    with _manifest_lock():
+        manifest = _read_manifest()
+
+        # Forget files removed by other means
+        for key in list(manifest):
+            if not (CACHE_DIR / key).exists():
+                manifest.pop(key)
+
+        groups = {}
+        for key, entry in manifest.items():
+            groups.setdefault(entry.get("group") or key, []).append(key)
+        kept_groups = {
+            manifest[key].get("group") or key for key in keep if key in manifest
+        }
+
+        now = time.time()
+        last_hits = {
+            group: max(manifest[key]["last_hit"] for key in keys)
+            for group, keys in groups.items()
+        }
+        total_bytes = sum(entry["bytes"] for entry in manifest.values())
+
+        for group in sorted(groups, key=last_hits.get):
+            if group in kept_groups:
+                continue
+            too_old = max_age > 0 and now - last_hits[group] > max_age
+            if not too_old and total_bytes <= max_bytes:
+                continue
+            for key in groups[group]:
+                try:
+                    (CACHE_DIR / key).unlink()
+                except FileNotFoundError:
+                    pass
+                total_bytes -= manifest.pop(key)["bytes"]
+                evicted.append(key)
+
+        _write_manifest(manifest)
+
+    if evicted:
+        logger.info("Evicted %d files from cache.", len(evicted))
+
+    return evicted
+
+
+def entries():
+    """Returns a copy of the manifest, a dictionary with the metadata of
+    every cached file keyed by its path relative to the cache root."""
+    with _manifest_lock():
+        return _read_manifest()
+
+
+def find_containing(bounds, **metadata):
+    """Searches the cache for files whose spatial extent contains bounds.
+
+    Only files registered with a "bounds" entry in their metadata are
+    considered. Bounds must be expressed in the same CRS as the cached
+    files, so the CRS is usually passed as part of metadata.
+
+    Parameters
+    ----------
+    bounds : tuple
+        Bounds (minx, miny, maxx, maxy) to be contained.
+    **metadata
+        Metadata values that the entries must match, e.g. the CRS,
+        dataset or resolution.
+
+    Returns
+    -------
+    fpaths : list of Path
+        Paths of the matching files, smallest extent first.
+
+    """
+
+    minx, miny, maxx, maxy = bounds
+
+    found = []
+    for key, entry in entries().items():
+        if "bounds" not in entry or _is_temporary(key):
+            continue
+        if any(entry.get(k) != v for k, v in metadata.items()):
+            continue
+        e_minx, e_miny, e_maxx, e_maxy = entry["bounds"]
+        if e_minx <= minx and e_miny <= miny and e_maxx >= maxx and e_maxy >= maxy:
+            area = (e_maxx - e_minx) * (e_maxy - e_miny)
+            found.append((area, CACHE_DIR / key))
+
+    return [fpath for _, fpath in sorted(found) if fpath.exists()]
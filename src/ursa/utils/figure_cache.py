@@ -0,0 +1,79 @@
+"""Compressed plotly figure cache inside the per city cache.
+
+Figures are stored as gzipped plotly JSON under path_cache/figures,
+named after their kind and the version of the code that produced them.
+The version is a digest of the source file of the producer, so editing
+a plotting function invalidates its cached figures.
+"""
+
+import gzip
+import hashlib
+import inspect
+import json
+import os
+import uuid
+
+from functools import lru_cache
+
+import ursa.utils.cache_manager as cm
+
+FIGURES_DIR = "figures"
+
+
+@lru_cache(maxsize=None)
+def _file_digest(fpath):
+    with open(fpath, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()[:12]
+
+
+def code_version(producer):
+    """Returns a short digest of the source file defining producer."""
+    return _file_digest(inspect.getsourcefile(producer))
+
+
+def figure_path(path_cache, kind, producer):
+    return path_cache / FIGURES_DIR / f"{kind}_{code_version(producer)}.json.gz"
+
+
+def load_or_build_figure(path_cache, kind, build, producer=None):
+    """Loads a cached figure or builds and caches it.
+
+    Parameters
+    ----------
+    path_cache : Path
+        Path to the city cache.
+    kind : str
+        Name identifying the figure within the city.
+    build : callable
+        Function without arguments returning a plotly Figure.
+    producer : callable
+        Plotting function whose source defines the code version.
+        Defaults to build.
+
+    Returns
+    -------
+    fig : dict
+        Plotly figure as a dictionary, ready to be sent to a
+        dcc.Graph.
+
+    """
+
+    if producer is None:
+        producer = build
+
+    fpath = figure_path(path_cache, kind, producer)
+    if cm.lookup(fpath):
+        with gzip.open(fpath, "rt", encoding="utf8") as f:
+            return json.load(f)
+
+    fig_json = build().to_json()
+
+    fpath.parent.mkdir(parents=True, exist_ok=True)
+    # Unique per call, threads of a process may build the same figure
+    tmp_path = fpath.with_name(f"{fpath.name}.{uuid.uuid4().hex}.tmp")
+    with gzip.open(tmp_path, "wt", encoding="utf8") as f:
+        f.write(fig_json)
+    os.replace(tmp_path, fpath)
+    cm.register(fpath, producer=producer, kind=kind)
+
+    return json.loads(fig_json)
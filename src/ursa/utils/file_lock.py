@@ -0,0 +1,72 @@
+"""Exclusive lock on a file, shared by threads and processes.
+
+Used to serialize read-modify-write updates of small JSON files written
+by several processes, e.g. the cache manifest or the status files of
+background jobs.
+"""
+
+import os
+import threading
+
+from contextlib import contextmanager
+
+if os.name == "nt":
+    import msvcrt
+else:
+    import fcntl
+
+# flock locks are held per open file, so threads of a process also need
+# a lock of their own. Keyed by absolute path.
+_locks = {}
+_locks_lock = threading.Lock()
+
+
+def _lock(f):
+    if os.name == "nt":
+        f.seek(0)
+        while True:
+            try:
+                msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+                break
+            except OSError:
+                # LK_LOCK gives up after 10 seconds
+                continue
+    else:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+
+
+def _unlock(f):
+    if os.name == "nt":
+        f.seek(0)
+        msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+    else:
+        fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
+@contextmanager
+def file_lock(fpath):
+    """Holds an exclusive lock on fpath, created if missing.
+
+    The lock is reentrant within a thread, the file is only locked by
+    the outermost acquisition.
+    """
+
+    key = os.path.abspath(fpath)
+    with _locks_lock:
+        state = _locks.setdefault(
+            key, {"lock": threading.RLock(), "depth": 0, "file": None}
+        )
+
+    with state["lock"]:
+        if state["depth"] == 0:
+            state["file"] = open(fpath, "a+b")
+            _lock(state["file"])
+        state["depth"] += 1
+        try:
+            yield
+        finally:
+            state["depth"] -= 1
+            if state["depth"] == 0:
+                _unlock(state["file"])
+                state["file"].close()
+                state["file"] = None
@@ -1,4 +1,18 @@
 import base64
+import io
+import math
+import os
+
+import numpy as np
+import plotly.colors as pc
+
+from PIL import Image
+
+# Maximum number of pixels of a map overlay after upscaling.
+OVERLAY_MAX_PIXELS = int(os.environ.get("URSA_OVERLAY_MAX_PIXELS", 16_000_000))
+
+# Maximum number of pixels of each frame of an animated raster.
+FRAME_MAX_PIXELS = int(os.environ.get("URSA_FRAME_MAX_PIXELS", 500_000))
 
 
 def b64_image(image_filename):
@@ -6,3 +20,144 @@ def b64_image(image_filename):
     with open(image_filename, "rb") as f:
         image = f.read()
     return "data:image/png;base64," + base64.b64encode(image).decode("utf-8")
+
+
+def overlay_scale(size, max_pixels, max_upscale):
+    """Returns the scale factor that fits an image of size (width, height)
+    in max_pixels. Upscaling uses integer factors up to max_upscale so
+    pixels stay square, downscaling only happens if the image is larger
+    than the budget."""
+
+    width, height = size
+    scale = (max_pixels / (width * height)) ** 0.5
+    if scale >= 1:
+        return max(1, min(int(scale), max_upscale))
+    return scale
+
+
+def encode_overlay(img, max_pixels=None, max_upscale=10, colors=256):
+    """Encodes an image as a PNG data URI for a mapbox image layer.
+
+    Mapbox interpolates image layers linearly, so small rasters are
+    upscaled with nearest neighbour to keep pixel edges sharp. The
+    image is converted to a palette before resizing, which takes a
+    quarter of the memory of RGBA and compresses much better.
+
+    Parameters
+    ----------
+    img : PIL.Image
+        Image to encode, usually RGBA.
+    max_pixels : int
+        Maximum number of pixels of the encoded image.
+        Defaults to OVERLAY_MAX_PIXELS.
+    max_upscale : int
+        Maximum upscaling factor, 1 disables upscaling.
+    colors : int
+        Maximum number of colors of the palette.
+
+    Returns
+    -------
+    uri : str
+        PNG data URI.
+
+    """
+
+    if max_pixels is None:
+        max_pixels = OVERLAY_MAX_PIXELS
+
+    if img.mode != "P":
+        img = img.quantize(colors=colors, method=Image.Quantize.FASTOCTREE)
+
+    scale = overlay_scale(img.size, max_pixels, max_upscale)
+    if scale != 1:
+        size = [max(1, round(hw * scale)) for hw in img.size]
+        img = img.resize(size, resample=Image.Resampling.NEAREST)
+
+    return png_uri(img)
+
+
+def png_uri(img):
+    """Encodes an image as an optimized PNG data URI."""
+
+    buffer = io.BytesIO()
+    img.save(buffer, format="PNG", optimize=True)
+    return "data:image/png;base64," + base64.b64encode(buffer.getvalue()).decode(
+        "utf-8"
+    )
+
+
+def colorscale_palette(colorscale):
+    """Samples a plotly colorscale into a flat list of 256 RGB values,
+    usable as the palette of a PIL image."""
+
+    colors = pc.sample_colorscale(
+        pc.get_colorscale(colorscale),
+        [i / 255 for i in range(256)],
+        colortype="tuple",
+    )
+    return [round(255 * c) for color in colors for c in color]
+
+
+def downsample_mean(band, max_pixels):
+    """Averages square blocks of a 2D array so the result has at most
+    max_pixels. Edges are padded by repetition if the block size does
+    not divide the shape."""
+
+    height, width = band.shape
+    factor = math.ceil(math.sqrt(height * width / max_pixels))
+    if factor <= 1:
+        return band
+
+    band = np.pad(band, [(0, -height % factor), (0, -width % factor)], mode="edge")
+    h, w = band.shape
+    return band.reshape(h // factor, factor, w // factor, factor).mean(axis=(1, 3))
+
+
+def encode_frames(grid, colorscale, vmin=0, vmax=1, max_pixels=None):
+    """Encodes each band of a raster stack as a palette PNG.
+
+    Bands are averaged down to the pixel budget, quantized to 256 levels
+    between vmin and vmax and colored with colorscale, so every frame
+    takes a few KB instead of a full matrix of floats.
+
+    Parameters
+    ----------
+    grid : np.ndarray
+        Array of shape (frames, height, width).
+    colorscale : str
+        Name of a plotly colorscale.
+    vmin, vmax : float
+        Values mapped to the ends of the colorscale.
+    max_pixels : int
+        Maximum number of pixels of each frame.
+        Defaults to FRAME_MAX_PIXELS.
+
+    Returns
+    -------
+    uris : list of str
+        PNG data URI of each frame.
+    shape : tuple
+        Height and width of the encoded frames.
+
+    """
+
+    if max_pixels is None:
+        max_pixels = FRAME_MAX_PIXELS
+
+    palette = colorscale_palette(colorscale)
+
+    uris = []
+    shape = grid.shape[1:]
+    for band in grid:
+        band = downsample_mean(np.asarray(band, dtype=np.float32), max_pixels)
+        shape = band.shape
+
+        scaled = (band - vmin) / (vmax - vmin)
+        levels = np.rint(np.clip(np.nan_to_num(scaled), 0, 1) * 255).astype(np.uint8)
+
+        # Setting the palette turns the grayscale image into a palette one
+        img = Image.fromarray(levels)
+        img.putpalette(palette)
+        uris.append(png_uri(img))
+
+    return uris, shape
@@ -0,0 +1,51 @@
+"""Long-lived process pools shared by all the calls of a module.
+
+Starting a pool from the app is expensive, spawned workers import the
+Dash app and the geo stack again before doing any work. Pools are
+created on first use, one per name, and kept alive between calls.
+
+Forking the multi-threaded app process is unsafe, so workers are forked
+from a forkserver where available and spawned otherwise.
+"""
+
+import multiprocessing
+import threading
+
+from concurrent.futures import ProcessPoolExecutor
+
+# Pools and their sizes, keyed by name
+_executors = {}
+_lock = threading.Lock()
+
+
+def get_executor(name, max_workers):
+    """Returns the pool called name, creating it if needed.
+
+    A pool is created again if max_workers differs from its size.
+    Workers are started on demand, so a large pool only costs memory
+    while its workers are busy.
+    """
+
+    with _lock:
+        executor, size = _executors.get(name, (None, 0))
+        if executor is not None and size != max_workers:
+            executor.shutdown(wait=False)
+            executor = None
+        if executor is None:
+            if "forkserver" in multiprocessing.get_all_start_methods():
+                context = multiprocessing.get_context("forkserver")
+            else:
+                context = multiprocessing.get_context("spawn")
+            executor = ProcessPoolExecutor(max_workers=max_workers, mp_context=context)
+            _executors[name] = (executor, max_workers)
+        return executor
+
+
+def reset_executor(name, executor):
+    """Drops executor if it is still the pool called name, e.g. after one
+    of its workers died, so the next call creates a new one."""
+
+    with _lock:
+        if _executors.get(name, (None, 0))[0] is executor:
+            del _executors[name]
+    executor.shutdown(wait=False)
@@ -1,13 +1,33 @@
 from osgeo import gdal
+import os
 import numpy as np
 import geopandas as gpd
 import rasterio as rio
+import shapely
+from concurrent.futures import ThreadPoolExecutor
 from shapely.geometry import box, Polygon
 import ee
 from pathlib import Path
 import rioxarray as rxr
 import xarray as xr
 
+# Base URL of the S3 bucket with the COGs, the bucket name is filled in
+# on request. Can be pointed to a local HTTP server for testing.
+S3_ENDPOINT = os.environ.get("URSA_S3_ENDPOINT", "http://{bucket}.s3.amazonaws.com")
+
+# Maximum number of concurrent windowed reads against remote COGs.
+S3_MAX_WORKERS = int(os.environ.get("URSA_S3_MAX_WORKERS", 8))
+
+# GDAL configuration for remote COG reads. Avoids listing the remote
+# directory on open and lets GDAL merge and cache range requests.
+GDAL_HTTP_OPTIONS = {
+    "GDAL_DISABLE_READDIR_ON_OPEN": "EMPTY_DIR",
+    "CPL_VSIL_CURL_ALLOWED_EXTENSIONS": ".tif",
+    "GDAL_HTTP_MULTIRANGE": "YES",
+    "GDAL_HTTP_MERGE_CONSECUTIVE_RANGES": "YES",
+    "VSI_CACHE": "TRUE",
+}
+
 
 def row2cell(row, res_xy):
     # Extract resolution for each dimension
@@ -24,6 +44,44 @@ def row2cell(row, res_xy):
     return poly
 
 
+def cells_from_xy(x, y, res_xy, crs=None, index=None):
+    """Builds the polygons of grid cells centered on x and y.
+
+    Vectorized equivalent of applying row2cell to every row of a
+    DataFrame with x and y columns.
+
+    Parameters
+    ----------
+    x : array_like
+        X coordinates of the cell centers.
+    y : array_like
+        Y coordinates of the cell centers.
+    res_xy : tuple
+        Resolution (res_x, res_y) of the grid, as returned by
+        rio.resolution().
+    crs : str
+        CRS of the coordinates.
+    index : array_like
+        Index of the returned GeoSeries, e.g. the index of the
+        DataFrame containing x and y.
+
+    Returns
+    -------
+    cells : gpd.GeoSeries
+        Polygon of each cell.
+
+    """
+
+    res_x, res_y = res_xy
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+
+    # XY Coordinates are centered on the pixel
+    cells = shapely.box(x - res_x / 2, y + res_y / 2, x + res_x / 2, y - res_y / 2)
+
+    return gpd.GeoSeries(cells, crs=crs, index=index)
+
+
 def km_2_lat(d):
     # radius of the earth
     R = 6371
@@ -128,6 +186,50 @@ def get_bboxes(city, country, data_path, buff=10, square=False):
     )
 
 
+def s3_url(s3_path, bucket="tec-expansion-urbana-p"):
+    """Returns the HTTP url of an object stored in an S3 bucket."""
+    return f"{S3_ENDPOINT.format(bucket=bucket)}/{s3_path}"
+
+
+def np_from_bbox_url(url, bbox, nodata_to_zero=False):
+    """Reads a windowed raster with bounds defined by bbox from a COG
+    at url and stores it in memory in a numpy array.
+
+    Parameters
+    ----------
+    url : str
+        Url or path of the COG.
+    bbox : Polygon
+        Shapely Polygon defining the raster's bounding box.
+    nodata_to_zero : bool
+        If True, sets the output raster's nodata attribute to 0.
+
+    Returns
+    -------
+    subset : np.array
+        Numpy array with raster data.
+    profile : dict
+        Dictionary with geographical properties of the raster.
+
+    """
+
+    with rio.open(url) as src:
+        profile = src.profile.copy()
+        transform = profile["transform"]
+        window = rio.windows.from_bounds(*bbox.bounds, transform)
+        window = window.round_lengths().round_offsets()
+        # The transform is specified as (dx, rot_x, x_0 , rot_y, dy, y0)
+        new_transform = src.window_transform(window)
+        profile.update(
+            {"height": window.height, "width": window.width, "transform": new_transform}
+        )
+        subset = src.read(window=window)
+    if nodata_to_zero:
+        subset[subset == profile["nodata"]] = 0
+
+    return subset, profile
+
+
 def np_from_bbox_s3(
     s3_path, bbox, bucket="tec-expansion-urbana-p", nodata_to_zero=False
 ):
@@ -161,23 +263,108 @@ def np_from_bbox_s3(
 
     gdal.PushErrorHandler("CPLQuietErrorHandler")
 
-    url = f"http://{bucket}.s3.amazonaws.com/{s3_path}"
+    return np_from_bbox_url(s3_url(s3_path, bucket), bbox, nodata_to_zero)
 
-    with rio.open(url) as src:
-        profile = src.profile.copy()
-        transform = profile["transform"]
-        window = rio.windows.from_bounds(*bbox.bounds, transform)
-        window = window.round_lengths().round_offsets()
-        # The transform is specified as (dx, rot_x, x_0 , rot_y, dy, y0)
-        new_transform = src.window_transform(window)
-        profile.update(
-            {"height": window.height, "width": window.width, "transform": new_transform}
+
+def _read_window(url, bbox, nodata_to_zero):
+    """Runs np_from_bbox_url within a GDAL environment with
+    GDAL_HTTP_OPTIONS, closed once the read finishes."""
+    gdal.PushErrorHandler("CPLQuietErrorHandler")
+    try:
+        with rio.Env(**GDAL_HTTP_OPTIONS):
+            return np_from_bbox_url(url, bbox, nodata_to_zero)
+    finally:
+        gdal.PopErrorHandler()
+
+
+def np_list_from_bbox_s3(
+    s3_paths,
+    bbox,
+    bucket="tec-expansion-urbana-p",
+    nodata_to_zero=False,
+    max_workers=None,
+):
+    """Downloads windowed rasters with bounds defined by bbox from several
+    COGs stored in an Amazon S3 bucket concurrently.
+
+    Reads are performed by a bounded pool of threads, each one within its
+    own GDAL environment, so the total time is close to that of the
+    slowest read instead of the sum of all of them.
+
+    Parameters
+    ----------
+    s3_paths : list of str
+        The relative paths of the COGs in S3.
+    bbox : Polygon
+        Shapely Polygon defining the rasters' bounding box.
+    bucket : str
+        Name of the S3 bucket with the COGs.
+    nodata_to_zero : bool
+        If True, sets the output rasters' nodata attribute to 0.
+    max_workers : int
+        Maximum number of concurrent reads. Defaults to S3_MAX_WORKERS.
+
+    Returns
+    -------
+    results : list of tuple
+        List of (subset, profile) tuples in the same order as s3_paths.
+
+    """
+
+    if max_workers is None:
+        max_workers = S3_MAX_WORKERS
+    max_workers = max(1, min(max_workers, len(s3_paths)))
+
+    urls = [s3_url(s3_path, bucket) for s3_path in s3_paths]
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        results = list(
+            executor.map(lambda url: _read_window(url, bbox, nodata_to_zero), urls)
         )
-        subset = src.read(window=window)
-    if nodata_to_zero:
-        subset[subset == profile["nodata"]] = 0
 
-    return subset, profile
+    return results
+
+
+def xr_from_np(array, profile, bands=None):
+    """Builds a georeferenced DataArray from a numpy array and its profile
+    without writing it to disk.
+
+    Parameters
+    ----------
+    array : np.array
+        Array with shape (band, y, x).
+    profile : dict
+        Dictionary with geographical properties of the raster, as returned
+        by np_from_bbox_s3.
+    bands : list
+        Coordinates for the band dimension.
+        If none, bands are numbered starting from 1.
+
+    Returns
+    -------
+    raster : xarray.DataArray
+        In memory raster.
+
+    """
+
+    transform = profile["transform"]
+    n_bands, height, width = array.shape
+
+    if bands is None:
+        bands = list(range(1, n_bands + 1))
+
+    # Coordinates are centered on the pixel
+    x = transform.c + transform.a * (np.arange(width) + 0.5)
+    y = transform.f + transform.e * (np.arange(height) + 0.5)
+
+    raster = xr.DataArray(
+        array, dims=("band", "y", "x"), coords={"band": bands, "y": y, "x": x}
+    )
+    raster = raster.rio.write_crs(profile["crs"])
+    raster = raster.rio.write_transform(transform)
+    raster = raster.rio.write_nodata(profile["nodata"])
+
+    return raster
 
 
 def tif_from_bbox_s3(
@@ -364,21 +551,7 @@ def np_from_bbox_local(local_path, bbox, nodata_to_zero=False):
 
     """
 
-    with rio.open(local_path) as src:
-        profile = src.profile.copy()
-        transform = profile["transform"]
-        window = rio.windows.from_bounds(*bbox.bounds, transform)
-        window = window.round_lengths().round_offsets()
-        # The transform is specified as (dx, rot_x, x_0 , rot_y, dy, y0)
-        new_transform = src.window_transform(window)
-        profile.update(
-            {"height": window.height, "width": window.width, "transform": new_transform}
-        )
-        subset = src.read(window=window)
-    if nodata_to_zero:
-        subset[subset == profile["nodata"]] = 0
-
-    return subset, profile
+    return np_from_bbox_url(local_path, bbox, nodata_to_zero)
 
 
 def pop_2_density(raster, units="ha", save=False):
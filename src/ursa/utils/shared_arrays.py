@@ -0,0 +1,39 @@
+"""Helpers to share read-only numpy arrays with worker processes.
+
+Arrays are copied once into a shared memory block and workers attach to
+it from a small (name, shape, dtype) spec, instead of receiving a
+pickled copy of the array with every task.
+"""
+
+import numpy as np
+
+from multiprocessing import shared_memory
+
+
+def to_shared(array):
+    """Copies array into a new shared memory block. Returns the block and
+    the (name, shape, dtype) spec needed to attach to it.
+
+    The caller owns the block and must close and unlink it once workers
+    are done.
+    """
+
+    array = np.ascontiguousarray(array)
+    shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+    np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)[:] = array
+    return shm, (shm.name, array.shape, array.dtype.str)
+
+
+def from_shared(spec, readonly=False):
+    """Attaches to the shared memory block described by spec. Returns the
+    block and an array view of it.
+
+    Views must be released before closing the block.
+    """
+
+    name, shape, dtype = spec
+    shm = shared_memory.SharedMemory(name=name)
+    array = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+    if readonly:
+        array.flags.writeable = False
+    return shm, array